@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Hermetic benchmark of the full clone flow.
+
+The benchmark uses the libvirt test driver, a VG on a loop device and a small fake Debian template,
+so it never touches production domains or volumes. It still has to be run as root:
+
+    python -m bench -o before.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from lxml import etree
+
+from bench import fixtures
+from libvirtpy.conn import LibVirtConnection
+from util import config as configuration
+from util import metrics
+from util import settings
+from util import trace
+from util.clone import clone
+
+log = logging.getLogger(__name__)
+
+TEMPLATE = 'benchtpl'
+TEMPLATE_ID = 99
+VG = 'virsh-create-bench'
+MiB = 1024 * 1024
+
+SCENARIOS = {
+    'single': {'clones': 1},
+    'batch-10': {'clones': 10},
+    'batch-50': {'clones': 50},
+    'dense': {'clones': 1, 'dense': True},
+    'dense-10': {'clones': 10, 'dense': True},
+    'many-domains': {'clones': 1, 'domains': 500},
+}
+
+parser = argparse.ArgumentParser(prog='python -m bench', description=__doc__.splitlines()[0])
+parser.add_argument('-s', '--scenario', action='append', choices=sorted(SCENARIOS),
+                    help="Scenario to run, may be given multiple times (Default: all).")
+parser.add_argument('--disk-size', type=int, default=128, metavar='MiB',
+                    help="Size of the template disk in MiB (Default: %(default)s).")
+parser.add_argument('-o', '--output', metavar='FILE',
+                    help="Write results to FILE (Default: bench-<git revision>.json).")
+parser.add_argument('-v', '--verbose', default=0, action="count",
+                    help="Verbose output. Can be given up to three times to increase verbosity.")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def summarize(runs):
+    """Get p50 and max of every phase over all successful runs."""
+    phases = {}
+    for run in runs:
+        if run['status'] != 'ok':
+            continue
+        for phase, duration in run['phases']:
+            phases.setdefault(phase, []).append(duration)
+        phases.setdefault('total', []).append(run['duration'])
+    return {phase: {'p50': metrics.percentile(values, 50), 'max': max(values)}
+            for phase, values in phases.items()}
+
+
+def run_scenario(name, clones=1, dense=False, domains=0, disk_size=128 * MiB):
+    log.warning('Running scenario %s...', name)
+    config = configuration.load('virsh-create.conf.example')
+    section = 'DEFAULT'
+    config[section]['template_id'] = str(TEMPLATE_ID)
+
+    conn = LibVirtConnection('test:///default')
+    defined = []
+    runs = []
+
+    workdir = tempfile.mkdtemp(prefix='virsh-create-bench-')
+    vg_size = (clones + 2) * disk_size
+    try:
+        with fixtures.loop_vg(VG, vg_size, workdir):
+            disk = fixtures.make_template(VG, TEMPLATE, disk_size, config, section, dense=dense)
+            conn.loadXML(etree.fromstring(
+                fixtures.domain_xml(TEMPLATE, TEMPLATE_ID, config, section, disk=disk)))
+            defined.append(TEMPLATE)
+            for i in range(domains):
+                dummy = 'bench-dummy-%s' % i
+                conn.loadXML(etree.fromstring(
+                    fixtures.domain_xml(dummy, 1000 + i, config, section)))
+                defined.append(dummy)
+
+            for i in range(clones):
+                guest = 'bench%02d' % i
+                args = argparse.Namespace(
+                    name=guest, id=10 + i, frm=TEMPLATE, section=section, desc='', cpus=1,
+                    mem=1.0, extra=None, update_cert=False, start=False,
+                    wait_ready=False, numa=False, profile=None)
+                configuration.for_guest(config, section, args.id, args.frm)
+                settings.CHROOT = os.path.join(workdir, 'target')
+
+                del trace.spans[:]
+                status = 'ok'
+                try:
+                    clone(conn, args, config)
+                    defined.append(guest)
+                except SystemExit:
+                    status = 'failed'
+                    log.error('%s: clone %s failed.', name, guest)
+                    fixtures.cleanup_guest(guest, '/dev/%s/%s-disk' % (VG, guest),
+                                           settings.CHROOT)
+
+                data = metrics.collect() or {}
+                data['status'] = status
+                data['name'] = guest
+                runs.append(data)
+    finally:
+        for domain in defined:
+            try:
+                conn.getRawDomain(name=domain).undefine()
+            except Exception as e:
+                log.warning('Could not undefine %s: %s', domain, e)
+        try:
+            os.rmdir(workdir)
+        except OSError as e:
+            log.warning('Could not remove %s: %s', workdir, e)
+
+    return {
+        'name': name,
+        'clones': clones,
+        'dense': dense,
+        'domains': domains,
+        'disk_size': disk_size,
+        'runs': runs,
+        'summary': summarize(runs),
+    }
+
+
+def main():
+    args = parser.parse_args()
+    logging.basicConfig(
+        format='[%(asctime)s] %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.WARNING - (args.verbose * 10 if args.verbose <= 2 else 20)
+    )
+
+    if os.getuid() != 0:
+        log.error('Error: The benchmark needs root privileges for loop devices and LVM.')
+        sys.exit(1)
+    missing = fixtures.missing_tools()
+    if missing:
+        log.error('Error: Missing tools: %s', ', '.join(missing))
+        sys.exit(1)
+
+    revision = git_revision()
+    results = {
+        'revision': revision,
+        'host': socket.gethostname(),
+        'started': time.time(),
+        'scenarios': [],
+    }
+    for name in args.scenario or sorted(SCENARIOS):
+        results['scenarios'].append(
+            run_scenario(name, disk_size=args.disk_size * MiB, **SCENARIOS[name]))
+
+    output = args.output or 'bench-%s.json' % revision
+    with open(output, 'w') as stream:
+        json.dump(results, stream, indent=2)
+
+    print('%-14s %-20s %9s %9s' % ('scenario', 'phase', 'p50', 'max'))
+    for scenario in results['scenarios']:
+        for phase, values in sorted(scenario['summary'].items()):
+            print('%-14s %-20s %8.2fs %8.2fs' % (
+                scenario['name'], phase, values['p50'], values['max']))
+    print('Results written to %s' % output)
+
+
+if __name__ == '__main__':
+    main()
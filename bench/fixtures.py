@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Fixtures for the benchmark: a loop-device backed VG and a small fake Debian template.
+
+The template disk is laid out like our real templates: The first partition is ``/boot``, the
+second partition is a PV of the VG ``vm_<template>`` that contains the ``root`` LV.
+"""
+
+import logging
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+BOOT_SIZE = 16  # MiB
+TOOLS = ['losetup', 'pvcreate', 'vgcreate', 'lvcreate', 'kpartx', 'parted', 'mkfs.ext2',
+         'mkfs.ext4', 'ssh-keygen', 'ldd']
+
+# binaries that have to work inside the chroot
+CHROOT_BINARIES = ['sh', 'rm', 'mv', 'sed', 'ssh-keygen']
+
+# commands that would need network access or a real kernel, replaced by a small shell script
+CHROOT_STUBS = {
+    'usr/bin/apt-get': '#!/bin/sh\necho "Need to get 0 B of archives."\n',
+    'usr/sbin/update-initramfs': '#!/bin/sh\nexit 0\n',
+}
+
+DOMAIN_XML = """<domain type='test'>
+  <name>{name}</name>
+  <description>{name}</description>
+  <memory unit='KiB'>1048576</memory>
+  <currentMemory unit='KiB'>1048576</currentMemory>
+  <vcpu>1</vcpu>
+  <os><type arch='x86_64'>hvm</type></os>
+  <devices>
+    {disks}
+    <interface type='bridge'>
+      <mac address='{public_mac}'/>
+      <source bridge='br0'/>
+    </interface>
+    <interface type='bridge'>
+      <mac address='{priv_mac}'/>
+      <source bridge='br1'/>
+    </interface>
+    <graphics type='vnc' port='{vnc_port}'/>
+  </devices>
+</domain>"""
+
+DISK_XML = """<disk type='block' device='disk'>
+      <source dev='{path}'/>
+      <target dev='vdz' bus='virtio'/>
+    </disk>"""
+
+
+def run(cmd, check=True):
+    log.debug('+ %s', ' '.join(cmd))
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if check and proc.returncode != 0:
+        raise RuntimeError('%s returned %s: %s' % (
+            cmd[0], proc.returncode, proc.stderr.decode('utf-8', 'replace')))
+    return proc.stdout.decode('utf-8')
+
+
+def missing_tools():
+    return [t for t in TOOLS if shutil.which(t) is None]
+
+
+@contextmanager
+def loop_vg(name, size, directory):
+    """Create a VG called ``name`` on a sparse file of ``size`` bytes."""
+    image = os.path.join(directory, '%s.img' % name)
+    with open(image, 'wb') as stream:
+        stream.truncate(size)
+
+    loop = run(['losetup', '--find', '--show', image]).strip()
+    try:
+        run(['pvcreate', '-q', loop])
+        run(['vgcreate', '-q', name, loop])
+        try:
+            yield name
+        finally:
+            run(['vgremove', '-q', '-f', name], check=False)
+            run(['pvremove', '-q', '-f', loop], check=False)
+    finally:
+        run(['losetup', '-d', loop], check=False)
+        os.remove(image)
+
+
+def kpartx_add(path):
+    """Map partitions of ``path``, return the paths of the partition devices."""
+    output = run(['kpartx', '-s', '-a', '-v', path])
+    return ['/dev/mapper/%s' % name for name in re.findall(r'^add map (\S+)', output, re.M)]
+
+
+def install_binary(root, name):
+    """Copy a host binary and the libraries it links against into ``root``."""
+    path = shutil.which(name)
+    files = [path]
+    for line in run(['ldd', path], check=False).splitlines():
+        match = re.search(r'(/\S+) \(0x', line)
+        if match:
+            files.append(match.group(1))
+
+    for src in files:
+        dest = os.path.join(root, src.lstrip('/'))
+        if os.path.exists(dest):
+            continue
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        shutil.copy2(os.path.realpath(src), dest)
+
+    # e.g. /bin/sh might be found at /usr/bin/sh on merged-/usr hosts
+    for bindir in ['bin', 'usr/bin']:
+        dest = os.path.join(root, bindir, name)
+        if not os.path.exists(dest):
+            os.makedirs(os.path.dirname(dest), exist_ok=True)
+            shutil.copy2(os.path.realpath(path), dest)
+
+
+def populate_root(root, template, config, section):
+    """Create the files that :py:mod:`util.process` edits in a new guest."""
+    def get(key):
+        return config.get(section, key)
+
+    files = {
+        'etc/hostname': '%s\n' % template,
+        'etc/hosts': '127.0.0.1 localhost\n127.0.1.1 %s.local %s\n' % (template, template),
+        'etc/fstab': '/dev/mapper/vm_%s-root / ext4 defaults 0 1\n' % template,
+        'etc/mailname': '%s.local\n' % template,
+        'etc/resolv.conf': 'nameserver 2001:db8::53\n',
+        'etc/passwd': 'root:x:0:0:root:/root:/bin/sh\nuser:x:1000:1000::/home/user:/bin/sh\n',
+        'etc/group': 'root:x:0:\nssl-cert:x:110:\nuser:x:1000:\n',
+        'etc/nsswitch.conf': 'passwd: files\ngroup: files\n',
+        'etc/postfix/main.cf': 'myhostname = %s.local\n' % template,
+        'etc/cgabackup/client.conf': 'host = backup-cga-%s\npath = /backup/cga/%s\n' % (
+            template, template),
+        'etc/cron.d/cgabackup': '0 5 * * * root /usr/bin/true\n',
+        'etc/network/interfaces.d/eth0': 'address %s\naddress %s\n' % (
+            get('src_public_ip4'), get('src_public_ip6')),
+        'etc/network/interfaces.d/eth1': 'address %s\naddress %s\n' % (
+            get('src_priv_ip4'), get('src_priv_ip6')),
+        'etc/udev/rules.d/70-persistent-net.rules':
+            'SUBSYSTEM=="net", ATTR{address}=="%s", NAME="eth0"\n'
+            'SUBSYSTEM=="net", ATTR{address}=="%s", NAME="eth1"\n' % (
+                get('src_public_mac'), get('src_priv_mac')),
+        'etc/ssh/sshd_config.d/local.conf': 'ListenAddress %s\n' % get('src_priv_ip6'),
+        'etc/ssh/ssh_host_ed25519_key': 'template key\n',
+        'etc/ssh/ssh_host_ed25519_key.pub': 'template key\n',
+        'etc/munin/munin-node.conf': 'host %s\n#tls paranoid\ntls_private_key x\n'
+                                     'tls_certificate x\n' % get('src_priv_ip6'),
+        'boot/grub/grub.cfg': 'menuentry "Debian GNU/Linux, %s" {}\n' % template,
+        'root/.bash_history': 'ls\n',
+        'home/user/.bash_history': 'ls\n',
+        'home/user/.viminfo': '\n',
+    }
+    for path, content in files.items():
+        path = os.path.join(root, path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as stream:
+            stream.write(content)
+
+    for path in ['dev', 'proc', 'sys', 'tmp', 'var/log', 'usr/sbin', 'root/.ssh',
+                 'etc/ssl/private', 'etc/ssl/public']:
+        os.makedirs(os.path.join(root, path), exist_ok=True)
+
+    for name in CHROOT_BINARIES:
+        install_binary(root, name)
+    for path, content in CHROOT_STUBS.items():
+        path = os.path.join(root, path)
+        with open(path, 'w') as stream:
+            stream.write(content)
+        os.chmod(path, 0o755)
+
+
+def make_template(vg, template, size, config, section, dense=False):
+    """Create the boot disk of a template in ``vg`` and return its path.
+
+    :param dense: Fill the disk with random data first, so the copy can't profit from the sparse
+        loop file.
+    """
+    lv_name = '%s-disk' % template
+    run(['lvcreate', '-q', '-y', '-L', '%sB' % size, '-n', lv_name, vg])
+    path = '/dev/%s/%s' % (vg, lv_name)
+    if dense:
+        run(['dd', 'if=/dev/urandom', 'of=%s' % path, 'bs=4M', 'status=none'], check=False)
+
+    run(['parted', '-s', path, 'mklabel', 'msdos',
+         'mkpart', 'primary', '1MiB', '%sMiB' % (BOOT_SIZE + 1),
+         'mkpart', 'primary', '%sMiB' % (BOOT_SIZE + 1), '100%',
+         'set', '2', 'lvm', 'on'])
+    boot, pv = kpartx_add(path)
+    inner_vg = 'vm_%s' % template
+    try:
+        run(['mkfs.ext2', '-q', boot])
+        run(['pvcreate', '-q', '-f', pv])
+        run(['vgcreate', '-q', inner_vg, pv])
+        run(['lvcreate', '-q', '-y', '-l', '100%FREE', '-n', 'root', inner_vg])
+        run(['mkfs.ext4', '-q', '/dev/%s/root' % inner_vg])
+
+        root = tempfile.mkdtemp(prefix='virsh-create-bench-')
+        run(['mount', '/dev/%s/root' % inner_vg, root])
+        try:
+            os.makedirs(os.path.join(root, 'boot'))
+            run(['mount', boot, os.path.join(root, 'boot')])
+            try:
+                populate_root(root, template, config, section)
+            finally:
+                run(['umount', os.path.join(root, 'boot')])
+        finally:
+            run(['umount', root])
+            os.rmdir(root)
+    finally:
+        run(['vgchange', '-q', '-a', 'n', inner_vg], check=False)
+        run(['kpartx', '-s', '-d', path], check=False)
+    return path
+
+
+def cleanup_guest(name, path, target):
+    """Release whatever a failed clone of ``name`` left mounted at ``target``."""
+    if os.path.ismount(target):
+        run(['umount', '-R', target], check=False)
+    if os.path.isdir(target):
+        os.rmdir(target)
+    run(['vgchange', '-q', '-a', 'n', 'vm_%s' % name], check=False)
+    run(['kpartx', '-s', '-d', path], check=False)
+
+
+def domain_xml(name, guest_id, config, section, disk=None):
+    """Get the XML for a domain in the libvirt test driver.
+
+    Domains with an id of 100 or more (that the config can't express) get MAC addresses with the
+    QEMU prefix, so they never conflict with those of a clone.
+    """
+    disks = DISK_XML.format(path=disk) if disk else ''
+    if guest_id < 100:
+        public_mac = config.get(section, 'public_mac', vars={'guest_id': '%02d' % guest_id})
+        priv_mac = config.get(section, 'priv_mac', vars={'guest_id': '%02d' % guest_id})
+    else:
+        public_mac = '52:54:00:00:%02x:%02x' % divmod(guest_id % 0x10000, 0x100)
+        priv_mac = '52:54:00:01:%02x:%02x' % divmod(guest_id % 0x10000, 0x100)
+    return DOMAIN_XML.format(name=name, disks=disks, vnc_port=5900 + guest_id,
+                             public_mac=public_mac, priv_mac=priv_mac)
@@ -1,5 +1,7 @@
 import six
 
+from concurrent.futures import ThreadPoolExecutor
+
 from lxml import etree
 
 import libvirt
@@ -9,11 +11,14 @@ from libvirtpy.error import DomainLookupError
 from libvirtpy.constants import AVAILABLE_VIRTUAL_FUNCTIONS
 from libvirtpy.domain import LibVirtDomain
 #from libvirtpy._libvirt import libvirt
+from util import trace
 
 
 class LibVirtConnection(object):
     def __init__(self, name=None):
-        self._conn = libvirt.open(name)
+        self.uri = name
+        with trace.span('open', cat='libvirt', command='open(%s)' % name):
+            self._conn = libvirt.open(name)
         if self._conn is None:
             raise ConnectionError('Failed to open connection to the hypervisor')
 
@@ -24,9 +29,11 @@ class LibVirtConnection(object):
     def getRawDomain(self, name=None, id=None):
         try:
             if name is not None:
-                return self._conn.lookupByName(name)
+                with trace.span('lookupByName', cat='libvirt', command='lookupByName(%s)' % name):
+                    return self._conn.lookupByName(name)
             if id is not None:
-                return self._conn.lookupByID(id)
+                with trace.span('lookupByID', cat='libvirt', command='lookupByID(%s)' % id):
+                    return self._conn.lookupByID(id)
         except Exception as e:
             raise DomainLookupError("Error looking up domain", e)
 
@@ -50,16 +57,26 @@ class LibVirtConnection(object):
         if cache and self._fetched_all is True:
             return list(six.itervalues(self._name_cache))
 
-        for name in self._conn.listDefinedDomains():  # only powered-off domains!
+        # rebuild the caches, so domains that were undefined in the meantime disappear
+        name_cache = {}
+        id_cache = {}
+
+        with trace.span('listDefinedDomains', cat='libvirt'):
+            defined = self._conn.listDefinedDomains()
+        for name in defined:  # only powered-off domains!
             domain = LibVirtDomain(conn=self, name=name)
-            self._name_cache[name] = domain
-            self._id_cache[domain.id] = domain
+            name_cache[name] = domain
+            id_cache[domain.id] = domain
 
-        for did in self._conn.listDomainsID():  # only powered-on domains!
+        with trace.span('listDomainsID', cat='libvirt'):
+            running = self._conn.listDomainsID()
+        for did in running:  # only powered-on domains!
             domain = LibVirtDomain(conn=self, id=did)
-            self._name_cache[domain.name] = domain
-            self._id_cache[did] = domain
+            name_cache[domain.name] = domain
+            id_cache[did] = domain
 
+        self._name_cache = name_cache
+        self._id_cache = id_cache
         self._fetched_all = True
         return list(six.itervalues(self._name_cache))
 
@@ -73,9 +90,104 @@ class LibVirtConnection(object):
         available = AVAILABLE_VIRTUAL_FUNCTIONS - used_vfs
         return list(available)[0]
 
+    def hasDomain(self, name):
+        try:
+            self.getRawDomain(name=name)
+            return True
+        except DomainLookupError:
+            return False
+
+    def getHostStats(self):
+        """Get physical and committed memory (in bytes) and CPUs of the host.
+
+        All defined domains count as committed, not only running ones, since they might be
+        started at any time.
+        """
+        with trace.span('getInfo', cat='libvirt'):
+            info = self._conn.getInfo()
+        with trace.span('listAllDomains', cat='libvirt'):
+            domains = self._conn.listAllDomains(0)
+
+        committed_memory = committed_cpus = 0
+        for domain in domains:
+            state, max_memory, memory, cpus, cpu_time = domain.info()
+            committed_memory += max_memory * 1024
+            committed_cpus += cpus
+
+        return {
+            'memory': info[1] * 1024 * 1024,
+            'cpus': info[2],
+            'committed_memory': committed_memory,
+            'committed_cpus': committed_cpus,
+        }
+
+    def getCapabilities(self):
+        with trace.span('getCapabilities', cat='libvirt'):
+            return etree.fromstring(self._conn.getCapabilities())
+
+    def getStoragePoolStats(self, name):
+        """Get capacity, allocation and available bytes of a storage pool or ``None``."""
+        try:
+            with trace.span('storagePoolLookupByName', cat='libvirt'):
+                pool = self._conn.storagePoolLookupByName(name)
+                pool.refresh(0)
+                state, capacity, allocation, available = pool.info()
+        except libvirt.libvirtError:
+            return None
+        return {'capacity': capacity, 'allocation': allocation, 'available': available}
+
+    def getVolumeSize(self, path):
+        """Get the capacity of the storage volume at ``path`` in bytes or ``None``."""
+        try:
+            with trace.span('storageVolLookupByPath', cat='libvirt'):
+                return self._conn.storageVolLookupByPath(path).info()[1]
+        except libvirt.libvirtError:
+            return None
+
+    def startDomain(self, name):
+        domain = self.getRawDomain(name=name)
+        with trace.span('create', cat='libvirt', command='create(%s)' % name):
+            domain.create()
+
     def loadXML(self, domain_xml):
-        domain = self._conn.defineXML(etree.tostring(domain_xml).decode('utf-8'))
+        with trace.span('defineXML', cat='libvirt'):
+            domain = self._conn.defineXML(etree.tostring(domain_xml).decode('utf-8'))
         return LibVirtDomain(self, domain=domain)
 
 
-conn = LibVirtConnection(None)
+class LibVirtConnectionPool(object):
+    """Connections to several hypervisors that are queried in parallel."""
+
+    def __init__(self, uris):
+        self.uris = list(uris)
+        self.errors = {}  # URIs that could not be opened -> the error
+
+        def connect(uri):
+            try:
+                return LibVirtConnection(uri)
+            except (libvirt.libvirtError, ConnectionError) as e:
+                self.errors[uri] = str(e)
+                return None
+
+        with ThreadPoolExecutor(max_workers=len(self.uris) or 1) as executor:
+            self.connections = list(executor.map(connect, self.uris))
+
+    def get(self, uri):
+        """Get the connection to ``uri`` (``None`` if it could not be opened)."""
+        return self.connections[self.uris.index(uri)]
+
+    def map(self, func):
+        """Call ``func`` with every connection in parallel, return the results in order.
+
+        The result for hosts that could not be reached is ``None``.
+        """
+        parent = trace.current()
+
+        def call(conn):
+            if conn is None:
+                return None
+            with trace.span(conn.uri or 'default', cat='host', parent=parent):
+                return func(conn)
+
+        with ThreadPoolExecutor(max_workers=len(self.connections) or 1) as executor:
+            return list(executor.map(call, self.connections))
@@ -3,8 +3,22 @@ import logging
 
 from lxml import etree
 
+from util import trace
+
 log = logging.getLogger(__name__)
 
+DISK_TYPES = {'block': 'dev', 'file': 'file'}  # disk type -> attribute of the source element
+
+
+def _disks(xml):
+    """Yield all block and file disks (with a source) in ``xml``, skipping e.g. CD-ROMs."""
+    for elem in xml.findall('devices/disk'):
+        source = elem.find('source')
+        if elem.get('type') in DISK_TYPES and elem.get('device', 'disk') == 'disk' \
+                and source is not None:
+            yield elem
+
+
 class LibVirtBase(object):
     def getBootDisk(self):
         # NOTE: according to documentation, the xml description sorts disks by
@@ -12,10 +26,54 @@ class LibVirtBase(object):
 
         # We convert returned value to str because for some reason the script
         # segfaults (!) otherwise.
-        return str(self.xml.find('devices/disk[@type="block"]/source').get('dev'))
+        elem = next(_disks(self.xml))
+        return str(elem.find('source').get(DISK_TYPES[elem.get('type')]))
 
     def getBootTarget(self):
-        return str(self.xml.find('devices/disk[@type="block"]/target').get('dev'))
+        return str(next(_disks(self.xml)).find('target').get('dev'))
+
+    def getBootDiskFormat(self):
+        """Get the format of a file boot disk (e.g. ``qcow2``), ``None`` for block devices."""
+        typ, path, fmt = next(self.getDisks())
+        return fmt if typ == 'file' else None
+
+    def getDisks(self):
+        """Yield type (``block`` or ``file``), path and format of all disks."""
+        for elem in _disks(self.xml):
+            driver = elem.find('driver')
+            fmt = driver.get('type', 'raw') if driver is not None else 'raw'
+            yield elem.get('type'), elem.find('source').get(DISK_TYPES[elem.get('type')]), fmt
+
+    def getDiskPaths(self):
+        for typ, path, fmt in self.getDisks():
+            yield path
+
+    def getVncPort(self):
+        elem = self.xml.find('devices/graphics[@type="vnc"]')
+        if elem is None or elem.get('port') in (None, '-1'):  # -1 means autoport
+            return None
+        return int(elem.get('port'))
+
+    def getMacs(self):
+        return [e.get('address') for e in self.xml.findall('devices/interface/mac')]
+
+    def getIPs(self):
+        return [e.get('value') for e in self.xml.findall('devices/interface/filterref/parameter')
+                if e.get('name') in ('IP', 'IPV6')]
+
+    def getPinning(self):
+        """Get vCPUs, memory (KiB), the cpuset of every vCPU and the NUMA nodeset of the memory.
+
+        Cpusets and the nodeset are ``None`` if the domain is not pinned.
+        """
+        xml = self.xml
+        vcpu = xml.find('vcpu')
+        pins = dict((int(e.get('vcpu')), e.get('cpuset'))
+                    for e in xml.findall('cputune/vcpupin'))
+        cpusets = [pins.get(i, vcpu.get('cpuset')) for i in range(int(vcpu.text))]
+        memory = xml.find('numatune/memory')
+        nodeset = memory.get('nodeset') if memory is not None else None
+        return int(vcpu.text), int(xml.find('memory').text), cpusets, nodeset
 
 class LibVirtDomain(LibVirtBase):
     def __init__(self, conn, name=None, id=None, domain=None):
@@ -42,12 +100,14 @@ class LibVirtDomain(LibVirtBase):
 
     @property
     def status(self):
-        return self._domain.info()[0]
+        with trace.span('info', cat='libvirt'):
+            return self._domain.info()[0]
 
     @property
     def xml(self):
         if self._xml is None:
-            self._xml = etree.fromstring(self._domain.XMLDesc(0))
+            with trace.span('XMLDesc', cat='libvirt'):
+                self._xml = etree.fromstring(self._domain.XMLDesc(0))
 
         return copy.deepcopy(self._xml)
 
@@ -63,13 +123,6 @@ class LibVirtDomain(LibVirtBase):
         func = int(elem.get('function'), 16)
         return domain, bus, slot, func
 
-    def getDiskPaths(self):
-        for elem in self.xml.findall('devices/disk[@type="block"]'):
-            source = elem.find('source')
-            if source is None:
-                continue
-            yield source.get('dev')
-
     def copy(self):
         return LibVirtDomainXML(self.xml)
 
@@ -191,9 +244,122 @@ class LibVirtDomainXML(LibVirtBase):
             v6.set('value', ip6)
 
 
-    def replaceDisk(self, old_path, new_path):
-        elem = self.xml.find('devices/disk/source[@dev="%s"]' % old_path)
-        elem.set('dev', new_path)
+    def _element(self, path):
+        """Get the child element at ``path``, creating it if it does not exist."""
+        elem = self.xml
+        for tag in path.split('/'):
+            child = elem.find(tag)
+            elem = etree.SubElement(elem, tag) if child is None else child
+        return elem
+
+    def pin(self, vcpus, cpuset, nodeset):
+        """Pin vCPU ``i`` to the host CPUs ``vcpus[i]``, emulator threads to ``cpuset`` and the
+        memory to the NUMA nodes in ``nodeset``."""
+        vcpu = self.xml.find('vcpu')
+        vcpu.set('placement', 'static')
+        vcpu.set('cpuset', cpuset)
+
+        cputune = self._element('cputune')
+        for elem in cputune.findall('vcpupin') + cputune.findall('emulatorpin'):
+            cputune.remove(elem)
+        for i, cpus in enumerate(vcpus):
+            etree.SubElement(cputune, 'vcpupin', vcpu=str(i), cpuset=cpus)
+        etree.SubElement(cputune, 'emulatorpin', cpuset=cpuset)
+
+        numatune = self._element('numatune')
+        for elem in list(numatune):
+            numatune.remove(elem)
+        etree.SubElement(numatune, 'memory', mode='strict', nodeset=nodeset)
+
+    def setCpuTopology(self, sockets, cores, threads):
+        """Set the guest CPU topology, guest NUMA cells of the template are removed."""
+        cpu = self._element('cpu')
+        for elem in cpu.findall('topology') + cpu.findall('numa'):
+            cpu.remove(elem)
+        etree.SubElement(cpu, 'topology', sockets=str(sockets), cores=str(cores),
+                         threads=str(threads))
+
+    def setDiskDriver(self, cache=None, io=None, discard=None):
+        """Set the cache, I/O and discard mode of all disks, ``None`` keeps the current value."""
+        for elem in _disks(self.xml):
+            driver = elem.find('driver')
+            if driver is None:
+                driver = etree.SubElement(elem, 'driver', name='qemu')
+            for key, value in [('cache', cache), ('io', io), ('discard', discard)]:
+                if value is not None:
+                    driver.set(key, value)
+
+    def setIOThreads(self, count):
+        """Use ``count`` iothreads, virtio disks and SCSI controllers are assigned round-robin."""
+        for elem in self.xml.findall('iothreads') + self.xml.findall('iothreadids'):
+            self.xml.remove(elem)
+        if count > 0:
+            etree.SubElement(self.xml, 'iothreads').text = str(count)
+
+        elems = [e for e in _disks(self.xml) if e.find('target[@bus="virtio"]') is not None]
+        elems += self.xml.findall('devices/controller[@model="virtio-scsi"]')
+        for i, elem in enumerate(elems):
+            driver = elem.find('driver')
+            if count == 0:
+                if driver is not None and 'iothread' in driver.attrib:
+                    del driver.attrib['iothread']
+                continue
+            if driver is None:
+                driver = etree.SubElement(elem, 'driver')
+            driver.set('iothread', str(i % count + 1))
+
+    def setNetQueues(self, queues):
+        """Set the number of queues of all virtio network interfaces."""
+        for iface in self.xml.findall('devices/interface'):
+            if iface.find('model[@type="virtio"]') is None:
+                continue
+            driver = iface.find('driver')
+            if driver is None:
+                driver = etree.SubElement(iface, 'driver', name='vhost')
+            if queues > 1:
+                driver.set('queues', str(queues))
+            elif 'queues' in driver.attrib:
+                del driver.attrib['queues']
+
+    def setHugepages(self, enabled):
+        backing = self.xml.find('memoryBacking')
+        if backing is None and enabled:
+            backing = etree.SubElement(self.xml, 'memoryBacking')
+        if backing is None:
+            return
+        for elem in backing.findall('hugepages'):
+            backing.remove(elem)
+        if enabled:
+            etree.SubElement(backing, 'hugepages')
+        elif len(backing) == 0:
+            self.xml.remove(backing)
+
+    def setMemballoon(self, model, period=None):
+        """Set the memballoon model (``none`` disables it) and the statistics period."""
+        devices = self.xml.find('devices')
+        elem = devices.find('memballoon')
+        if elem is None:
+            elem = etree.SubElement(devices, 'memballoon')
+        for child in list(elem):  # a disabled balloon has no address either
+            if child.tag == 'stats' or model == 'none':
+                elem.remove(child)
+        elem.set('model', model)
+        if model != 'none' and period:
+            etree.SubElement(elem, 'stats', period=str(period))
+
+    def replaceDisk(self, old_path, new_path, format=None):
+        """Replace the disk at ``old_path``, optionally changing the format of a file disk."""
+        for elem in _disks(self.xml):
+            source = elem.find('source')
+            attr = DISK_TYPES[elem.get('type')]
+            if source.get(attr) == old_path:
+                source.set(attr, new_path)
+                if format is not None:
+                    driver = elem.find('driver')
+                    if driver is None:
+                        driver = etree.SubElement(elem, 'driver', name='qemu')
+                    driver.set('type', format)
+                return
 
     def __str__(self):
         return etree.tostring(self.xml)
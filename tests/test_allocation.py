@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from util import allocation
+from util import config as configuration
+from util.lvm import PV
+
+GiB = 1024 ** 3
+
+
+class OptionsTestCase(unittest.TestCase):
+    def config(self, **options):
+        config = configuration.load(os.devnull)
+        config['DEFAULT'].update(options)
+        return config
+
+    def test_defaults(self):
+        self.assertEqual(allocation.options(self.config(), 'DEFAULT'), ('spread', {}, None, 2))
+
+    def test_options(self):
+        config = self.config(lv_placement='lvm', vg_map='hdd:ssd1,ssd2 other:x',
+                             lv_stripe_min_size='1.5', lv_stripes='3')
+        self.assertEqual(allocation.options(config, 'DEFAULT'),
+                         ('lvm', {'hdd': ['ssd1', 'ssd2'], 'other': ['x']}, 1.5 * GiB, 3))
+
+    def test_invalid(self):
+        for options in [{'lv_placement': 'random'}, {'vg_map': 'hdd'}, {'vg_map': ':ssd'},
+                        {'lv_stripes': 'two'}, {'lv_stripe_min_size': 'big'}]:
+            self.assertRaises(ValueError, allocation.options, self.config(**options), 'DEFAULT')
+
+
+class PlaceTestCase(unittest.TestCase):
+    def setUp(self):
+        # the source LV is on sda, vg0 has PVs on three disks, vg1 on two others
+        self.pvs = [
+            PV('/dev/sda1', 'vg0', 100 * GiB, 50 * GiB),
+            PV('/dev/sdb1', 'vg0', 100 * GiB, 20 * GiB),
+            PV('/dev/sdc1', 'vg0', 100 * GiB, 40 * GiB),
+            PV('/dev/sdd1', 'vg1', 100 * GiB, 100 * GiB),
+            PV('/dev/md0', 'vg1', 100 * GiB, 100 * GiB),
+        ]
+        self.pv_devices = {
+            '/dev/sda1': frozenset(['sda']),
+            '/dev/sdb1': frozenset(['sdb']),
+            '/dev/sdc1': frozenset(['sdc']),
+            '/dev/sdd1': frozenset(['sdd']),
+            '/dev/md0': frozenset(['sde', 'sdf']),
+        }
+        self.source = frozenset(['sda'])
+
+    def place(self, size, usage=None, **kwargs):
+        return allocation.place('vg0', size, self.source, self.pvs, self.pv_devices,
+                                {} if usage is None else usage, **kwargs)
+
+    def test_other_disk(self):
+        """The PV with the most free space on another disk than the source wins."""
+        self.assertEqual(self.place(10 * GiB),
+                         allocation.Allocation('vg0', ['/dev/sdc1'], None, frozenset(['sdc'])))
+
+    def test_usage(self):
+        """Disks used by other clones are avoided, the reservation is added to the usage."""
+        usage = {'sdc': 1}
+        self.assertEqual(self.place(10 * GiB, usage).pvs, ['/dev/sdb1'])
+        self.assertEqual(usage, {'sda': 1, 'sdb': 1, 'sdc': 1})
+
+    def test_free_space(self):
+        """The free space of the chosen PV is reduced, so the next LV goes elsewhere."""
+        self.assertEqual(self.place(30 * GiB).pvs, ['/dev/sdc1'])
+        self.assertEqual(self.pvs[2].free, 10 * GiB)
+        self.assertEqual(self.place(30 * GiB).pvs, ['/dev/sda1'])  # only one with enough space
+
+    def test_lvm(self):
+        """Without a PV that is large enough, LVM decides."""
+        self.assertEqual(self.place(60 * GiB),
+                         allocation.Allocation('vg0', None, None, frozenset()))
+
+    def test_vg_map(self):
+        result = self.place(10 * GiB, vg_map={'vg0': ['vg1']})
+        self.assertEqual(result.vg, 'vg1')
+        self.assertEqual(result.pvs, ['/dev/sdd1'])
+
+    def test_stripes(self):
+        result = self.place(20 * GiB, vg_map={'vg0': ['vg1']}, stripe_min_size=10 * GiB)
+        self.assertEqual(result, allocation.Allocation(
+            'vg1', ['/dev/sdd1', '/dev/md0'], 2, frozenset(['sdd', 'sde', 'sdf'])))
+        self.assertEqual([pv.free for pv in self.pvs[3:]], [90 * GiB, 90 * GiB])
+
+    def test_stripes_small(self):
+        """LVs below the minimum size and LVs that don't fit on enough disks are not striped."""
+        self.assertIsNone(self.place(5 * GiB, stripe_min_size=10 * GiB).stripes)
+        self.assertIsNone(self.place(40 * GiB, stripe_min_size=10 * GiB, stripes=3).stripes)
+
+
+class RegistryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.registry = allocation.Registry(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_reserve(self):
+        with self.registry.locked():
+            self.registry.reserve('a', ['sda', 'sdb'])
+            self.registry.reserve('b', ['sdb'])
+        self.assertEqual(self.registry.load(), {'sda': 1, 'sdb': 2})
+
+        with allocation.Reservation(self.registry, 'a'):
+            pass
+        self.assertEqual(self.registry.load(), {'sdb': 1})
+
+    def test_stale(self):
+        """Entries of processes that no longer exist are removed."""
+        stale = os.path.join(self.path, 'crashed.json')
+        with open(stale, 'w') as stream:
+            json.dump({'pid': 2 ** 31 - 1, 'devices': ['sda']}, stream)
+        self.assertEqual(self.registry.load(), {})
+        self.assertFalse(os.path.exists(stale))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+import unittest
+
+from util import ca
+from util import config as configuration
+
+KEY = ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes']
+
+
+def openssl(*args, **kwargs):
+    return subprocess.run(('openssl', ) + args, check=True, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, **kwargs).stdout.decode('utf-8')
+
+
+def wait_for(condition, timeout=5):
+    end = time.time() + timeout
+    while not condition():
+        if time.time() > end:
+            raise AssertionError('Timed out.')
+        time.sleep(0.01)
+
+
+class CaTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = configuration.load(os.devnull)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+
+class BackendTestCase(CaTestCase):
+    def test_backend(self):
+        self.assertIsInstance(ca.backend(self.config, 'DEFAULT'), ca.InteractiveBackend)
+        self.config['DEFAULT'].update({'ca_backend': 'dropdir', 'ca_dropdir': self.directory})
+        self.assertIsInstance(ca.backend(self.config, 'DEFAULT'), ca.DropDirBackend)
+
+    def test_invalid(self):
+        self.config['DEFAULT']['ca_backend'] = 'email'
+        self.assertRaises(ValueError, ca.backend, self.config, 'DEFAULT')
+        self.config['DEFAULT']['ca_backend'] = 'local'
+        self.assertRaises(ValueError, ca.backend, self.config, 'DEFAULT')
+
+    def test_timeout(self):
+        self.assertIsNone(ca.timeout(self.config, 'DEFAULT'))
+        self.config['DEFAULT']['ca_timeout'] = '1.5'
+        self.assertEqual(ca.timeout(self.config, 'DEFAULT'), 1.5)
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is not installed')
+class LocalBackendTestCase(CaTestCase):
+    def test_sign(self):
+        openssl('req', '-x509', *KEY, '-subj', '/CN=Test CA', '-days', '1',
+                '-keyout', self.path('ca.key'), '-out', self.path('ca.pem'))
+        csr = openssl('req', '-new', *KEY, '-subj', '/CN=example.local',
+                      '-keyout', self.path('example.key'))
+        self.config['DEFAULT'].update({'ca_backend': 'local', 'ca_key': self.path('ca.key'),
+                                       'ca_cert': self.path('ca.pem')})
+
+        future = ca.submit(ca.backend(self.config, 'DEFAULT'), 'example', csr)
+        cert = ca.result(future, timeout=30)
+        self.assertIn(ca.END_MARKER, cert)
+
+        with open(self.path('example.pem'), 'w') as stream:
+            stream.write(cert)
+        openssl('verify', '-CAfile', self.path('ca.pem'), self.path('example.pem'))
+        self.assertIn('DNS:example.local', openssl('x509', '-noout', '-text', '-in',
+                                                   self.path('example.pem')))
+
+
+class DropDirBackendTestCase(CaTestCase):
+    def setUp(self):
+        super(DropDirBackendTestCase, self).setUp()
+        self.poll_interval = ca.POLL_INTERVAL
+        ca.POLL_INTERVAL = 0.01
+        self.config['DEFAULT'].update({'ca_backend': 'dropdir', 'ca_dropdir': self.directory})
+        self.backend = ca.backend(self.config, 'DEFAULT')
+        self.csr = self.path('example.local.csr')
+        self.pem = self.path('example.local.pem')
+
+    def tearDown(self):
+        ca.POLL_INTERVAL = self.poll_interval
+        super(DropDirBackendTestCase, self).tearDown()
+
+    def test_sign(self):
+        future = ca.submit(self.backend, 'example', 'CSR\n')
+        wait_for(lambda: os.path.exists(self.csr))
+        with open(self.csr) as stream:
+            self.assertEqual(stream.read(), 'CSR\n')
+
+        # an incomplete certificate is not picked up
+        with open(self.pem, 'w') as stream:
+            stream.write('-----BEGIN CERTIFICATE-----\n')
+        time.sleep(0.1)
+        self.assertFalse(future.done())
+
+        with open(self.pem + '.tmp', 'w') as stream:
+            stream.write('-----BEGIN CERTIFICATE-----\n%s\n' % ca.END_MARKER)
+        os.rename(self.pem + '.tmp', self.pem)
+        self.assertEqual(ca.result(future, timeout=5),
+                         '-----BEGIN CERTIFICATE-----\n%s\n' % ca.END_MARKER)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_cancel(self):
+        """After a timeout, the backend stops polling and removes the CSR."""
+        future = ca.submit(self.backend, 'example', 'CSR\n')
+        wait_for(lambda: os.path.exists(self.csr))
+        self.assertIsNone(ca.result(future, timeout=0.05))
+        self.assertTrue(future.cancelled())
+        wait_for(lambda: not os.path.exists(self.csr))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from util import estimate
+from util import metrics
+from util import trace
+
+MiB = 1024 * 1024
+
+
+class EstimateTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db = os.path.join(self.directory, 'metrics.sqlite')
+        del trace.spans[:]
+
+    def tearDown(self):
+        del trace.spans[:]
+        shutil.rmtree(self.directory)
+
+    def run_clone(self):
+        """Record the spans of a (very fast) clone."""
+        with trace.span('open', cat='libvirt'):
+            pass
+        with trace.span('preflight'):
+            pass
+        with trace.span('copy disks'):
+            with trace.span('copy root', cat='copy', bytes=64 * MiB, allocated=None,
+                            source='/dev/vg0/template', target='/dev/vg0/clone'):
+                pass
+        with trace.span('customize'):
+            with trace.span('prepare_sshd', cat='step'):
+                pass
+
+    def report(self, template='template'):
+        stream = io.StringIO()
+        estimate.report(self.db, template, stream=stream)
+        return stream.getvalue()
+
+    def test_no_history(self):
+        self.assertEqual(estimate.history(self.db, 'template'), (None, None, {}))
+
+    def test_history(self):
+        self.run_clone()
+        metrics.record(self.db, 'template', 'clone', 'ok')
+        throughput, apt_bytes, phases = estimate.history(self.db, 'template')
+        self.assertGreater(throughput, 0)
+        self.assertEqual(apt_bytes, 0)
+        self.assertEqual(sorted(phases), ['copy disks', 'customize', 'preflight', 'total'])
+
+    def test_report(self):
+        self.run_clone()
+        metrics.record(self.db, 'template', 'clone', 'ok')
+        output = self.report()
+        self.assertIn('copy /dev/vg0/template -> /dev/vg0/clone: 64.0 MiB', output)
+        self.assertIn('keys to generate: 2', output)
+        self.assertNotIn('open', output)  # not a phase
+        self.assertNotIn('incomplete', output)
+
+    def test_report_incomplete(self):
+        """Phases without history of the template make the prediction incomplete."""
+        self.run_clone()
+        metrics.record(self.db, 'template', 'clone', 'ok')
+        output = self.report('other')
+        self.assertIn('apt download: unknown (no previous runs of other)', output)
+        self.assertIn('(incomplete, no history)', output)
+
+
+if __name__ == '__main__':
+    unittest.main()
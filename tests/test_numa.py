@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+import os
+import unittest
+
+from collections import namedtuple
+from xml.etree import ElementTree
+
+from util import numa
+
+# two nodes with four cores with two hyperthreads each and 64 GiB of memory
+CAPABILITIES = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'bench',
+                            'capabilities.xml')
+GiB = 1024 ** 3
+
+
+class Domain(namedtuple('domain', ['vcpus', 'kib', 'cpusets', 'nodeset'])):
+    """Stands in for a LibVirtDomain, only the pinning is used."""
+
+    def getPinning(self):
+        return self
+
+
+class CpusetTestCase(unittest.TestCase):
+    def test_parse(self):
+        self.assertEqual(numa.parse_cpuset('0-3,^2,8'), {0, 1, 3, 8})
+        self.assertEqual(numa.parse_cpuset('5'), {5})
+
+    def test_format(self):
+        self.assertEqual(numa.format_cpuset([8, 0, 1, 2, 5, 6]), '0-2,5-6,8')
+        self.assertEqual(numa.format_cpuset(numa.parse_cpuset('0-3,^2,8')), '0-1,3,8')
+
+
+class PlaceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.nodes = numa.topology(ElementTree.parse(CAPABILITIES).getroot())
+        # a domain pinned to the first core of node 0, so node 1 is the least loaded one
+        self.domains = [Domain(2, 4 * 1024 * 1024, ['0', '8'], '0')]
+
+    def test_topology(self):
+        self.assertEqual([node.id for node in self.nodes], [0, 1])
+        self.assertEqual([node.memory for node in self.nodes], [64 * GiB, 64 * GiB])
+        self.assertEqual(sorted(cpu.id for cpu in self.nodes[1].cpus),
+                         list(range(4, 8)) + list(range(12, 16)))
+        self.assertEqual(self.nodes[0].cpus[0].core, frozenset([0, 8]))
+
+    def test_siblings(self):
+        """An even number of vCPUs gets whole cores, hyperthreads next to each other."""
+        placement = numa.place(self.nodes, self.domains, 4, 4 * GiB)
+        self.assertEqual(placement, numa.Placement(1, [4, 12, 5, 13], 2, 2))
+
+    def test_odd(self):
+        """vCPUs that can't be split into cores get one thread of the least loaded cores."""
+        placement = numa.place(self.nodes, self.domains, 3, 4 * GiB)
+        self.assertEqual(placement, numa.Placement(1, [4, 5, 6], 3, 1))
+
+    def test_load(self):
+        """Unpinned domains count for all CPUs and nodes."""
+        cpu_load, memory = numa.load(self.nodes, [Domain(16, 16 * 1024 * 1024, [None] * 16,
+                                                         None)])
+        self.assertEqual(set(cpu_load.values()), {1.0})
+        self.assertEqual(memory, {0: 8 * GiB, 1: 8 * GiB})
+
+    def test_memory(self):
+        """Nodes without enough free memory are skipped."""
+        domains = [Domain(1, 62 * 1024 * 1024, ['4'], '1')]
+        self.assertEqual(numa.place(self.nodes, domains, 2, 4 * GiB).node, 0)
+
+    def test_too_large(self):
+        self.assertIsNone(numa.place(self.nodes, self.domains, 16, 4 * GiB))
+        self.assertIsNone(numa.place(self.nodes, self.domains, 2, 65 * GiB))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import unittest
+
+from util import placement
+
+GiB = 1024 ** 3
+
+
+def host(memory=64, committed_memory=0, cpus=16, committed_cpus=0, storage=None,
+         has_template=True):
+    return {'memory': memory * GiB, 'committed_memory': committed_memory * GiB, 'cpus': cpus,
+            'committed_cpus': committed_cpus, 'storage': storage, 'has_template': has_template}
+
+
+class ScoreTestCase(unittest.TestCase):
+    def test_memory(self):
+        self.assertEqual(placement.score(host(committed_memory=63), 2 * GiB, 1, None),
+                         (0, 'not enough memory'))
+        idle, reason = placement.score(host(), GiB, 1, None)
+        busy, reason = placement.score(host(committed_memory=32), GiB, 1, None)
+        self.assertIsNone(reason)
+        self.assertGreater(idle, busy)
+
+    def test_storage(self):
+        storage = {'capacity': 100 * GiB, 'allocation': 90 * GiB, 'available': 10 * GiB}
+        self.assertEqual(placement.score(host(storage=storage), GiB, 1, 20 * GiB),
+                         (0, 'not enough storage'))
+        full, reason = placement.score(host(storage=storage), GiB, 1, 5 * GiB)
+        self.assertIsNone(reason)
+        empty, reason = placement.score(host(storage=dict(storage, available=90 * GiB)), GiB, 1,
+                                        5 * GiB)
+        self.assertGreater(empty, full)
+
+    def test_cpus(self):
+        idle, reason = placement.score(host(), GiB, 4, None)
+        busy, reason = placement.score(host(committed_cpus=32), GiB, 4, None)
+        overcommitted, reason = placement.score(host(committed_cpus=100), GiB, 4, None)
+        self.assertGreater(idle, busy)
+        self.assertGreater(busy, overcommitted)
+        self.assertIsNone(reason)  # overcommitting CPUs is not an error
+
+    def test_template(self):
+        """Hosts without the template can only take the clone if it can be transferred."""
+        self.assertEqual(placement.score(host(has_template=False), GiB, 1, None),
+                         (0, 'template missing'))
+        without, reason = placement.score(host(has_template=False), GiB, 1, None, transfer=True)
+        self.assertIsNone(reason)
+        present, reason = placement.score(host(), GiB, 1, None, transfer=True)
+        self.assertAlmostEqual(present - without, placement.WEIGHT_TEMPLATE)
+
+
+class Pool(object):
+    """Stands in for a LibVirtConnectionPool, the stats of every host are given directly."""
+
+    def __init__(self, hosts):
+        self.uris = list(hosts)
+        self.hosts = hosts
+        self.connections = [None] * len(hosts)
+        self.errors = {uri: 'unreachable' for uri, data in hosts.items() if data is None}
+
+    def map(self, func):
+        return [self.hosts[uri] for uri in self.uris]
+
+
+class RankTestCase(unittest.TestCase):
+    def test_rank(self):
+        pool = Pool({
+            'test:///full': host(committed_memory=64),
+            'test:///busy': host(committed_memory=32),
+            'test:///down': None,
+            'test:///idle': host(),
+            'test:///empty': host(has_template=False),
+        })
+        ranking = placement.rank(pool, 'template', GiB, 1)
+        self.assertEqual([h.uri for h in ranking], ['test:///idle', 'test:///busy',
+                                                    'test:///full', 'test:///down',
+                                                    'test:///empty'])
+        self.assertEqual(ranking[2].reason, 'not enough memory')
+        self.assertEqual(ranking[3].reason, 'unreachable: unreachable')
+        self.assertEqual(ranking[4].reason, 'template missing')
+
+        # with transfer-from, the host without the template can take it, but with less points
+        ranking = placement.rank(pool, 'template', GiB, 1, transfer=True)
+        self.assertEqual([h.uri for h in ranking][:3],
+                         ['test:///idle', 'test:///busy', 'test:///empty'])
+        self.assertIsNone(ranking[2].reason)
+
+
+class LocalTestCase(unittest.TestCase):
+    def test_is_local(self):
+        self.assertTrue(placement.is_local(None))
+        self.assertTrue(placement.is_local('qemu:///system'))
+        self.assertTrue(placement.is_local('test:///path/to/host1.xml'))
+        self.assertTrue(placement.is_local('qemu+ssh://localhost/system'))
+        self.assertFalse(placement.is_local('qemu+ssh://root@other/system'))
+        self.assertTrue(placement.is_local('qemu+ssh://root@this/system',
+                                           'qemu+ssh://this/system'))
+        self.assertFalse(placement.is_local('qemu+ssh://other/system', 'qemu+ssh://this/system'))
+
+    def test_remote_command(self):
+        command = placement.remote_command('ssh {host} bin/virsh-create',
+                                           'qemu+ssh://root@other/system',
+                                           ['--desc', 'a b', 'name', '42'])
+        self.assertEqual(command, ['ssh', 'root@other', 'bin/virsh-create', '--desc', "'a b'",
+                                   'name', '42'])
+
+
+if __name__ == '__main__':
+    unittest.main()
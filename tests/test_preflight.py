@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import argparse
+import os
+import unittest
+
+from util import config as configuration
+from util import preflight
+from util.lvm import LV
+
+CONFIG = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'virsh-create.conf.example')
+GiB = 1024 ** 3
+
+
+def args(**kwargs):
+    values = {'section': 'DEFAULT', 'name': 'new', 'cpus': 1, 'numa': False, 'update_cert': True}
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+
+def lv(vg, name, size):
+    return LV(name, vg, '-wi-a-----', '%sB' % size, '', '', '', '', '', '', '', '')
+
+
+class ConfigureTestCase(unittest.TestCase):
+    def setUp(self):
+        self.config = configuration.for_guest(configuration.load(CONFIG), 'DEFAULT', 42)
+
+    def test_valid(self):
+        plan = preflight.configure(args(), self.config)
+        self.assertEqual(plan.problems, [])
+        self.assertEqual(plan.vnc_port, 5942)
+        self.assertEqual(plan.macs, ['00:53:00:10:00:42', '00:53:FF:10:01:42'])
+        self.assertEqual(plan.ips, ['198.51.100.42', '2001:db8:a::1:42', '192.0.2.42',
+                                    '2001:db8:b::42'])
+
+    def test_all_problems(self):
+        """All problems are reported at once, not just the first one."""
+        self.config['DEFAULT'].update({
+            'vnc_port': '70000',
+            'public_mac': '00:53:00:10:00',
+            'priv_ip4': '192.0.2.300',
+            'scrub_rules': 'shred etc/shadow',
+            'file_clone': 'hardlink',
+            'profile': 'missing',
+            'lv_placement': 'random',
+            'ca_backend': 'local',
+        })
+        plan = preflight.configure(args(), self.config)
+        self.assertEqual(plan.problems, [
+            'VNC port 70000 out of range.',
+            'Invalid MAC address: 00:53:00:10:00',
+            'Invalid IP address: 192.0.2.300',
+            'Invalid scrub rule: shred etc/shadow',
+            'file_clone must be one of overlay, copy.',
+            'Profile missing: No section [profile:missing] in the config file.',
+            'lv_placement must be one of spread, lvm.',
+            'CA backend local requires ca_key, ca_cert.',
+        ])
+
+    def test_missing(self):
+        del self.config['DEFAULT']['vnc_port']
+        self.config['DEFAULT']['public_ip4'] = '%(unknown)s'
+        plan = preflight.configure(args(), self.config)
+        self.assertEqual(plan.problems, ['public_ip4: Unknown option unknown.',
+                                         'Option vnc_port is missing.'])
+
+
+class ConflictsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plan = preflight.Plan('new')
+        self.plan.vnc_port = 5942
+        self.plan.macs = ['00:53:00:10:00:42', '00:53:ff:10:01:42']
+        self.plan.ips = ['198.51.100.42', '2001:db8:b::42']
+
+    def test_none(self):
+        inventory = [('other', 5943, ['00:53:00:10:00:43'], ['198.51.100.43'])]
+        self.assertEqual(preflight.conflicts(self.plan, inventory), [])
+
+    def test_name(self):
+        inventory = [('new', None, [], [])]
+        self.assertEqual(preflight.conflicts(self.plan, inventory),
+                         ['Domain new already defined.'])
+
+    def test_id(self):
+        """A domain with the same id has the same VNC port, MACs and IPs."""
+        inventory = [('old', 5942, ['00:53:FF:10:01:42'], ['2001:db8:b::42'])]
+        self.assertEqual(preflight.conflicts(self.plan, inventory), [
+            'VNC port 5942 already used by old.',
+            'MAC address 00:53:ff:10:01:42 already used by old.',
+            'IP address 2001:db8:b::42 already used by old.',
+        ])
+
+
+class StorageTestCase(unittest.TestCase):
+    def setUp(self):
+        self.plan = preflight.Plan('new')
+        self.plan.disks = [
+            preflight.Disk('block', '/dev/vg0/template', None, 'vg0', 'new', '/dev/vg0/new',
+                           10 * GiB, 'raw'),
+            preflight.Disk('block', '/dev/vg1/template-data', None, 'vg1', 'new-data',
+                           '/dev/vg1/new-data', 20 * GiB, 'raw'),
+            preflight.Disk('file', '/srv/template.qcow2', None, None, 'new.qcow2',
+                           '/srv/new.qcow2', 30 * GiB, 'qcow2'),
+        ]
+
+    def test_ok(self):
+        lvs = [lv('vg0', 'template', 10 * GiB), lv('vg1', 'template-data', 20 * GiB)]
+        self.assertEqual(preflight.storage_problems(self.plan, lvs, {'vg0': 50 * GiB,
+                                                                     'vg1': 50 * GiB}), [])
+
+    def test_problems(self):
+        lvs = [lv('vg0', 'new', 10 * GiB)]
+        self.assertEqual(preflight.storage_problems(self.plan, lvs, {'vg0': 5 * GiB}), [
+            'LV new in VG vg0 is already defined.',
+            'VG vg0 has only %s bytes free, but %s are needed.' % (5 * GiB, 10 * GiB),
+            'VG vg1 does not exist.',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import configparser
+import unittest
+
+from lxml import etree
+
+from libvirtpy.domain import LibVirtDomainXML
+from util import config as configuration
+from util import profile
+
+XML = '''<domain type="kvm">
+  <name>template</name>
+  <devices>
+    <disk type="block" device="disk">
+      <driver name="qemu" type="raw"/>
+      <source dev="/dev/vg0/template"/>
+      <target dev="vda" bus="virtio"/>
+    </disk>
+    <disk type="block" device="disk">
+      <source dev="/dev/vg0/template-data"/>
+      <target dev="vdb" bus="virtio"/>
+    </disk>
+    <interface type="bridge">
+      <source bridge="br0"/>
+      <model type="virtio"/>
+    </interface>
+    <memballoon model="virtio">
+      <stats period="5"/>
+    </memballoon>
+  </devices>
+</domain>'''
+
+
+def config(**options):
+    parser = configparser.ConfigParser(defaults=configuration.DEFAULTS)
+    parser.read_dict({'DEFAULT': {'profile': 'test'}, 'profile:test': options})
+    return parser
+
+
+def load(cpus=8, **options):
+    return profile.load(config(**options), 'DEFAULT', cpus)
+
+
+class CountTestCase(unittest.TestCase):
+    def test_count(self):
+        self.assertEqual(profile.count('3', 8), 3)
+        self.assertEqual(profile.count('cpus', 8), 8)
+        self.assertEqual(profile.count('cpus/4', 8), 2)
+        self.assertEqual(profile.count('cpus/4', 2), 1)
+        self.assertEqual(profile.count('0', 8), 0)
+
+    def test_invalid(self):
+        for value in ['-1', 'cpus/0', 'cpus/-2', 'cpus/x', 'many']:
+            with self.subTest(value=value), self.assertRaises(ValueError):
+                profile.count(value, 8)
+        with self.assertRaises(ValueError):
+            profile.count('0', 8, minimum=1)
+
+
+class LoadTestCase(unittest.TestCase):
+    def test_no_profile(self):
+        parser = configparser.ConfigParser(defaults=configuration.DEFAULTS)
+        self.assertIsNone(profile.load(parser, 'DEFAULT', 8))
+
+    def test_missing_section(self):
+        parser = config()
+        parser.remove_section('profile:test')
+        with self.assertRaisesRegex(ValueError, r'No section \[profile:test\]'):
+            profile.load(parser, 'DEFAULT', 8)
+
+    def test_load(self):
+        prof = load(disk_cache='none', disk_io='native', iothreads='cpus/4', net_queues='cpus',
+                    hugepages_min_mem='16', memballoon='virtio', memballoon_period='10')
+        self.assertEqual(prof.name, 'test')
+        self.assertEqual(prof.disk_cache, 'none')
+        self.assertEqual(prof.disk_io, 'native')
+        self.assertIsNone(prof.disk_discard)
+        self.assertEqual(prof.iothreads, 2)
+        self.assertEqual(prof.net_queues, 8)
+        self.assertEqual(prof.hugepages_min_mem, 16.0)
+        self.assertEqual(prof.memballoon, 'virtio')
+        self.assertEqual(prof.memballoon_period, 10)
+
+    def test_choices(self):
+        with self.assertRaisesRegex(ValueError, 'disk_cache must be one of'):
+            load(disk_cache='fast')
+
+    def test_native(self):
+        with self.assertRaisesRegex(ValueError, 'disk_io = native requires'):
+            load(disk_io='native')
+        self.assertEqual(load(disk_io='native', disk_cache='directsync').disk_io, 'native')
+
+    def test_counts(self):
+        self.assertEqual(load(iothreads='0').iothreads, 0)
+        self.assertEqual(load(cpus=512, net_queues='cpus').net_queues, profile.MAX_QUEUES)
+        for option, value in [('iothreads', '-1'), ('iothreads', 'cpus/0'), ('net_queues', '0'),
+                              ('hugepages_min_mem', '-4'), ('memballoon_period', '-1'),
+                              ('memballoon_period', 'often')]:
+            with self.subTest(option=option, value=value):
+                with self.assertRaisesRegex(ValueError, 'Invalid %s: %s' % (option, value)):
+                    load(**{option: value})
+
+
+class ApplyTestCase(unittest.TestCase):
+    def setUp(self):
+        self.domain = LibVirtDomainXML(etree.fromstring(XML))
+
+    def apply(self, mem=8, **options):
+        profile.apply(self.domain, load(**options), mem)
+        return self.domain.xml
+
+    def test_empty(self):
+        self.assertEqual(etree.tostring(self.apply()), etree.tostring(etree.fromstring(XML)))
+
+    def test_disks(self):
+        xml = self.apply(disk_cache='none', disk_io='native', disk_discard='unmap',
+                         iothreads='cpus/4')
+        self.assertEqual(xml.find('iothreads').text, '2')
+        drivers = [d.find('driver') for d in xml.findall('devices/disk')]
+        self.assertEqual([d.get('cache') for d in drivers], ['none', 'none'])
+        self.assertEqual([d.get('io') for d in drivers], ['native', 'native'])
+        self.assertEqual([d.get('discard') for d in drivers], ['unmap', 'unmap'])
+        self.assertEqual([d.get('iothread') for d in drivers], ['1', '2'])
+        self.assertEqual(drivers[0].get('type'), 'raw')
+
+    def test_no_iothreads(self):
+        self.apply(iothreads='2')
+        xml = self.apply(iothreads='0')
+        self.assertIsNone(xml.find('iothreads'))
+        self.assertEqual([d.find('driver').get('iothread') for d in xml.findall('devices/disk')],
+                         [None, None])
+
+    def test_net_queues(self):
+        xml = self.apply(net_queues='cpus/2')
+        self.assertEqual(xml.find('devices/interface/driver').get('queues'), '4')
+        xml = self.apply(net_queues='1')
+        self.assertIsNone(xml.find('devices/interface/driver').get('queues'))
+
+    def test_hugepages(self):
+        self.assertIsNone(self.apply(mem=8, hugepages_min_mem='16').find('memoryBacking'))
+        xml = self.apply(mem=16, hugepages_min_mem='16')
+        self.assertIsNotNone(xml.find('memoryBacking/hugepages'))
+
+    def test_memballoon(self):
+        xml = self.apply(memballoon='virtio', memballoon_period='10')
+        self.assertEqual([s.get('period') for s in xml.findall('devices/memballoon/stats')],
+                         ['10'])
+        xml = self.apply(memballoon='none')
+        self.assertEqual(xml.find('devices/memballoon').get('model'), 'none')
+        self.assertEqual(len(xml.find('devices/memballoon')), 0)
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from util import scrub
+
+RULES = '''
+# comments and empty lines are ignored
+
+delete home/*/.bash_history
+truncate var/log/**/*.log
+regenerate etc/machine-id
+delete **/.cache
+exclude home/keep
+'''
+
+
+class ParseTestCase(unittest.TestCase):
+    def test_parse(self):
+        rules = scrub.parse(RULES)
+        self.assertEqual([r.action for r in rules],
+                         ['delete', 'truncate', 'regenerate', 'delete', 'exclude'])
+        self.assertEqual(rules[0].parts, ['home', '*', '.bash_history'])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, scrub.parse, 'remove etc/shadow')
+        self.assertRaises(ValueError, scrub.parse, 'delete /')
+
+    def test_prefix(self):
+        self.assertEqual([scrub.prefix(r) for r in scrub.parse(RULES)],
+                         ['home', 'var/log', 'etc/machine-id', '', 'home/keep'])
+
+
+class MatchTestCase(unittest.TestCase):
+    def test_match(self):
+        parts = ['home', '*', '.bash_history']
+        self.assertTrue(scrub.match(parts, ['home', 'alice', '.bash_history']))
+        self.assertFalse(scrub.match(parts, ['home', 'alice']))
+        self.assertFalse(scrub.match(parts, ['home', 'alice', 'x', '.bash_history']))
+
+    def test_recursive(self):
+        parts = ['var', 'log', '**', '*.log']
+        self.assertTrue(scrub.match(parts, ['var', 'log', 'syslog.log']))
+        self.assertTrue(scrub.match(parts, ['var', 'log', 'apt', 'deep', 'term.log']))
+        self.assertFalse(scrub.match(parts, ['var', 'log', 'apt', 'term.txt']))
+        self.assertTrue(scrub.match(['**', '.cache'], ['.cache']))
+        self.assertTrue(scrub.match(['**', '.cache'], ['home', 'alice', '.cache']))
+
+    def test_below(self):
+        parts = ['home', '*', '.bash_history']
+        self.assertTrue(scrub.below(parts, []))
+        self.assertTrue(scrub.below(parts, ['home']))
+        self.assertTrue(scrub.below(parts, ['home', 'alice']))
+        self.assertFalse(scrub.below(parts, ['var']))
+        self.assertFalse(scrub.below(parts, ['home', 'alice', '.bash_history']))
+        self.assertTrue(scrub.below(['**', '.cache'], ['usr', 'share']))
+
+
+class ScrubTestCase(unittest.TestCase):
+    files = {
+        'home/alice/.bash_history': 'ls\n',
+        'home/alice/.cache/thumbnails/a.png': 'png',
+        'home/keep/.bash_history': 'keep\n',
+        'var/log/syslog.log': 'log\n',
+        'var/log/apt/term.log': 'log\n',
+        'var/log/apt/term.txt': 'txt\n',
+        'etc/machine-id': '0123\n',
+    }
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for path, content in self.files.items():
+            path = os.path.join(self.root, path)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as stream:
+                stream.write(content)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def read(self, path):
+        with open(os.path.join(self.root, path)) as stream:
+            return stream.read()
+
+    def test_scrub(self):
+        report = scrub.scrub(self.root, scrub.parse(RULES))
+        self.assertEqual(sorted(r.path for r in report), [
+            '/etc/machine-id', '/home/alice/.bash_history', '/home/alice/.cache',
+            '/var/log/apt/term.log', '/var/log/syslog.log'])
+
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'home/alice/.bash_history')))
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'home/alice/.cache')))
+        self.assertEqual(self.read('home/keep/.bash_history'), 'keep\n')
+        self.assertEqual(self.read('var/log/apt/term.log'), '')
+        self.assertEqual(self.read('var/log/apt/term.txt'), 'txt\n')
+        self.assertNotEqual(self.read('etc/machine-id'), '0123\n')
+
+    def test_missing_root(self):
+        self.assertEqual(scrub.scrub(os.path.join(self.root, 'missing'), []), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
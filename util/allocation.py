@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Choose the physical volumes for the LVs of a clone.
+
+With ``lv_placement = spread`` (the default), a new LV is put on a PV that is on a different disk
+than its source, so the copy doesn't read and write the same device. The VG is the one of the
+source or, if it is mapped in ``vg_map``, one of the VGs it is mapped to. Of the suitable PVs, the
+one on the disks used by the fewest running clones wins, then the one with the most free space.
+LVs of at least ``lv_stripe_min_size`` GiB are striped over ``lv_stripes`` PVs on different disks.
+
+Running clones register the disks they use in the ``placement_registry`` directory, one file per
+clone, so concurrent clones (from a batch or from the daemon) are spread over the available
+devices.
+"""
+
+import fcntl
+import json
+import logging
+import os
+
+from collections import namedtuple
+from contextlib import contextmanager
+
+from util import lvm
+from util import settings
+from util import throttle
+
+log = logging.getLogger(__name__)
+
+MODES = ('spread', 'lvm')
+EXTENT_SIZE = 4 * 1024 * 1024  # default extent size, LVM rounds every stripe up to whole extents
+
+Allocation = namedtuple('allocation', ['vg', 'pvs', 'stripes', 'devices'])
+
+
+def parse_vg_map(value):
+    """Parse ``vg_map`` (``SRC:DST[,DST...]`` separated by whitespace), raises ``ValueError``."""
+    vg_map = {}
+    for entry in value.split():
+        src, sep, dsts = entry.partition(':')
+        if not sep or not src or not dsts:
+            raise ValueError('Invalid vg_map entry: %s' % entry)
+        vg_map[src] = [d for d in dsts.split(',') if d]
+    return vg_map
+
+
+def options(config, section):
+    """Get placement mode, VG map, minimum size for striping and stripes from the config.
+
+    Raises ``ValueError`` if the configuration is invalid.
+    """
+    mode = config.get(section, 'lv_placement')
+    if mode not in MODES:
+        raise ValueError('lv_placement must be one of %s.' % ', '.join(MODES))
+    vg_map = parse_vg_map(config.get(section, 'vg_map'))
+    try:
+        stripe_min_size = config.get(section, 'lv_stripe_min_size')
+        stripe_min_size = float(stripe_min_size) * 1024 ** 3 if stripe_min_size else None
+        stripes = config.getint(section, 'lv_stripes')
+    except ValueError:
+        raise ValueError('lv_stripe_min_size and lv_stripes must be numbers.')
+    return mode, vg_map, stripe_min_size, stripes
+
+
+def devices(path):
+    """Get the names of the physical disks below the block device at ``path``."""
+    try:
+        return frozenset(throttle.physical_devices(throttle.device_name(path)))
+    except OSError:  # e.g. the device doesn't exist in a dry run
+        return frozenset([os.path.basename(path)])
+
+
+def lv_devices(path):
+    """Get the names of the physical disks below the PVs of the LV at ``path``."""
+    return frozenset(d for pv in lvm.devices(path) for d in devices(pv))
+
+
+class Registry(object):
+    """Disks used by running clones, shared by all processes on this host."""
+
+    def __init__(self, path):
+        self.path = path
+
+    @contextmanager
+    def locked(self):
+        """Hold an exclusive lock, so placements of concurrent clones don't overlap."""
+        if settings.DRY:  # only reads the registry
+            yield
+            return
+        os.makedirs(self.path, exist_ok=True)
+        with open(os.path.join(self.path, '.lock'), 'w') as stream:
+            fcntl.flock(stream, fcntl.LOCK_EX)
+            yield
+
+    def load(self):
+        """Get how many running clones use each disk."""
+        usage = {}
+        if not os.path.isdir(self.path):
+            return usage
+        for filename in os.listdir(self.path):
+            if not filename.endswith('.json'):
+                continue
+            path = os.path.join(self.path, filename)
+            try:
+                with open(path) as stream:
+                    data = json.load(stream)
+                os.kill(data['pid'], 0)
+            except ProcessLookupError:  # left behind by a clone that crashed
+                log.debug('Removing stale entry %s', path)
+                os.remove(path)
+                continue
+            except (OSError, ValueError, KeyError):
+                continue
+            for device in data['devices']:
+                usage[device] = usage.get(device, 0) + 1
+        return usage
+
+    def reserve(self, name, devices):
+        if settings.DRY:
+            return
+        with open(os.path.join(self.path, '%s.json' % name), 'w') as stream:
+            json.dump({'pid': os.getpid(), 'devices': sorted(devices)}, stream)
+
+    def release(self, name):
+        if settings.DRY:
+            return
+        try:
+            os.remove(os.path.join(self.path, '%s.json' % name))
+        except FileNotFoundError:
+            pass
+
+
+class Reservation(object):
+    """The disks used by one clone, released when the ``with`` block is left."""
+
+    def __init__(self, registry=None, name=None):
+        self.registry = registry
+        self.name = name
+
+    def release(self):
+        if self.registry is not None:
+            self.registry.release(self.name)
+            self.registry = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def place(vg, size, source_devices, pvs, pv_devices, usage, vg_map=None, stripe_min_size=None,
+          stripes=2):
+    """Choose where to create an LV of ``size`` bytes that is a copy of an LV in ``vg``.
+
+    :param source_devices: Disks of the source LV.
+    :param pvs: All physical volumes, as returned by :py:func:`util.lvm.pvs`. The free space of
+        the chosen PVs is reduced in place.
+    :param pv_devices: Dict mapping PV names to their disks.
+    :param usage: Dict mapping disks to the number of clones using them, updated in place.
+    :return: An :py:class:`Allocation`, ``pvs`` is ``None`` if LVM should choose.
+    """
+    vgs = (vg_map or {}).get(vg, [vg])
+
+    def score(pv):
+        return (bool(pv_devices[pv.name] & source_devices),
+                sum(usage.get(d, 0) for d in pv_devices[pv.name]), -pv.free)
+
+    candidates = sorted([pv for pv in pvs if pv.vg in vgs], key=score)
+    chosen = None
+
+    if stripe_min_size is not None and stripes > 1 and size >= stripe_min_size:
+        stripe_size = -(-size // stripes) + EXTENT_SIZE
+        for target in vgs:
+            selected = []
+            used = set(source_devices)
+            for pv in [c for c in candidates if c.vg == target and c.free >= stripe_size]:
+                if not pv_devices[pv.name] & used:
+                    selected.append(pv)
+                    used |= pv_devices[pv.name]
+            if len(selected) >= stripes:
+                chosen = selected[:stripes]
+                break
+        else:
+            log.info('Not enough PVs on separate disks to stripe over %s PVs.', stripes)
+
+    if chosen is None:
+        fitting = [pv for pv in candidates if pv.free >= size + EXTENT_SIZE]
+        if not fitting:  # let LVM decide, preflight reports if the VG is too small
+            return Allocation(vgs[0], None, None, frozenset())
+        chosen = fitting[:1]
+        if pv_devices[chosen[0].name] & source_devices:
+            log.info('No PV with enough space on a different disk than the source, copy will '
+                     'read and write %s.', ', '.join(sorted(source_devices)))
+
+    disks = frozenset(d for pv in chosen for d in pv_devices[pv.name])
+    for device in disks | source_devices:
+        usage[device] = usage.get(device, 0) + 1
+    for pv in chosen:
+        pvs[pvs.index(pv)] = pv._replace(free=pv.free - -(-size // len(chosen)))
+    return Allocation(chosen[0].vg, [pv.name for pv in chosen],
+                      len(chosen) if len(chosen) > 1 else None, disks)
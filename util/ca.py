@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Get the TLS certificate of a clone signed.
+
+The ``ca_backend`` config option selects how:
+
+* ``interactive``: Print the CSR and read the certificate from stdin (the default).
+* ``local``: Sign with the CA key and certificate in ``ca_key`` and ``ca_cert``.
+* ``command``: Run ``ca_command`` with the CSR on stdin, it prints the certificate on stdout.
+* ``dropdir``: Write the CSR to ``ca_dropdir`` and wait for the CA host to put the certificate
+  next to it.
+
+Signing runs in a background thread (see :py:func:`submit`), so the clone is customized while
+the CSR waits for the CA. The interactive backend is only started once the guest is customized,
+since the commands doing that share stdin with it.
+"""
+
+import abc
+import logging
+import os
+import shlex
+import tempfile
+import threading
+import time
+import uuid
+
+from concurrent.futures import Future
+from concurrent.futures import InvalidStateError
+from concurrent.futures import TimeoutError
+
+from util import settings
+from util import trace
+from util.cli import ex
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 5  # seconds between two checks of the drop directory
+END_MARKER = '-----END CERTIFICATE-----'
+DAYS = 825  # validity of certificates signed by the local backend
+
+
+class Backend(abc.ABC):
+    interactive = False  # reads from stdin
+
+    def __init__(self, config, section):
+        self.config = config
+        self.section = section
+
+    @abc.abstractmethod
+    def sign(self, name, csr, cancelled):
+        """Return the certificate for ``csr`` (a PEM-encoded string) of host ``name``.
+
+        :param cancelled: Callable returning ``True`` once nobody waits for the certificate
+            anymore, backends that wait for the CA should then give up and return ``None``.
+        """
+
+
+class InteractiveBackend(Backend):
+    interactive = True
+
+    def sign(self, name, csr, cancelled):
+        sign = 'fsinf-ca sign_cert --alt=%s.local --watch=<your email>' % name
+        ca_serial = self.config.get(self.section, 'ca_serial')
+        if ca_serial:
+            sign += ' --ca=%s' % ca_serial
+
+        log.critical('On %s, do:' % self.config.get(self.section, 'ca_host'))
+        log.critical('\t%s' % sign)
+        log.critical('... and paste the CSR:\n%s' % csr)
+
+        cert = ''
+        line = ''
+        while line != END_MARKER:
+            line = input().strip()
+            cert += '%s\n' % line
+        return cert
+
+
+class LocalBackend(Backend):
+    """Sign with a local CA, useful for testing and for hosts that hold an intermediate CA."""
+
+    def sign(self, name, csr, cancelled):
+        with tempfile.NamedTemporaryFile('w', suffix='.cnf') as extfile:
+            extfile.write('subjectAltName = DNS:%s.local\n' % name)
+            extfile.flush()
+            stdout, stderr = ex([
+                'openssl', 'x509', '-req', '-sha256', '-days', str(DAYS),
+                '-CA', self.config.get(self.section, 'ca_cert'),
+                '-CAkey', self.config.get(self.section, 'ca_key'),
+                '-set_serial', '0x%s' % uuid.uuid4().hex, '-extfile', extfile.name,
+            ], input=csr.encode('utf-8'))
+        return stdout.decode('utf-8')
+
+
+class CommandBackend(Backend):
+    def sign(self, name, csr, cancelled):
+        command = self.config.get(self.section, 'ca_command').format(name=name)
+        stdout, stderr = ex(shlex.split(command), input=csr.encode('utf-8'))
+        return stdout.decode('utf-8')
+
+
+class DropDirBackend(Backend):
+    """Exchange files with the CA host via a shared directory.
+
+    The CA host should write the certificate to a temporary file and rename it, a certificate is
+    only read once it is complete (i.e. contains the ``END CERTIFICATE`` line) in any case.
+    """
+
+    def read(self, path):
+        try:
+            with open(path) as stream:
+                cert = stream.read()
+        except FileNotFoundError:
+            return None
+        return cert if END_MARKER in cert else None
+
+    def sign(self, name, csr, cancelled):
+        dropdir = self.config.get(self.section, 'ca_dropdir')
+        csr_path = os.path.join(dropdir, '%s.local.csr' % name)
+        pem_path = os.path.join(dropdir, '%s.local.pem' % name)
+
+        with open(csr_path, 'w') as stream:
+            stream.write(csr)
+        log.info('Waiting for %s', pem_path)
+        try:
+            cert = self.read(pem_path)
+            while cert is None:
+                if cancelled():
+                    log.info('Stop waiting for %s', pem_path)
+                    return None
+                time.sleep(POLL_INTERVAL)
+                cert = self.read(pem_path)
+            os.remove(pem_path)
+        finally:
+            os.remove(csr_path)
+        return cert
+
+
+BACKENDS = {
+    'interactive': InteractiveBackend,
+    'local': LocalBackend,
+    'command': CommandBackend,
+    'dropdir': DropDirBackend,
+}
+
+# config options that must be set for a backend
+REQUIRED = {
+    'local': ['ca_key', 'ca_cert'],
+    'command': ['ca_command'],
+    'dropdir': ['ca_dropdir'],
+}
+
+
+def backend(config, section):
+    """Get the configured backend, raises ``ValueError`` if it is misconfigured."""
+    name = config.get(section, 'ca_backend')
+    if name not in BACKENDS:
+        raise ValueError('Unknown CA backend: %s' % name)
+    missing = [key for key in REQUIRED.get(name, []) if not config.get(section, key)]
+    if missing:
+        raise ValueError('CA backend %s requires %s.' % (name, ', '.join(missing)))
+    return BACKENDS[name](config, section)
+
+
+def timeout(config, section):
+    value = config.get(section, 'ca_timeout')
+    return float(value) if value else None
+
+
+def submit(backend, name, csr):
+    """Start signing ``csr`` in the background, return a future for the certificate."""
+    future = Future()
+    if settings.DRY:
+        log.info('Signing CSR with the %s backend', type(backend).__name__)
+        future.set_result('')
+        return future
+
+    parent = trace.current()
+
+    def sign():
+        try:
+            with trace.span('sign', cat='step', parent=parent, backend=type(backend).__name__):
+                cert = backend.sign(name, csr, future.cancelled)
+            future.set_result(cert)
+        except InvalidStateError:  # cancelled by result()
+            pass
+        except BaseException as e:  # includes SystemExit if a command failed
+            if not future.cancelled():
+                future.set_exception(e)
+
+    # a daemon thread, so a backend waiting for a certificate that never comes doesn't keep the
+    # process alive
+    threading.Thread(target=sign, daemon=True, name='ca-%s' % name).start()
+    return future
+
+
+def result(future, timeout=None):
+    """Wait for a certificate from :py:func:`submit`, return ``None`` if it did not arrive.
+
+    On timeout the future is cancelled, so backends waiting for the CA stop doing so.
+    """
+    try:
+        return future.result(timeout)
+    except TimeoutError:
+        future.cancel()
+        return None
@@ -6,37 +6,56 @@ from subprocess import PIPE
 from subprocess import Popen
 
 from util import settings
+from util import trace
 
 log = logging.getLogger(__name__)
 
 
-def ex(cmd, quiet=False, ignore_errors=False, dry=False):
+def _in_cgroup(path, cmd):
+    """Wrap ``cmd`` in a shell that moves itself to the cgroup at ``path`` before running it.
+
+    This is not done in a ``preexec_fn``, which is unsafe in a process with threads.
+    """
+    return ['sh', '-c', 'echo $$ > "$0/cgroup.procs" && exec "$@"', path] + list(cmd)
+
+
+def ex(cmd, quiet=False, ignore_errors=False, dry=False, cgroup=None, input=None):
     """Execute a command
 
     :param dry: Execute even if --dry was specified
+    :param cgroup: Path of a cgroup to run the command in, defaults to the ``CGROUP`` setting.
+    :param input: Bytes passed to the command on stdin.
     """
+    cgroup = cgroup or settings.get('CGROUP')
     if not quiet:
         log.debug('- %s', ' '.join([c if c else '""' for c in cmd]))
 
-    if settings.DRY and not dry:
-        return '', ''
-    else:
-        p = Popen(cmd, stdout=PIPE, stderr=PIPE)
-        out, err = p.communicate()
-        status = p.returncode
-
-        if settings.SLEEP > 0:  # sleep for given number of seconds
-            log.debug('(Sleeping for %s seconds)' % settings.SLEEP)
-            time.sleep(settings.SLEEP)
-
-        if status != 0:
-            if ignore_errors:
-                log.warn('Error: %s returned status code %s: %s (IGNORED)', cmd[0], status, err)
-            else:
-                log.error('Error: %s returned status code %s: %s', cmd[0], status, err)
-                sys.exit(1)
-        return out, err
+    with trace.span(cmd[0], cat='cmd', command=' '.join(cmd)) as span:
+        if settings.DRY and not dry:
+            span.set(dry=True)
+            return b'', b''
+        else:
+            p = Popen(_in_cgroup(cgroup, cmd) if cgroup else cmd,
+                      stdin=PIPE if input is not None else None, stdout=PIPE, stderr=PIPE)
+            out, err = p.communicate(input)
+            status = p.returncode
+            span.set(status=status, bytes_out=len(out), bytes_err=len(err))
+
+            sleep = settings.get('SLEEP')
+            if sleep > 0:  # sleep for given number of seconds
+                log.debug('(Sleeping for %s seconds)' % sleep)
+                time.sleep(sleep)
+
+            if status != 0:
+                if ignore_errors:
+                    log.warn('Error: %s returned status code %s: %s (IGNORED)',
+                             cmd[0], status, err)
+                else:
+                    log.error('Error: %s returned status code %s: %s', cmd[0], status, err)
+                    sys.exit(1)
+            return out, err
 
 def chroot(cmd, quiet=False, ignore_errors=False):
-    cmd = ['chroot', settings.CHROOT, ] + cmd
-    ex(cmd, quiet=quiet, ignore_errors=ignore_errors)
+    with trace.span(cmd[0], cat='chroot'):
+        cmd = ['chroot', settings.CHROOT, ] + cmd
+        return ex(cmd, quiet=quiet, ignore_errors=ignore_errors)
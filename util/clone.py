@@ -0,0 +1,279 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the GNU General
+# Public License as published by the Free Software Foundation, either version 3 of the License, or (at your
+# option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without even the
+# implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU General Public License
+# for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create. If not, see
+# <http://www.gnu.org/licenses/>.
+
+import logging
+import sys
+
+from contextlib import nullcontext
+
+from util import allocation
+from util import ca
+from util import image
+from util import lvm
+from util import numa
+from util import process
+from util import profile
+from util import ready
+from util import settings
+from util import throttle
+from util import trace
+from util.cli import ex
+from util.context import setting
+from util.preflight import preflight
+from util.preflight import target_problems
+
+log = logging.getLogger(__name__)
+
+
+def check_targets(bootdisk_path):
+    """Exit if the chroot target or the bootdisk symlink for grub already exist."""
+    problems = target_problems(bootdisk_path)
+    for problem in problems:
+        log.error('Error: %s', problem)
+    if problems:
+        sys.exit(1)
+
+
+def clone(conn, args, config, lock=None, lvs=None):
+    """Clone a new virtual machine as described by ``args``.
+
+    :param conn: The :py:class:`~libvirtpy.conn.LibVirtConnection` to use.
+    :param args: The parsed command line arguments.
+    :param config: The configuration, already prepared with :py:func:`util.config.for_guest`.
+    :param lock: Lock held while the guest filesystems are mounted, if several clones run at the
+        same time. The chroot target is only checked once the lock is acquired.
+    :param lvs: List of all logical volumes, if already known.
+    """
+    section = args.section
+    transfer_from = config.get(section, 'transfer-from')
+
+    #######################
+    # Variable definition #
+    #######################
+    # define some variables
+    lv_name = 'vm_%s' % args.name
+    src_guest = config.get(section, 'src_guest')
+    public_bridge = config.get(section, 'public_bridge')
+    public_mac = config.get(section, 'public_mac')
+    public_ip4 = config.get(section, 'public_ip4')
+    public_ip6 = config.get(section, 'public_ip6')
+    priv_bridge = config.get(section, 'priv_bridge')
+    priv_mac = config.get(section, 'priv_mac')
+    priv_ip4 = config.get(section, 'priv_ip4')
+    priv_ip6 = config.get(section, 'priv_ip6')
+    vnc_port = config.get(section, 'vnc_port')
+
+    #############
+    # PREFLIGHT #
+    #############
+    with trace.span('preflight'):
+        plan = preflight(conn, args, config, lvs=lvs, check_targets=lock is None)
+        for problem in plan.problems:
+            log.error('Error: %s', problem)
+        if plan.problems:
+            plan.reservation.release()
+            sys.exit(1)
+
+    log.debug('Creating VM %s...', args.name)
+    template = plan.template
+    bootdisk_path = plan.bootdisk_path
+
+    # get some variables depending on the run-time template id
+    config[section]['template_id'] = str(plan.template_id)
+    src_public_ip4 = config.get(section, 'src_public_ip4')
+    src_public_ip6 = config.get(section, 'src_public_ip6')
+    src_priv_ip4 = config.get(section, 'src_priv_ip4')
+    src_priv_ip6 = config.get(section, 'src_priv_ip6')
+
+    #################
+    # COPY TEMPLATE #
+    #################
+    # the disks of the plan are reserved until they are copied
+    with plan.reservation:
+        # finally get the full xml of the template
+        with trace.span('copy xml'):
+            log.info("Copying libvirt XML configuration...")
+            domain = template.copy()
+            domain.name = args.name
+            domain.uuid = ''
+            domain.description = args.desc
+            domain.vcpu = args.cpus
+            domain.memory = int(args.mem * 1024 * 1024)
+            domain.currentMemory = int(args.mem * 1024 * 1024)
+            domain.vncport = int(vnc_port)
+            domain.update_interface(public_bridge, public_mac, public_ip4, public_ip6)
+            domain.update_interface(priv_bridge, priv_mac, priv_ip4, priv_ip6)
+            if plan.numa is not None:
+                numa.apply(domain, plan.numa)
+            if plan.profile is not None:
+                profile.apply(domain, plan.profile, args.mem)
+
+        ##############
+        # Copy disks #
+        ##############
+        with trace.span('copy disks'):
+            for disk in plan.disks:
+                path, lv, new_path = disk.path, disk.lv, disk.new_path
+                if disk.type == 'file':
+                    # not cat="copy": overlays and reflinks would skew the copy throughput
+                    with trace.span('%s %s' % (plan.file_clone, disk.name), cat='image',
+                                    bytes=disk.size, source=path, target=new_path) as span:
+                        if plan.file_clone == 'overlay':
+                            image.overlay(path, new_path, disk.format)
+                            domain.replaceDisk(path, new_path, format='qcow2')
+                        else:
+                            span.set(method=image.copy(path, new_path))
+                            domain.replaceDisk(path, new_path)
+                    continue
+
+                # create logical volume
+                lvm.lvcreate(disk.vg, disk.name, lv.size, pvs=disk.pvs, stripes=disk.stripes)
+                target_devices = disk.target_devices
+                if not target_devices and not settings.DRY:  # LVM chose the PVs
+                    target_devices = allocation.lv_devices(new_path)
+
+                # replace disk in template
+                domain.replaceDisk(path, new_path)
+
+                if transfer_from:
+                    transfer_to = config.get(section, 'transfer-to')
+                    transfer_source = config.get(section, 'transfer-source')
+                    log.warn('Copy disk by executing on %s', transfer_from)
+                    log.warn("  dd if=%s bs=4096 | pv | gzip | ssh %s "
+                             "'gzip -d | dd of=%s bs=4096'", transfer_source or path, transfer_to,
+                             new_path)
+                    log.warn("Press enter when done.")
+                    if not settings.DRY:
+                        input()
+                else:
+                    # copy data from local volume
+                    log.info("Copying LV %s to %s", path, new_path)
+                    with trace.span('copy %s' % lv.name, cat='copy', bytes=lvm.size(lv),
+                                    allocated=lvm.allocated(lv), source=path, target=new_path,
+                                    source_devices=','.join(sorted(disk.source_devices)),
+                                    target_devices=','.join(sorted(target_devices))) as span:
+                        with throttle.copy(config, section, '%s-copy' % args.name, path,
+                                           new_path) as io:
+                            cmd = ['dd', 'if=%s' % path, 'of=%s' % new_path, 'bs=4M']
+                            if io.path:  # buffered writes would escape the io.max limit
+                                cmd += ['iflag=direct', 'oflag=direct']
+                            ex(cmd, cgroup=io.path)
+                        span.set(throttle_events=io.events, min_rate=io.min_rate)
+                    if io.bandwidth:
+                        log.info('Copied %s MiB at %.1f MiB/s, throttled %s times.',
+                                 io.bytes // 1024 // 1024, io.bandwidth / 1024 / 1024, io.events)
+
+    ############################
+    # Define domain in libvirt #
+    ############################
+    with trace.span('define'):
+        log.info('Load new libvirt XML configuration')
+        if not settings.DRY:
+            conn.loadXML(domain.xml)
+
+    #####################
+    # MODIFY FILESYSTEM #
+    #####################
+    sed_ex = 's/%s/%s/g' % (src_guest, args.name)
+
+    bootdisk = domain.getBootDisk()
+    with lock or nullcontext():
+        check_targets(bootdisk_path)
+        with process.mount(src_guest, lv_name, bootdisk, bootdisk_path,
+                           fmt=domain.getBootDiskFormat()):
+            with trace.span('customize'):
+                # copy /etc/resolv.conf, so that e.g. apt-get update works
+                ex(['cp', '-S', '.backup', '-ba', '/etc/resolv.conf', 'etc/resolv.conf'])
+
+                # update hostname
+                with trace.span('update_hostname', cat='step'):
+                    log.info('Update hostname')
+                    for path in plan.files:
+                        ex(['sed', '-i', sed_ex, path])
+
+                process.prepare_cga(src_guest, args.name)
+                process.update_ips(
+                    src_public_ip4=src_public_ip4,
+                    public_ip4=public_ip4,
+                    src_priv_ip4=src_priv_ip4,
+                    priv_ip4=priv_ip4,
+                    src_public_ip6=src_public_ip6,
+                    public_ip6=public_ip6,
+                    src_priv_ip6=src_priv_ip6,
+                    priv_ip6=priv_ip6,
+                )
+                process.update_macs(public_mac, priv_mac)
+                process.scrub(plan.scrub_rules)
+                host_keys = process.prepare_sshd(src_priv_ip6, priv_ip6)
+
+                # submit the CSR early, so it is signed while we continue (unless it is read from
+                # stdin, which the commands below inherit)
+                cert = None
+                if args.update_cert:
+                    key, pem, csr = process.create_tls_key(args.name)
+                    if not plan.ca_backend.interactive:
+                        cert = ca.submit(plan.ca_backend, args.name, csr)
+                    process.prepare_munin_tls(key, pem)
+
+                process.update_grub(sed_ex)
+                with throttle.cgroup(config, section, '%s-apt' % args.name) as cgroup:
+                    with setting(CGROUP=cgroup):
+                        process.update_system()
+                        if args.extra:
+                            process.install_extra(args.extra)
+
+                process.create_ssh_client_keys(args.name)
+
+                process.prepare_munin(src_priv_ip6, priv_ip6)
+
+                if args.update_cert:
+                    if cert is None:
+                        cert = ca.submit(plan.ca_backend, args.name, csr)
+                    timeout = ca.timeout(config, section)
+                    with trace.span('wait for certificate', cat='step'):
+                        content = ca.result(cert, timeout)
+                    if content is None:
+                        log.error('Error: No signed certificate after %ss.', timeout)
+                        sys.exit(1)
+                    process.install_tls_cert(pem, content)
+
+                log.info('Done, cleaning up.')
+                ex(['mv', 'etc/resolv.conf.backup', 'etc/resolv.conf'])
+
+    ####################
+    # Start the domain #
+    ####################
+    if args.start or args.wait_ready:
+        probe = ready.Probe(args.name, [priv_ip6, public_ip4], host_keys,
+                            port=int(config.get(section, 'ready_port')), uri=conn.uri)
+        monitor = ready.monitor() if args.wait_ready and not settings.DRY else None
+        with trace.span('start'):
+            log.info('Starting %s', args.name)
+            if monitor is not None:
+                monitor.watch(probe)  # before starting, so we don't miss any events
+            if not settings.DRY:
+                conn.startDomain(args.name)
+
+        if monitor is not None:
+            with trace.span('wait ready') as span:
+                log.info('Waiting for %s to be ready', args.name)
+                monitor.wait([probe], int(config.get(section, 'ready_timeout')))
+                span.set(**probe.as_dict())
+            if probe.error:
+                log.error('Error: %s: %s', args.name, probe.error)
+                sys.exit(1)
+
+    return domain
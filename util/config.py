@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+import configparser
+
+DOTFILES = ['.bash_history', '.lesshst', '.viminfo', '.rnd', '.histfile']
+
+DEFAULTS = {
+    'src_guest': 'stretch',
+    'transfer-from': '',
+    'transfer-to': '',
+    'transfer-source': '',
+    'public_bridge': 'br0',
+    'priv_bridge': 'br1',
+    'vnc_port': '59%(guest_id)s',
+    'ca_host': '',
+    'ca_serial': '',
+    'ca_backend': 'interactive',
+    'ca_key': '',
+    'ca_cert': '',
+    'ca_command': '',
+    'ca_dropdir': '',
+    'ca_timeout': '',
+    'metrics_db': '/var/lib/virsh-create/metrics.sqlite',
+    'metrics_textfile': '',
+    'daemon_socket': '/run/virsh-create.sock',
+    'daemon_max_jobs': '1',
+    'hosts': '',
+    'storage_pool': '',
+    'remote_command': 'ssh {host} virsh-create.py',
+    'io_cgroup': '',
+    'io_weight': '50',
+    'io_max_rate': '',
+    'io_latency_target': '20',
+    'io_monitor': '',
+    'ready_timeout': '600',
+    'ready_port': '22',
+    'file_clone': 'copy',
+    'numa_capabilities': '',
+    'profile': '',
+    'lv_placement': 'spread',
+    'vg_map': '',
+    'lv_stripe_min_size': '',
+    'lv_stripes': '2',
+    'placement_registry': '/run/virsh-create/clones',
+    'libvirt_uri': '',
+    'scrub_rules': '\n'.join(['delete %s/%s' % (home, f) for home in ['root', 'home/*']
+                              for f in DOTFILES] + ['regenerate etc/machine-id']),
+}
+
+
+def load(path='virsh-create.conf'):
+    """Parse local machine dependent configuration."""
+    config = configparser.ConfigParser(defaults=DEFAULTS)
+    config.read(path)
+    return config
+
+
+def for_guest(config, section, guest_id, frm=None, profile=None):
+    """Set the guest-specific values in ``section``."""
+    config[section]['guest_id'] = str(guest_id)
+    if frm:
+        config[section]['src_guest'] = frm
+    if profile:
+        config[section]['profile'] = profile
+    return config
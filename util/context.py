@@ -24,6 +24,7 @@ from contextlib import contextmanager
 from util import settings
 
 log = logging.getLogger(__name__)
+_unset = object()
 
 
 @contextmanager
@@ -45,12 +46,17 @@ def umask(mask):
 
 @contextmanager
 def setting(**kwargs):
+    """Override settings for the current thread, read them with :py:func:`util.settings.get`."""
     old = {}
     for k, v in kwargs.items():
-        old[k] = getattr(settings, k, None)
-        setattr(settings, k, v)
-
-    yield
-
-    for k, v in old.items():
-        setattr(settings, k, v)
+        old[k] = getattr(settings.local, k, _unset)
+        setattr(settings.local, k, v)
+
+    try:
+        yield
+    finally:
+        for k, v in old.items():
+            if v is _unset:
+                delattr(settings.local, k)
+            else:
+                setattr(settings.local, k, v)
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Long-running provisioning daemon.
+
+The daemon keeps the libvirt connection, the domain and LVM inventories and the configuration
+loaded and accepts clone jobs on a Unix socket. The protocol is one JSON object per line, requests
+look like this::
+
+    {"action": "submit", "job": {"name": "example", "id": 42}, "follow": true}
+    {"action": "follow", "job": 1}
+    {"action": "jobs"}
+    {"action": "inventory"}
+
+A followed job streams ``log``, ``phase`` and finally a ``done`` event back to the client.
+
+Jobs run in worker threads. Copying disks of several jobs may happen at the same time (up to
+``daemon_max_jobs``), but since all guests are mounted at the same chroot target, only one job
+at a time customizes its guest.
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import logging
+import os
+import queue
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+from util import config as configuration
+from util import lvm
+from util import metrics
+from util import settings
+from util import trace
+from util.clone import clone
+
+log = logging.getLogger(__name__)
+
+KEEP_SECONDS = 24 * 3600  # finished jobs are forgotten after this long...
+KEEP_JOBS = 100  # ... or when there are more finished jobs than this
+
+JOB_DEFAULTS = {
+    'frm': None,
+    'section': 'DEFAULT',
+    'desc': '',
+    'cpus': 1,
+    'mem': 1.0,
+    'extra': None,
+    'update_cert': True,
+    'start': False,
+    'wait_ready': False,
+    'numa': False,
+    'profile': None,
+}
+
+
+class Job(object):
+    def __init__(self, id, args):
+        self.id = id
+        self.args = args
+        self.state = 'queued'
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self.events = []
+        self.changed = threading.Condition()
+
+    def emit(self, **event):
+        event['job'] = self.id
+        with self.changed:
+            self.events.append(event)
+            self.changed.notify_all()
+
+    def finish(self, state):
+        self.state = state
+        self.finished = time.time()
+        self.emit(event='done', state=state)
+
+    def follow(self):
+        """Yield all events of this job, blocking until the job is done."""
+        index = 0
+        while True:
+            with self.changed:
+                while index >= len(self.events):
+                    self.changed.wait()
+                events = self.events[index:]
+            index += len(events)
+            for event in events:
+                yield event
+                if event['event'] == 'done':
+                    return
+
+    def as_dict(self):
+        return {
+            'job': self.id,
+            'name': self.args.name,
+            'state': self.state,
+            'submitted': self.submitted,
+            'started': self.started,
+            'finished': self.finished,
+        }
+
+
+class JobLogHandler(logging.Handler):
+    """Forward log records emitted by the thread of a job to that job."""
+
+    def __init__(self, daemon, level=logging.INFO):
+        super(JobLogHandler, self).__init__(level)
+        self.daemon = daemon
+        self.setFormatter(logging.Formatter('%(message)s'))
+
+    def emit(self, record):
+        job = self.daemon.running.get(record.thread)
+        if job is not None:
+            job.emit(event='log', level=record.levelname, message=self.format(record))
+
+
+class Daemon(object):
+    def __init__(self, conn, config, socket_path, max_jobs=1):
+        self.conn = conn
+        self.config = config
+        self.socket_path = socket_path
+        self.max_jobs = max_jobs
+
+        self.jobs = {}
+        self.running = {}  # thread ident -> job
+        self.workers = set()  # thread idents of the workers
+        self.queue = queue.Queue()
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.mount_lock = threading.Lock()
+
+        self.domains = set()
+        self.lvs = []
+        self.refresh()
+
+        # Clients get the progress of their jobs regardless of -v, which only applies to the
+        # handlers that are already configured (i.e. the console of the daemon).
+        root = logging.getLogger()
+        for handler in root.handlers:
+            if handler.level == logging.NOTSET:
+                handler.setLevel(root.level)
+        root.setLevel(min(root.level, logging.INFO))
+        root.addHandler(JobLogHandler(self))
+        trace.listeners.append(self.on_phase)
+
+    def refresh(self):
+        """Re-read the domain and LVM inventories."""
+        with trace.span('refresh', cat='daemon') as sp:
+            self.domains = set(d.name for d in self.conn.getAllDomains(cache=False))
+            self.lvs = lvm.lvs()
+        log.info('Inventory: %s domains, %s logical volumes', len(self.domains), len(self.lvs))
+
+        # not part of any job, so its spans must not end up in the metrics of the next one
+        with trace._lock:
+            trace.spans[:] = [s for s in trace.spans if trace.root(s) is not sp]
+
+    def on_phase(self, state, span):
+        job = self.running.get(span.tid)
+        if job is not None:
+            job.emit(event='phase', name=span.name, state=state,
+                     duration=span.duration if state == 'end' else None)
+
+    def expire(self):
+        """Forget old finished jobs, the caller must hold the lock."""
+        finished = sorted([j for j in self.jobs.values() if j.finished is not None],
+                          key=lambda j: j.finished)
+        now = time.time()
+        for index, job in enumerate(finished):
+            if now - job.finished > KEEP_SECONDS or len(finished) - index > KEEP_JOBS:
+                del self.jobs[job.id]
+
+    def submit(self, data):
+        """Create a new job. Errors that need no work to detect are reported right away."""
+        values = dict(JOB_DEFAULTS)
+        values.update(data)
+        args = argparse.Namespace(**values)
+
+        with self.lock:
+            self.expire()
+            job = Job(next(self.ids), args)
+            self.jobs[job.id] = job
+
+            error = None
+            pending = [j.args.name for j in self.jobs.values()
+                       if j.state in ('queued', 'running') and j is not job]
+            if not getattr(args, 'name', None) or getattr(args, 'id', None) is None:
+                error = 'Jobs need a name and an id.'
+            elif args.name in self.domains or args.name in pending:
+                error = 'Domain %s already defined or queued.' % args.name
+            elif not self.config.has_section(args.section) and args.section != 'DEFAULT':
+                error = 'Unknown section %s.' % args.section
+            elif args.update_cert and self.config.get(args.section, 'ca_backend') == 'interactive':
+                error = 'Interactive TLS certificates are not supported in daemon mode.'
+            elif self.config.get(args.section, 'transfer-from'):
+                error = 'Copying templates from other hosts is not supported in daemon mode.'
+
+        if error is not None:
+            job.emit(event='log', level='ERROR', message='Error: %s' % error)
+            job.finish('failed')
+        else:
+            self.queue.put(job)
+        return job
+
+    def run_job(self, job):
+        config = configuration.for_guest(copy.deepcopy(self.config), job.args.section,
+                                         job.args.id, job.args.frm, job.args.profile)
+        ident = threading.get_ident()
+        job.state = 'running'
+        job.started = time.time()
+        self.running[ident] = job
+
+        state = 'failed'
+        try:
+            clone(self.conn, job.args, config, lock=self.mount_lock, lvs=self.lvs)
+            state = 'ok'
+        except SystemExit:
+            pass
+        except Exception as e:
+            log.exception('Error: %s', e)
+        finally:
+            del self.running[ident]
+
+        with trace._lock:
+            # spans of helper threads (e.g. preflight checks) belong to the phase that started them
+            spans = [s for s in trace.spans if trace.root(s).tid == ident]
+            # spans of other threads than the workers (e.g. of clients) are never collected
+            trace.spans[:] = [s for s in trace.spans
+                              if trace.root(s).tid in self.workers and trace.root(s).tid != ident]
+        try:
+            metrics.record(config.get(job.args.section, 'metrics_db'),
+                           config.get(job.args.section, 'src_guest'), job.args.name, state,
+                           spans=spans)
+        except Exception as e:
+            log.warning('Could not record metrics: %s', e)
+
+        self.refresh()
+        job.finish(state)
+
+    def worker(self):
+        self.workers.add(threading.get_ident())
+        while True:
+            job = self.queue.get()
+            try:
+                self.run_job(job)
+            finally:
+                self.queue.task_done()
+
+    def handle(self, request, reply):
+        action = request.get('action')
+        if action == 'submit':
+            job = self.submit(request.get('job', {}))
+            reply(job.as_dict())
+            if request.get('follow'):
+                for event in job.follow():
+                    reply(event)
+        elif action == 'follow':
+            job = self.jobs.get(request.get('job'))
+            if job is None:
+                reply({'error': 'Unknown job.'})
+            else:
+                for event in job.follow():
+                    reply(event)
+        elif action == 'jobs':
+            reply({'jobs': [j.as_dict() for j in self.jobs.values()]})
+        elif action == 'inventory':
+            reply({'domains': sorted(self.domains), 'lvs': ['%s/%s' % (lv.vg, lv.name)
+                                                            for lv in self.lvs]})
+        elif action == 'refresh':
+            self.refresh()
+            reply({'domains': len(self.domains), 'lvs': len(self.lvs)})
+        else:
+            reply({'error': 'Unknown action: %s' % action})
+
+    def serve(self):
+        settings.DRY = False
+        for i in range(self.max_jobs):
+            threading.Thread(target=self.worker, daemon=True, name='worker-%s' % i).start()
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                def reply(data):
+                    self.wfile.write(json.dumps(data).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line.decode('utf-8'))
+                    except ValueError:
+                        reply({'error': 'Invalid JSON.'})
+                        continue
+                    daemon.handle(request, reply)
+
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = socketserver.ThreadingUnixStreamServer(self.socket_path, Handler)
+        server.daemon_threads = True
+        os.chmod(self.socket_path, 0o600)
+        # e.g. systemctl stop, exit normally so the socket is removed and clients clone locally
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        log.info('Listening on %s with %s worker(s)', self.socket_path, self.max_jobs)
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            os.remove(self.socket_path)
+
+
+def request(socket_path, data):
+    """Send a request to the daemon at ``socket_path`` and yield all replies."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(socket_path)
+    try:
+        sock.sendall(json.dumps(data).encode('utf-8') + b'\n')
+        sock.shutdown(socket.SHUT_WR)
+        with sock.makefile('rb') as stream:
+            for line in stream:
+                yield json.loads(line.decode('utf-8'))
+    finally:
+        sock.close()
+
+
+def submit(socket_path, job):
+    """Submit a job, log its progress and return ``True`` if it succeeded.
+
+    Returns ``None`` if the daemon is not running (e.g. the socket was left behind).
+    """
+    state = None
+    events = request(socket_path, {'action': 'submit', 'job': job, 'follow': True})
+    try:
+        first = next(events)
+    except (ConnectionRefusedError, FileNotFoundError) as e:
+        log.warning('Daemon at %s is not running: %s', socket_path, e)
+        return None
+
+    for event in itertools.chain([first], events):
+        if event.get('event') == 'log':
+            log.log(getattr(logging, event['level'], logging.INFO), event['message'])
+        elif event.get('event') == 'phase':
+            if event['state'] == 'end':
+                log.info('Job %s: %s done after %.2fs', event['job'], event['name'],
+                         event['duration'])
+        elif event.get('event') == 'done':
+            state = event['state']
+        elif 'error' in event:
+            log.error('Error: %s', event['error'])
+        else:
+            log.info('Job %s: %s', event['job'], event['state'])
+    return state == 'ok'
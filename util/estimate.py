@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Predict duration and I/O of a clone from a dry run.
+
+A dry run records the same spans as a real run (see :py:mod:`util.trace`), just without executing
+anything. The cost model combines that execution plan with the measured throughput of the source
+device and the history in the metrics database (see :py:mod:`util.metrics`).
+"""
+
+import logging
+import os
+import sys
+import time
+
+from util import metrics
+from util import trace
+from util.cli import ex
+
+log = logging.getLogger(__name__)
+
+SAMPLE_SIZE = 64  # MiB read from the source device to measure throughput
+
+# number of keys generated by each step
+KEYS = {
+    'prepare_sshd': 2,
+    'create_ssh_client_keys': 2,
+    'create_tls_key': 1,
+}
+
+
+def measure_throughput(path, size=SAMPLE_SIZE):
+    """Measure the read throughput of ``path`` in bytes per second.
+
+    This only reads from the device, so it is safe to do in a dry run. Since the copy reads and
+    writes at the same time, the result is an optimistic upper bound for the copy throughput.
+    """
+    start = time.perf_counter()
+    ex(['dd', 'if=%s' % path, 'of=/dev/null', 'bs=4M', 'count=%s' % (size // 4), 'iflag=direct'],
+       quiet=True, dry=True)
+    return size * 1024 * 1024 / (time.perf_counter() - start)
+
+
+def history(path, template):
+    """Get copy throughput, apt download volume and phase durations from previous runs."""
+    if not os.path.exists(path):
+        return None, None, {}
+
+    db = metrics.connect(path)
+    throughput = [b / s for b, s in db.execute(
+        "SELECT copy_bytes, copy_seconds FROM runs WHERE status = 'ok' AND copy_seconds > 0")]
+    apt = [row[0] for row in db.execute(
+        "SELECT apt_bytes FROM runs WHERE status = 'ok' AND template = ?", (template, ))]
+    phases = {phase: metrics.percentile(values, 50)
+              for (tmpl, phase), values in metrics.phase_durations(db, template=template).items()}
+    db.close()
+    return metrics.percentile(throughput, 50), metrics.percentile(apt, 50), phases
+
+
+def _size(value):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if abs(value) < 1024:
+            return '%.1f %s' % (value, unit)
+        value /= 1024.0
+    return '%.1f TiB' % value
+
+
+def _duration(value):
+    if value is None:
+        return '?'
+    return '%dm%02ds' % divmod(round(value), 60)
+
+
+def report(metrics_db, template, stream=sys.stdout, spans=trace.spans):
+    """Print the execution plan of the dry run that just finished, with estimates."""
+    copies = [s for s in spans if s.cat == 'copy']
+    steps = [s.name for s in spans if s.cat == 'step']
+    throughput, apt_bytes, phases = history(metrics_db, template)
+    # e.g. opening the libvirt connection is a root span too, but not a phase of the clone
+    estimates = {s.name: phases.get(s.name) for s in trace.roots(spans) if s.cat == 'phase'}
+
+    source = 'history'
+    if throughput is None and copies:
+        throughput = measure_throughput(copies[0].attrs['source'])
+        source = 'read sample'
+
+    print('Execution plan for a clone of %s:' % template, file=stream)
+    copy_total = 0
+    for sp in copies:
+        seconds = sp.attrs['bytes'] / throughput if throughput else None
+        copy_total += seconds or 0
+        allocated = ''
+        if sp.attrs.get('allocated') is not None:
+            allocated = ' (%s allocated)' % _size(sp.attrs['allocated'])
+        print('  copy %s -> %s: %s%s, %s' % (
+            sp.attrs['source'], sp.attrs['target'], _size(sp.attrs['bytes']), allocated,
+            _duration(seconds)), file=stream)
+    if throughput:
+        print('  copy throughput: %s/s (%s)' % (_size(throughput), source), file=stream)
+        estimates['copy disks'] = copy_total
+
+    if apt_bytes is not None:
+        print('  apt download: %s (median of previous runs)' % _size(apt_bytes), file=stream)
+    else:
+        print('  apt download: unknown (no previous runs of %s)' % template, file=stream)
+    print('  keys to generate: %s' % sum(KEYS.get(step, 0) for step in steps), file=stream)
+
+    print('Phases:', file=stream)
+    for name, seconds in estimates.items():
+        print('  %-24s %8s' % (name, _duration(seconds)), file=stream)
+
+    known = {k: v for k, v in estimates.items() if v is not None}
+    total = sum(known.values())
+    print('Predicted total: %s%s' % (
+        _duration(total), '' if len(known) == len(estimates) else ' (incomplete, no history)'),
+        file=stream)
+    if known:
+        # all phases run one after another, so the critical path is the whole run
+        slowest = max(known, key=known.get)
+        print('Critical path: %s' % ' > '.join(known), file=stream)
+        print('Dominated by: %s (%s, %d%%)' % (
+            slowest, _duration(known[slowest]), known[slowest] / total * 100 if total else 0),
+            file=stream)
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Clone and attach file-backed disk images (``<disk type="file">``).
+
+Images are cloned according to the ``file_clone`` config option: ``copy`` (the default) copies
+the image, using a reflink if the filesystem supports it and otherwise ``copy_file_range()`` on the
+data regions only, so sparse images stay sparse. ``overlay`` creates a qcow2 overlay with the
+template image as backing file.
+
+To modify the guest, qcow2 images are attached with ``qemu-nbd`` and raw images with ``losetup``,
+the resulting block device is then handled like an LVM-backed disk.
+"""
+
+import errno
+import fcntl
+import glob
+import logging
+import os
+import sys
+
+from util import settings
+from util.cli import ex
+
+log = logging.getLogger(__name__)
+
+FICLONE = 0x40049409  # ioctl to create a reflink, see ioctl_ficlone(2)
+CHUNK = 1024 * 1024 * 1024  # max bytes per copy_file_range() call
+NBD_MAX_PART = 0  # partitions are mapped by kpartx, so LVM doesn't see every PV twice
+
+
+def clone_path(path, template, name):
+    """Get the path of the clone of the image at ``path``."""
+    dirname, filename = os.path.split(path)
+    if template in filename:
+        return os.path.join(dirname, filename.replace(template, name))
+    return os.path.join(dirname, '%s-%s' % (name, filename))
+
+
+def allocated(path):
+    """Bytes actually allocated by the file at ``path``."""
+    return os.stat(path).st_blocks * 512
+
+
+def overlay(backing, path, backing_format):
+    """Create a qcow2 image at ``path`` with ``backing`` as backing file."""
+    log.info('Creating overlay %s on %s', path, backing)
+    ex(['qemu-img', 'create', '-q', '-f', 'qcow2', '-b', backing, '-F', backing_format, path])
+
+
+def _data(fd, size):
+    """Yield ``(start, end)`` of all regions of ``fd`` that contain data."""
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:  # only a hole left
+                return
+            raise
+        end = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, end
+        offset = end
+
+
+def copy(src, dst):
+    """Copy ``src`` to ``dst``, return ``'reflink'`` or ``'copy_file_range'``."""
+    log.info('Copying image %s to %s', src, dst)
+    if settings.DRY:
+        return None
+
+    with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+        try:
+            fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            return 'reflink'
+        except OSError as e:  # not supported by the filesystem or across filesystems
+            log.debug('Cannot reflink %s: %s', src, e)
+
+        size = os.fstat(fsrc.fileno()).st_size
+        for start, end in _data(fsrc.fileno(), size):
+            offset = start
+            while offset < end:
+                offset += os.copy_file_range(fsrc.fileno(), fdst.fileno(),
+                                             min(CHUNK, end - offset), offset, offset)
+        os.ftruncate(fdst.fileno(), size)
+    return 'copy_file_range'
+
+
+def _free_nbd():
+    for path in sorted(glob.glob('/sys/block/nbd*'), key=lambda p: int(p[len('/sys/block/nbd'):])):
+        if not os.path.exists(os.path.join(path, 'pid')):  # no qemu-nbd attached
+            return os.path.join('/dev', os.path.basename(path))
+
+
+def attach(path, fmt):
+    """Attach the image at ``path`` as block device and return the device."""
+    if fmt == 'raw':
+        stdout, stderr = ex(['losetup', '--find', '--show', path])
+        device = stdout.decode('utf-8').strip() or '/dev/loopX'
+    else:
+        ex(['modprobe', 'nbd', 'max_part=%s' % NBD_MAX_PART])
+        device = '/dev/nbdX' if settings.DRY else _free_nbd()
+        if device is None:
+            log.error('Error: No free NBD device.')
+            sys.exit(1)
+        ex(['qemu-nbd', '--connect=%s' % device, '--format=%s' % fmt, path])
+    log.info('Attached %s as %s', path, device)
+    return device
+
+
+def detach(device):
+    if device.startswith('/dev/nbd'):
+        ex(['qemu-nbd', '--disconnect', device])
+    else:
+        ex(['losetup', '--detach', device])
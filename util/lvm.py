@@ -22,6 +22,7 @@ from util.cli import ex
 
 LV = namedtuple('lv', ['name', 'vg', 'attr', 'size', 'pool', 'origin', 'data', 'meta', 'move',
                        'log', 'copy', 'convert'])
+PV = namedtuple('pv', ['name', 'vg', 'size', 'free'])
 log = logging.getLogger(__name__)
 
 
@@ -31,12 +32,52 @@ def lvs():
     return [LV(*line.strip().split(';')) for line in stdout.decode('utf-8').split()]
 
 
+def vgs():
+    """Get a dictionary of all volume groups with the bytes free in each of them."""
+    stdout, stderr = ex(['vgs', '--noheadings', '--separator', ';', '--units=b', '--nosuffix',
+                         '-o', 'vg_name,vg_free'], quiet=True, dry=True)
+    return {vg: int(free) for vg, free in
+            (line.strip().split(';') for line in stdout.decode('utf-8').split())}
+
+
+def pvs():
+    """Get all physical volumes, sizes are in bytes."""
+    stdout, stderr = ex(['pvs', '--noheadings', '--separator', ';', '--units=b', '--nosuffix',
+                         '-o', 'pv_name,vg_name,pv_size,pv_free'], quiet=True, dry=True)
+    return [PV(name, vg, int(size), int(free)) for name, vg, size, free in
+            (line.strip().split(';') for line in stdout.decode('utf-8').split())]
+
+
+def devices(path):
+    """Get the physical volumes the LV at ``path`` is on."""
+    stdout, stderr = ex(['lvs', '--noheadings', '-o', 'devices', path], quiet=True, dry=True)
+    # one line per segment, devices of a striped segment are separated by commas
+    return sorted(set(d.split('(')[0] for line in stdout.decode('utf-8').split()
+                      for d in line.split(',') if d))
+
+
 def lvdisplay(path):
     stdout, stderr = ex(['lvdisplay', '--noheadings', '--separator', ';', '--units=b', '-C', path],
                         quiet=True, dry=True)
     return LV(*stdout.decode('utf-8').strip().split(';'))
 
 
-def lvcreate(vg, name, size):
-    log.info('Create LV %s on VG %s', name, vg)
-    ex(['lvcreate', '-L', size, '-n', name, vg])
+def size(lv):
+    """Size of ``lv`` in bytes."""
+    return int(lv.size.rstrip('B'))
+
+
+def allocated(lv):
+    """Bytes actually allocated by ``lv`` if it is a thin volume, otherwise ``None``."""
+    if not lv.data:
+        return None
+    return int(size(lv) * float(lv.data) / 100)
+
+
+def lvcreate(vg, name, size, pvs=None, stripes=None):
+    """Create an LV, on the physical volumes ``pvs`` (if given) with ``stripes`` stripes."""
+    log.info('Create LV %s on VG %s%s', name, vg, ' (%s)' % ', '.join(pvs) if pvs else '')
+    cmd = ['lvcreate', '-L', size, '-n', name]
+    if stripes:
+        cmd += ['-i', str(stripes)]
+    ex(cmd + [vg] + list(pvs or []))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Store per-run provisioning metrics in a local SQLite database.
+
+The data is taken from the spans recorded by :py:mod:`util.trace`.
+"""
+
+import logging
+import math
+import os
+import socket
+import sqlite3
+import sys
+import time
+
+from util import trace
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    started REAL NOT NULL,
+    host TEXT NOT NULL,
+    template TEXT NOT NULL,
+    name TEXT NOT NULL,
+    status TEXT NOT NULL,
+    duration REAL NOT NULL,
+    copy_bytes INTEGER NOT NULL,
+    copy_seconds REAL NOT NULL,
+    apt_bytes INTEGER NOT NULL,
+    throttle_events INTEGER NOT NULL DEFAULT 0,
+    ready_seconds REAL
+);
+CREATE TABLE IF NOT EXISTS phases (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    phase TEXT NOT NULL,
+    duration REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS phases_run_id ON phases(run_id);
+CREATE TABLE IF NOT EXISTS copies (
+    run_id INTEGER NOT NULL REFERENCES runs(id),
+    source_devices TEXT NOT NULL,
+    target_devices TEXT NOT NULL,
+    bytes INTEGER NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS copies_run_id ON copies(run_id);
+"""
+
+# columns added after the first release, so they are missing in older databases
+COLUMNS = [
+    ('runs', 'throttle_events', 'INTEGER NOT NULL DEFAULT 0'),
+    ('runs', 'ready_seconds', 'REAL'),
+]
+
+
+def connect(path):
+    dirname = os.path.dirname(path)
+    if dirname and not os.path.exists(dirname):
+        os.makedirs(dirname)
+    db = sqlite3.connect(path)
+    db.executescript(SCHEMA)
+    for table, column, definition in COLUMNS:
+        if column not in [row[1] for row in db.execute('PRAGMA table_info(%s)' % table)]:
+            db.execute('ALTER TABLE %s ADD COLUMN %s %s' % (table, column, definition))
+    return db
+
+
+def collect(spans=trace.spans):
+    """Summarize the spans recorded so far into a dict suitable for :py:func:`record`."""
+    # e.g. opening the libvirt connection is a root span too, but not a phase of the clone
+    phases = [s for s in trace.roots(spans) if s.cat == 'phase']
+    if not phases:
+        return None
+
+    copies = [s for s in spans if s.cat == 'copy']
+    return {
+        'started': time.time() - (time.perf_counter() - phases[0].start),
+        'duration': phases[-1].end - phases[0].start,
+        'phases': [(s.name, s.duration) for s in phases],
+        'copies': [(s.attrs.get('source_devices', ''), s.attrs.get('target_devices', ''),
+                    s.attrs.get('bytes', 0), s.duration) for s in copies],
+        'copy_bytes': sum(s.attrs.get('bytes', 0) for s in copies),
+        'copy_seconds': sum(s.duration for s in copies),
+        'apt_bytes': sum(s.attrs.get('download_bytes', 0) for s in spans),
+        'throttle_events': sum(s.attrs.get('throttle_events', 0) for s in copies),
+        'ready_seconds': next((s.attrs.get('ready') for s in phases if s.name == 'wait ready'),
+                              None),
+    }
+
+
+def record(path, template, name, status, spans=trace.spans):
+    """Add the current run to the metrics database at ``path``."""
+    data = collect(spans)
+    if data is None:
+        return
+
+    log.info('Recording metrics in %s', path)
+    db = connect(path)
+    with db:
+        cursor = db.execute(
+            'INSERT INTO runs (started, host, template, name, status, duration, copy_bytes, '
+            'copy_seconds, apt_bytes, throttle_events, ready_seconds) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (data['started'], socket.gethostname(), template, name, status, data['duration'],
+             data['copy_bytes'], data['copy_seconds'], data['apt_bytes'],
+             data['throttle_events'], data['ready_seconds']))
+        db.executemany('INSERT INTO phases (run_id, phase, duration) VALUES (?, ?, ?)',
+                       [(cursor.lastrowid, phase, duration) for phase, duration in data['phases']])
+        db.executemany('INSERT INTO copies (run_id, source_devices, target_devices, bytes, '
+                       'seconds) VALUES (?, ?, ?, ?, ?)',
+                       [(cursor.lastrowid, ) + copy for copy in data['copies']])
+    db.close()
+
+
+def percentile(values, p):
+    """Nearest-rank percentile of ``values``."""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+
+def phase_durations(db, template=None):
+    """Get a dict mapping ``(template, phase)`` to all recorded durations of successful runs."""
+    query = "SELECT r.template, p.phase, p.duration FROM phases p JOIN runs r ON p.run_id = r.id " \
+            "WHERE r.status = 'ok'"
+    params = ()
+    if template is not None:
+        query += ' AND r.template = ?'
+        params = (template, )
+
+    durations = {}
+    for tmpl, phase, duration in db.execute(query, params):
+        durations.setdefault((tmpl, phase), []).append(duration)
+    for tmpl, duration in db.execute(
+            "SELECT template, duration FROM runs WHERE status = 'ok'" + (
+                ' AND template = ?' if template is not None else ''), params):
+        durations.setdefault((tmpl, 'total'), []).append(duration)
+    return durations
+
+
+def device_throughput(db, template=None):
+    """Get count, bytes and seconds of copies in successful runs per source and target disks."""
+    query = "SELECT c.source_devices, c.target_devices, COUNT(*), SUM(c.bytes), " \
+            "SUM(c.seconds) FROM copies c JOIN runs r ON c.run_id = r.id " \
+            "WHERE r.status = 'ok' AND c.target_devices != ''"
+    params = ()
+    if template is not None:
+        query += ' AND r.template = ?'
+        params = (template, )
+    query += ' GROUP BY c.source_devices, c.target_devices'
+    return [(source, target, count, size, seconds)
+            for source, target, count, size, seconds in db.execute(query, params)]
+
+
+def stats(path, template=None, stream=sys.stdout):
+    """Print p50/p95 per phase and template and the copy throughput per device."""
+    db = connect(path)
+    durations = phase_durations(db, template=template)
+    devices = device_throughput(db, template=template)
+    db.close()
+
+    if not durations:
+        print('No successful runs recorded in %s.' % path, file=stream)
+        return
+
+    print('%-16s %-24s %6s %9s %9s' % ('template', 'phase', 'runs', 'p50', 'p95'), file=stream)
+    for (tmpl, phase), values in sorted(durations.items()):
+        print('%-16s %-24s %6s %8.2fs %8.2fs' % (
+            tmpl, phase, len(values), percentile(values, 50), percentile(values, 95)), file=stream)
+
+    if devices:
+        print('', file=stream)
+        print('%-20s %-20s %6s %12s' % ('source disks', 'target disks', 'copies', 'MiB/s'),
+              file=stream)
+        for source, target, count, size, seconds in devices:
+            print('%-20s %-20s %6s %12.1f' % (
+                source, target, count, size / seconds / 1024 / 1024 if seconds else 0),
+                file=stream)
+
+
+def _labels(**labels):
+    return ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+                    for k, v in sorted(labels.items()))
+
+
+def write_textfile(db_path, path):
+    """Write the metrics database as a Prometheus node-exporter textfile.
+
+    The file is written atomically, so the node exporter never reads a partial file.
+    """
+    db = connect(db_path)
+    lines = []
+
+    lines += ['# HELP virsh_create_runs_total Number of recorded virsh-create runs.',
+              '# TYPE virsh_create_runs_total counter']
+    for template, status, count in db.execute(
+            'SELECT template, status, COUNT(*) FROM runs GROUP BY template, status'):
+        lines.append('virsh_create_runs_total{%s} %s' % (
+            _labels(template=template, status=status), count))
+
+    last = {}
+    for row in db.execute("SELECT id, template, started, duration, copy_bytes, copy_seconds, "
+                          "apt_bytes, throttle_events, ready_seconds FROM runs "
+                          "WHERE status = 'ok' "
+                          "ORDER BY started"):
+        last[row[1]] = row  # later runs overwrite earlier ones
+
+    gauges = (
+        ('last_run_timestamp_seconds', 'Start time of the last successful run.', 2),
+        ('last_run_duration_seconds', 'Duration of the last successful run.', 3),
+        ('last_copy_bytes', 'Bytes copied in the last successful run.', 4),
+        ('last_apt_download_bytes', 'Bytes downloaded by apt in the last successful run.', 6),
+        ('last_copy_throttle_events', 'Times the copy was throttled in the last successful run.',
+         7),
+        ('last_ready_seconds', 'Seconds from start until the guest was ready in the last '
+         'successful run.', 8),
+    )
+    for name, help, index in gauges:
+        lines += ['# HELP virsh_create_%s %s' % (name, help),
+                  '# TYPE virsh_create_%s gauge' % name]
+        for template, row in sorted(last.items()):
+            if row[index] is not None:
+                lines.append('virsh_create_%s{%s} %s' % (
+                    name, _labels(template=template), row[index]))
+
+    lines += ['# HELP virsh_create_last_copy_throughput_bytes_per_second Copy throughput of the '
+              'last successful run.',
+              '# TYPE virsh_create_last_copy_throughput_bytes_per_second gauge']
+    for template, row in sorted(last.items()):
+        if row[5]:
+            lines.append('virsh_create_last_copy_throughput_bytes_per_second{%s} %s' % (
+                _labels(template=template), row[4] / row[5]))
+
+    lines += ['# HELP virsh_create_device_copy_throughput_bytes_per_second Copy throughput per '
+              'source and target disks over all successful runs.',
+              '# TYPE virsh_create_device_copy_throughput_bytes_per_second gauge']
+    for source, target, count, size, seconds in device_throughput(db):
+        if seconds:
+            lines.append('virsh_create_device_copy_throughput_bytes_per_second{%s} %s' % (
+                _labels(source=source, target=target), size / seconds))
+
+    lines += ['# HELP virsh_create_last_phase_duration_seconds Phase durations of the last '
+              'successful run.',
+              '# TYPE virsh_create_last_phase_duration_seconds gauge']
+    for template, row in sorted(last.items()):
+        for phase, duration in db.execute(
+                'SELECT phase, duration FROM phases WHERE run_id = ?', (row[0], )):
+            lines.append('virsh_create_last_phase_duration_seconds{%s} %s' % (
+                _labels(template=template, phase=phase), duration))
+
+    lines += ['# HELP virsh_create_phase_duration_seconds Phase duration quantiles over all '
+              'successful runs.',
+              '# TYPE virsh_create_phase_duration_seconds gauge']
+    for (template, phase), values in sorted(phase_durations(db).items()):
+        for quantile in (50, 95):
+            lines.append('virsh_create_phase_duration_seconds{%s} %s' % (
+                _labels(template=template, phase=phase, quantile=quantile / 100.0),
+                percentile(values, quantile)))
+    db.close()
+
+    log.info('Writing Prometheus textfile %s', path)
+    tmp = '%s.%s.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as stream:
+        stream.write('\n'.join(lines) + '\n')
+    os.replace(tmp, path)
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Place the vCPUs and memory of a new domain on a single NUMA node of the host (``--numa``).
+
+The host topology is read from the libvirt capabilities (or from the file in the
+``numa_capabilities`` config option, e.g. to try placements on a machine with a different
+topology). The load of a node is what other domains already use of it: vCPUs pinned to a host CPU
+count fully for that CPU, unpinned vCPUs are spread over all CPUs they may run on. Memory counts
+for the nodes in ``numatune``, or for all nodes if there is none.
+
+The new domain is placed on the least-loaded node that has enough CPUs and memory left. Every vCPU
+is pinned to one host CPU of that node, memory is bound to the node with ``numatune`` and the guest
+CPU topology is set to match the host, so e.g. two vCPUs that are hyperthreads of the same core
+also look like that to the guest.
+"""
+
+import logging
+
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+Cpu = namedtuple('cpu', ['id', 'core'])  # core is the set of hyperthread siblings
+Node = namedtuple('node', ['id', 'memory', 'cpus'])  # memory in bytes
+Placement = namedtuple('placement', ['node', 'cpus', 'cores', 'threads'])
+
+
+def parse_cpuset(value):
+    """Parse a libvirt cpuset like ``0-3,^2,8`` into a set of integers."""
+    cpus = set()
+    excluded = set()
+    for part in value.split(','):
+        part = part.strip()
+        target = cpus
+        if part.startswith('^'):
+            target = excluded
+            part = part[1:]
+        if '-' in part:
+            start, end = part.split('-')
+            target.update(range(int(start), int(end) + 1))
+        elif part:
+            target.add(int(part))
+    return cpus - excluded
+
+
+def format_cpuset(cpus):
+    """Format integers as libvirt cpuset, the inverse of :py:func:`parse_cpuset`."""
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ','.join(str(s) if s == e else '%s-%s' % (s, e) for s, e in ranges)
+
+
+def capabilities(conn, path=None):
+    if path:
+        from lxml import etree
+        return etree.parse(path).getroot()
+    return conn.getCapabilities()
+
+
+def topology(caps):
+    """Get the NUMA nodes of the host from its capabilities XML."""
+    nodes = []
+    for cell in caps.findall('host/topology/cells/cell'):
+        memory = cell.find('memory')
+        factor = {'KiB': 1024, 'MiB': 1024 ** 2, 'GiB': 1024 ** 3}.get(memory.get('unit'), 1024)
+        cpus = []
+        for elem in cell.findall('cpus/cpu'):
+            cpu = int(elem.get('id'))
+            siblings = elem.get('siblings')
+            cpus.append(Cpu(cpu, frozenset(parse_cpuset(siblings) if siblings else [cpu])))
+        nodes.append(Node(int(cell.get('id')), int(memory.text) * factor, cpus))
+    return nodes
+
+
+def load(nodes, domains):
+    """Get the load of all host CPUs and the memory (in bytes) committed on every node."""
+    all_cpus = set(cpu.id for node in nodes for cpu in node.cpus)
+    cpu_load = dict((cpu, 0.0) for cpu in all_cpus)
+    memory = dict((node.id, 0.0) for node in nodes)
+
+    for domain in domains:
+        vcpus, kib, cpusets, nodeset = domain.getPinning()
+        for cpuset in cpusets:
+            cpus = parse_cpuset(cpuset) & all_cpus if cpuset else all_cpus
+            for cpu in cpus:
+                cpu_load[cpu] += 1.0 / len(cpus)
+
+        ids = parse_cpuset(nodeset) & set(memory) if nodeset else set(memory)
+        for node in ids:
+            memory[node] += kib * 1024.0 / len(ids)
+    return cpu_load, memory
+
+
+def place(nodes, domains, vcpus, memory):
+    """Pick a node and host CPUs for a domain with ``vcpus`` and ``memory`` (in bytes).
+
+    Returns a :py:class:`Placement` or ``None`` if no node has enough CPUs and memory.
+    """
+    cpu_load, committed = load(nodes, domains)
+
+    candidates = []
+    for node in nodes:
+        free = node.memory - committed[node.id]
+        if len(node.cpus) < vcpus or free < memory:
+            log.debug('NUMA node %s: %s CPUs, %s bytes free, too small.',
+                      node.id, len(node.cpus), free)
+            continue
+        score = sum(cpu_load[c.id] for c in node.cpus) / len(node.cpus) + \
+            float(committed[node.id]) / node.memory
+        log.debug('NUMA node %s: score %.2f', node.id, score)
+        candidates.append((score, node.id, node))
+    if not candidates:
+        return None
+    node = min(candidates)[2]
+
+    # whole cores if the vCPUs can be split into them, so hyperthreads stay together
+    threads = min(len(cpu.core) for cpu in node.cpus)
+    if vcpus % threads != 0:
+        threads = 1
+
+    node_cpus = set(cpu.id for cpu in node.cpus)
+    cores = sorted(set(cpu.core & node_cpus for cpu in node.cpus),
+                   key=lambda core: (sum(cpu_load[c] for c in core), min(core)))
+    if threads > 1:
+        cpus = [cpu for core in cores[:vcpus // threads] for cpu in sorted(core)[:threads]]
+    else:  # one thread of the least loaded cores first
+        order = [(cpu_load[cpu], i, index, cpu) for index, core in enumerate(cores)
+                 for i, cpu in enumerate(sorted(core))]
+        cpus = [cpu for _, _, _, cpu in sorted(order)[:vcpus]]
+    return Placement(node.id, cpus, vcpus // threads, threads)
+
+
+def apply(domain, placement):
+    """Write ``placement`` to the XML of ``domain`` (a :py:class:`LibVirtDomainXML`)."""
+    log.info('Placing on NUMA node %s, CPUs %s', placement.node, format_cpuset(placement.cpus))
+    domain.pin([str(cpu) for cpu in placement.cpus], format_cpuset(placement.cpus),
+               str(placement.node))
+    domain.setCpuTopology(sockets=1, cores=placement.cores, threads=placement.threads)
@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Pick the best hypervisor for a new clone.
+
+Every host in the ``hosts`` config option is queried in parallel, see
+:py:class:`~libvirtpy.conn.LibVirtConnectionPool`. Hosts are scored by free space in the storage
+pool, committed vs. physical memory, vCPU overcommit and whether the template is present locally.
+"""
+
+import logging
+import os
+import shlex
+
+from collections import namedtuple
+from urllib.parse import urlparse
+
+from util import trace
+
+log = logging.getLogger(__name__)
+
+Host = namedtuple('host', ['uri', 'score', 'reason', 'has_template', 'storage', 'memory',
+                           'committed_memory', 'cpus', 'committed_cpus'])
+
+# weights of the individual criteria, all criteria are normalized to [0, 1]
+WEIGHT_STORAGE = 1.0
+WEIGHT_MEMORY = 2.0
+WEIGHT_CPUS = 1.0
+WEIGHT_TEMPLATE = 1.5
+
+MAX_CPU_OVERCOMMIT = 4.0  # hosts above this ratio of vCPUs to physical CPUs score 0
+
+
+def pool_name(conn, template):
+    """Guess the storage pool of ``template`` from its boot disk, e.g. ``/dev/vg0/...``."""
+    domain = conn.getDomain(name=template)
+    path = next(iter(domain.getDiskPaths()), None)
+    if path is None or not path.startswith('/dev/'):
+        return None
+    return path.split('/')[2]
+
+
+def requirements(pool, template):
+    """Get the bytes of storage the clone of ``template`` needs (or ``None`` if unknown)."""
+    for conn in pool.connections:
+        if conn is not None and conn.hasDomain(template):
+            sizes = [conn.getVolumeSize(p) for p in conn.getDomain(name=template).getDiskPaths()]
+            if None in sizes:
+                return None, pool_name(conn, template)
+            return sum(sizes), pool_name(conn, template)
+    return None, None
+
+
+def score(host, memory, cpus, storage, transfer=False):
+    """Score a host, ``memory`` (in bytes), ``cpus`` and ``storage`` are what the clone needs.
+
+    :param transfer: If the template can be copied from another host (``transfer-from``),
+        otherwise only hosts that have the template can take the clone.
+    :return: The score (higher is better) and a reason if the host cannot take the clone.
+    """
+    if not host['has_template'] and not transfer:
+        return 0, 'template missing'
+    free_memory = host['memory'] - host['committed_memory'] - memory
+    if free_memory < 0:
+        return 0, 'not enough memory'
+    if storage is not None and host['storage'] is not None \
+            and host['storage']['available'] < storage:
+        return 0, 'not enough storage'
+
+    result = WEIGHT_MEMORY * free_memory / host['memory']
+
+    overcommit = (host['committed_cpus'] + cpus) / float(host['cpus'])
+    result += WEIGHT_CPUS * max(0, 1 - overcommit / MAX_CPU_OVERCOMMIT)
+
+    if host['storage'] is not None and host['storage']['capacity']:
+        free_storage = host['storage']['available'] - (storage or 0)
+        result += WEIGHT_STORAGE * free_storage / host['storage']['capacity']
+
+    if host['has_template']:
+        result += WEIGHT_TEMPLATE
+    return result, None
+
+
+def rank(pool, template, memory, cpus, storage_pool=None, transfer=False):
+    """Rank all hosts in ``pool`` for a clone of ``template``, best host first.
+
+    :param transfer: See :py:func:`score`.
+    """
+    with trace.span('placement'):
+        storage, guessed_pool = requirements(pool, template)
+        storage_pool = storage_pool or guessed_pool
+
+        def stats(conn):
+            data = conn.getHostStats()
+            data['has_template'] = conn.hasDomain(template)
+            data['storage'] = conn.getStoragePoolStats(storage_pool) if storage_pool else None
+            return data
+
+        hosts = []
+        for uri, data in zip(pool.uris, pool.map(stats)):
+            if data is None:
+                hosts.append(Host(uri=uri, score=0, reason='unreachable: %s' % pool.errors[uri],
+                                  has_template=False, storage=None, memory=0, committed_memory=0,
+                                  cpus=0, committed_cpus=0))
+                continue
+            points, reason = score(data, memory, cpus, storage, transfer)
+            hosts.append(Host(
+                uri=uri, score=points, reason=reason, has_template=data['has_template'],
+                storage=data['storage'], memory=data['memory'],
+                committed_memory=data['committed_memory'], cpus=data['cpus'],
+                committed_cpus=data['committed_cpus']))
+
+    hosts.sort(key=lambda h: (h.reason is None, h.score), reverse=True)
+    for host in hosts:
+        log.info('%s: score %.2f%s (memory %s/%s MiB, vCPUs %s/%s, template %s)',
+                 host.uri, host.score, ' - %s' % host.reason if host.reason else '',
+                 host.committed_memory // 1024 // 1024, host.memory // 1024 // 1024,
+                 host.committed_cpus, host.cpus, 'present' if host.has_template else 'missing')
+    return hosts
+
+
+def is_local(uri, local_uri=None):
+    """If ``uri`` points to a hypervisor on this host.
+
+    :param local_uri: The URI this host uses for its own hypervisor (``libvirt_uri``), it may
+        contain the hostname of this host.
+    """
+    hostname = urlparse(uri).hostname if uri else None
+    if hostname in (None, '', 'localhost'):
+        return True
+    return bool(local_uri) and hostname == urlparse(local_uri).hostname
+
+
+def remote_command(command, uri, argv):
+    """Get the command running virsh-create with ``argv`` on the host of ``uri``.
+
+    :param command: The ``remote_command`` config option, ``{host}`` is replaced with the hostname
+        of ``uri``.
+    """
+    parsed = urlparse(uri)
+    host = parsed.hostname
+    if parsed.username:
+        host = '%s@%s' % (parsed.username, host)
+    # ssh passes the command to a shell, so quote the arguments
+    return shlex.split(command.format(host=host)) + [shlex.quote(a) for a in argv]
+
+
+def run_remote(command, uri, argv):
+    cmd = remote_command(command, uri, argv)
+    log.info('Running clone on %s: %s', uri, ' '.join(cmd))
+    os.execvp(cmd[0], cmd)
@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Compile a clone into a plan and check it before anything is changed.
+
+All independent checks run at the same time and every problem is reported, so a batch job fails
+within seconds instead of partway through a copy.
+"""
+
+import configparser
+import ipaddress
+import logging
+import os
+import re
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from libvirtpy.error import DomainLookupError
+
+from util import allocation
+from util import ca
+from util import image
+from util import lvm
+from util import numa
+from util import process
+from util import profile
+from util import scrub
+from util import settings
+from util import trace
+
+log = logging.getLogger(__name__)
+
+MAX_WORKERS = 8
+MAC_RE = re.compile(r'^([0-9a-fA-F]{1,2}:){5}[0-9a-fA-F]{1,2}$')
+REQUIRED = ['vnc_port', 'public_mac', 'priv_mac', 'public_ip4', 'public_ip6', 'priv_ip4',
+            'priv_ip6']
+
+# type is "block" for LVs and "file" for images, lv and vg are None for images. vg, pvs and stripes
+# are where the new LV is created, source_devices and target_devices the disks below the LVs.
+Disk = namedtuple('disk', ['type', 'path', 'lv', 'vg', 'name', 'new_path', 'size', 'format',
+                           'source_devices', 'pvs', 'stripes', 'target_devices'],
+                  defaults=(frozenset(), None, None, frozenset()))
+FILE_CLONE = ('overlay', 'copy')
+
+
+class CheckFailed(Exception):
+    """Raised by a check that could not complete, e.g. because a command failed."""
+    pass
+
+
+class Plan(object):
+    """Everything a clone will do, compiled before anything is changed."""
+
+    def __init__(self, name):
+        self.name = name
+        self.template = None
+        self.template_id = None
+        self.bootdisk_path = None
+        self.disks = []
+        self.vnc_port = None
+        self.macs = []
+        self.ips = []
+        self.files = list(process.HOSTNAME_FILES)
+        self.scrub_rules = []
+        self.ca_backend = None
+        self.file_clone = None
+        self.numa = None
+        self.profile = None
+        self.reservation = allocation.Reservation()
+        self.problems = []
+
+    def describe(self):
+        lines = ['Plan for %s:' % self.name]
+        for disk in self.disks:
+            if disk.type == 'file':
+                lines.append('  create image %s (%s bytes), %s of %s' % (
+                    disk.new_path, disk.size, self.file_clone, disk.path))
+            else:
+                on = ''
+                if disk.pvs:
+                    on = ' on %s' % ', '.join(disk.pvs)
+                    if disk.stripes:
+                        on += ' (%s stripes)' % disk.stripes
+                lines.append('  create LV %s/%s (%s bytes)%s, copy from %s' % (
+                    disk.vg, disk.name, disk.size, on, disk.path))
+        lines.append('  XML: VNC port %s, MACs %s, IPs %s' % (
+            self.vnc_port, ', '.join(self.macs), ', '.join(self.ips)))
+        if self.numa is not None:
+            lines.append('  NUMA node %s, CPUs %s' % (self.numa.node,
+                                                      numa.format_cpuset(self.numa.cpus)))
+        if self.profile is not None:
+            lines.append('  profile %s: %s' % (self.profile.name, ', '.join(
+                '%s=%s' % (k, v) for k, v in self.profile._asdict().items()
+                if k != 'name' and v is not None)))
+        lines.append('  update hostname in: %s' % ', '.join(self.files))
+        lines.append('  scrub: %s' % ', '.join('%s %s' % (r.action, r.pattern)
+                                               for r in self.scrub_rules))
+        return '\n'.join(lines)
+
+
+def target_problems(bootdisk_path):
+    """Check that the chroot target and the bootdisk symlink for grub don't exist yet."""
+    problems = []
+    if os.path.exists(settings.CHROOT):
+        problems.append('%s: chroot target exists.' % settings.CHROOT)
+    if os.path.lexists(bootdisk_path):
+        problems.append('%s already exists' % bootdisk_path)
+    return problems
+
+
+def check_root():
+    if os.getuid() != 0:  # check if we are root
+        return ['You need to be root to create a virtual machine.']
+    return []
+
+
+def lookup_template(conn, name):
+    try:
+        template = conn.getDomain(name=name)
+    except DomainLookupError:
+        raise CheckFailed('Template VM "%s" does not exist.' % name)
+    template.xml  # fetch XML now, so it happens in parallel
+    return template
+
+
+def domain_inventory(conn):
+    """Get the VNC port, MAC and IP addresses of all domains."""
+    domains = conn.getAllDomains()
+    parent = trace.current()
+
+    def inspect(domain):
+        with trace.span(domain.name, cat='check', parent=parent):
+            return domain.name, domain.getVncPort(), domain.getMacs(), domain.getIPs()
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        return list(executor.map(inspect, domains))
+
+
+def conflicts(plan, inventory):
+    """Check for domains that already use the name, VNC port, MAC or IP addresses of ``plan``."""
+    problems = []
+    for name, port, macs, ips in inventory:
+        if name == plan.name:
+            problems.append('Domain %s already defined.' % name)
+        if port is not None and port == plan.vnc_port:
+            problems.append('VNC port %s already used by %s.' % (port, name))
+        for mac in set(m.lower() for m in plan.macs) & set(m.lower() for m in macs):
+            problems.append('MAC address %s already used by %s.' % (mac, name))
+        for ip in set(plan.ips) & set(ips):
+            problems.append('IP address %s already used by %s.' % (ip, name))
+    return problems
+
+
+def storage_problems(plan, lvs, vgs):
+    problems = []
+    existing = set((lv.vg, lv.name) for lv in lvs)
+    needed = {}
+    for disk in [d for d in plan.disks if d.type == 'block']:
+        if (disk.vg, disk.name) in existing:
+            problems.append('LV %s in VG %s is already defined.' % (disk.name, disk.vg))
+        needed[disk.vg] = needed.get(disk.vg, 0) + disk.size
+
+    for vg, size in needed.items():
+        if vg not in vgs:
+            problems.append('VG %s does not exist.' % vg)
+        elif vgs[vg] < size:
+            problems.append('VG %s has only %s bytes free, but %s are needed.' % (
+                vg, vgs[vg], size))
+    return problems
+
+
+def allocate(plan, pvs, config, section):
+    """Choose the VG and PVs of the new LVs and reserve their disks, see :py:mod:`util.allocation`.
+
+    Raises ``ValueError`` if the configuration is invalid.
+    """
+    mode, vg_map, stripe_min_size, stripes = allocation.options(config, section)
+
+    pv_devices = dict((pv.name, allocation.devices(pv.name)) for pv in pvs)
+    registry = allocation.Registry(config.get(section, 'placement_registry'))
+    with registry.locked():
+        usage = registry.load() if mode == 'spread' else {}
+        used = set()
+        for i, disk in enumerate(plan.disks):
+            if disk.type != 'block':
+                continue
+            if mode == 'spread':
+                alloc = allocation.place(disk.vg, disk.size, disk.source_devices, pvs, pv_devices,
+                                         usage, vg_map, stripe_min_size, stripes)
+            else:
+                alloc = allocation.Allocation(vg_map.get(disk.vg, [disk.vg])[0], None, None,
+                                              frozenset())
+            new_path = disk.new_path
+            if alloc.vg != disk.vg:
+                new_path = os.path.join('/dev', alloc.vg, disk.name)
+            plan.disks[i] = disk._replace(vg=alloc.vg, new_path=new_path, pvs=alloc.pvs,
+                                          stripes=alloc.stripes, target_devices=alloc.devices)
+            used |= disk.source_devices | alloc.devices
+
+        if mode == 'spread' and used:
+            registry.reserve(plan.name, used)
+            plan.reservation = allocation.Reservation(registry, plan.name)
+
+
+def image_problems(plan):
+    """Check that the images of ``plan`` don't exist and fit into their filesystems."""
+    problems = []
+    needed = {}
+    for disk in [d for d in plan.disks if d.type == 'file']:
+        if os.path.lexists(disk.new_path):
+            problems.append('%s already exists.' % disk.new_path)
+        if plan.file_clone == 'copy':  # overlays start (almost) empty
+            dirname = os.path.dirname(disk.new_path)
+            needed[dirname] = needed.get(dirname, 0) + image.allocated(disk.path)
+
+    for dirname, size in needed.items():
+        st = os.statvfs(dirname)
+        if st.f_bavail * st.f_frsize < size:
+            problems.append('%s has only %s bytes free, but %s are needed.' % (
+                dirname, st.f_bavail * st.f_frsize, size))
+    return problems
+
+
+def configure(args, config):
+    """Compile the parts of the plan that only depend on the configuration.
+
+    This needs neither libvirt nor LVM, so it is fast enough to validate a clone with
+    ``virsh-create.py validate``. Problems are in the ``problems`` attribute of the returned plan.
+    """
+    section = args.section
+    plan = Plan(args.name)
+    for key in config[section]:
+        try:
+            config.get(section, key)
+        except configparser.InterpolationMissingOptionError as e:
+            if e.reference != 'template_id':  # only known once the template was looked up
+                plan.problems.append('%s: Unknown option %s.' % (key, e.reference))
+        except configparser.Error as e:
+            plan.problems.append('%s: %s' % (key, e))
+    plan.problems += ['Option %s is missing.' % key for key in REQUIRED
+                      if not config.has_option(section, key)]
+    if plan.problems:
+        return plan
+
+    try:
+        plan.vnc_port = int(config.get(section, 'vnc_port'))
+    except ValueError:
+        plan.problems.append('Invalid VNC port: %s' % config.get(section, 'vnc_port'))
+    else:
+        if not 0 < plan.vnc_port < 65536:
+            plan.problems.append('VNC port %s out of range.' % plan.vnc_port)
+    plan.macs = [config.get(section, 'public_mac'), config.get(section, 'priv_mac')]
+    for mac in plan.macs:
+        if not MAC_RE.match(mac):
+            plan.problems.append('Invalid MAC address: %s' % mac)
+    plan.ips = [config.get(section, key)
+                for key in ['public_ip4', 'public_ip6', 'priv_ip4', 'priv_ip6']]
+    for ip in plan.ips:
+        try:
+            ipaddress.ip_address(ip)
+        except ValueError:
+            plan.problems.append('Invalid IP address: %s' % ip)
+
+    try:
+        plan.scrub_rules = scrub.parse(config.get(section, 'scrub_rules'))
+    except ValueError as e:
+        plan.problems.append(str(e))
+    plan.file_clone = config.get(section, 'file_clone')
+    if plan.file_clone not in FILE_CLONE:
+        plan.problems.append('file_clone must be one of %s.' % ', '.join(FILE_CLONE))
+    try:
+        plan.profile = profile.load(config, section, args.cpus)
+    except ValueError as e:
+        plan.problems.append(str(e))
+    try:
+        allocation.options(config, section)
+    except ValueError as e:
+        plan.problems.append(str(e))
+    if args.numa and config.get(section, 'numa_capabilities') and \
+            not os.path.exists(config.get(section, 'numa_capabilities')):
+        plan.problems.append('%s: File not found.' % config.get(section, 'numa_capabilities'))
+    if args.update_cert:
+        try:
+            plan.ca_backend = ca.backend(config, section)
+        except ValueError as e:
+            plan.problems.append(str(e))
+    return plan
+
+
+def preflight(conn, args, config, lvs=None, check_targets=True):
+    """Compile the clone described by ``args`` into a :py:class:`Plan` and check it.
+
+    The problems found are in the ``problems`` attribute of the returned plan.
+
+    :param check_targets: Also check the chroot target and bootdisk symlink. Skip this if they are
+        checked later, e.g. once a lock is held.
+    """
+    from libvirtpy.constants import DOMAIN_STATUS_SHUTOFF  # imports libvirt
+
+    section = args.section
+    plan = configure(args, config)
+    parent = trace.current()
+
+    def call(func, *args):
+        with trace.span(func.__name__, cat='check', parent=parent):
+            try:
+                return func(*args)
+            except SystemExit:  # e.g. a command failed, the error was already logged
+                raise CheckFailed('%s failed.' % func.__name__)
+
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        root = executor.submit(call, check_root)
+        template = executor.submit(call, lookup_template, conn, config.get(section, 'src_guest'))
+        inventory = executor.submit(call, domain_inventory, conn)
+        vgs = pvs = caps = None
+        if args.numa:
+            caps = executor.submit(call, numa.capabilities, conn,
+                                   config.get(section, 'numa_capabilities'))
+
+        try:
+            template = template.result()
+        except CheckFailed as e:
+            plan.problems.append(str(e))
+            template = None
+
+        if template is not None:
+            plan.template = template
+            plan.template_id = template.domain_id
+            plan.bootdisk_path = os.path.join('/dev', template.getBootTarget())
+
+            transfer_from = config.get(section, 'transfer-from')
+            if template.status != DOMAIN_STATUS_SHUTOFF and not transfer_from:
+                plan.problems.append('VM "%s" is not shut off' % template.name)
+            if check_targets:
+                plan.problems += target_problems(plan.bootdisk_path)
+
+            disks = list(template.getDisks())
+            if any(typ == 'block' for typ, path, fmt in disks):  # LVM is only needed for LVs
+                if lvs is None:
+                    lvs = executor.submit(call, lvm.lvs)
+                vgs = executor.submit(call, lvm.vgs)
+                pvs = executor.submit(call, lvm.pvs)
+            lv_futures = {path: (executor.submit(call, lvm.lvdisplay, path),
+                                 executor.submit(call, allocation.lv_devices, path))
+                          for typ, path, fmt in disks if typ == 'block'}
+            for typ, path, fmt in disks:
+                if typ == 'file':
+                    if transfer_from:
+                        plan.problems.append(
+                            '%s: transfer-from is only supported for LVM-backed disks.' % path)
+                    elif not os.path.exists(path):
+                        plan.problems.append('%s: Image does not exist.' % path)
+                    else:
+                        new_path = image.clone_path(path, template.name, args.name)
+                        plan.disks.append(Disk(
+                            type=typ, path=path, lv=None, vg=None,
+                            name=os.path.basename(new_path), new_path=new_path,
+                            size=os.path.getsize(path), format=fmt))
+                    continue
+
+                try:
+                    lv = lv_futures[path][0].result()
+                    source_devices = lv_futures[path][1].result()
+                except CheckFailed as e:
+                    plan.problems.append(str(e))
+                    continue
+                new_lv = lv.name.replace(template.name, args.name)
+                plan.disks.append(Disk(type=typ, path=path, lv=lv, vg=lv.vg, name=new_lv,
+                                       new_path=path.replace(lv.name, new_lv),
+                                       size=lvm.size(lv), format=fmt,
+                                       source_devices=source_devices))
+
+        results = {}
+        for key, future in [('root', root), ('inventory', inventory), ('lvs', lvs),
+                            ('vgs', vgs), ('pvs', pvs), ('caps', caps)]:
+            if not hasattr(future, 'result'):  # passed by the caller or not needed
+                results[key] = future
+                continue
+            try:
+                results[key] = future.result()
+            except CheckFailed as e:
+                plan.problems.append(str(e))
+                results[key] = None
+
+    if results['root']:
+        plan.problems = results['root'] + plan.problems
+    if results['inventory'] is not None:
+        plan.problems += conflicts(plan, results['inventory'])
+    if results['pvs'] is not None:
+        try:
+            allocate(plan, results['pvs'], config, section)
+        except ValueError as e:
+            plan.problems.append(str(e))
+    if results['lvs'] is not None and results['vgs'] is not None:
+        plan.problems += storage_problems(plan, results['lvs'], results['vgs'])
+    plan.problems += image_problems(plan)
+    if results['caps'] is not None and results['inventory'] is not None:
+        with trace.span('numa', cat='check'):
+            plan.numa = numa.place(numa.topology(results['caps']), conn.getAllDomains(),
+                                   vcpus=args.cpus, memory=int(args.mem * 1024 ** 3))
+        if plan.numa is None:
+            plan.problems.append('No NUMA node has %s CPUs and %s GiB of memory left.' % (
+                args.cpus, args.mem))
+
+    log.debug(plan.describe())
+    return plan
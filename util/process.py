@@ -14,107 +14,207 @@
 # You should have received a copy of the GNU General Public License along with virsh-create. If not, see
 # <http://www.gnu.org/licenses/>.
 
+import functools
 import glob
 import logging
 import os
 import random
+import re
+import tempfile
 
 from contextlib import contextmanager
 
+from util import image
+from util import scrub as scrubber
 from util import settings
+from util import trace
 from util.cli import chroot
 from util.cli import ex
 from util.context import gid, umask, setting
 from util.helpers import get_chroot_gid
 
 log = logging.getLogger(__name__)
+APT_DOWNLOAD_RE = re.compile(r'Need to get ([0-9.,]+) ([kMG]?)B')
+APT_UNITS = {'': 1, 'k': 1000, 'M': 1000 ** 2, 'G': 1000 ** 3}
 
+# files where the hostname of the template is replaced with the hostname of the clone
+HOSTNAME_FILES = ['etc/hostname', 'etc/hosts', 'etc/fstab', 'etc/mailname', 'etc/postfix/main.cf']
 
-@contextmanager
-def mount(frm, lv_name, bootdisk, bootdisk_path):
-    if not settings.DRY:
-        os.makedirs(settings.CHROOT)
-
-    log.info('Detecting logical volumes')
-    with setting(SLEEP=3):
-        ex(['kpartx', '-s', '-a', bootdisk])  # Discover partitions on bootdisk
-        ex(['vgrename', 'vm_%s' % frm, lv_name])  # Rename volume group
-        ex(['vgchange', '-a', 'y', lv_name])  # Activate volume group
-
-    log.info('Mounting logical volumes...')
-    mounted = []
-    ex(['mount', os.path.join('/dev', lv_name, 'root'), settings.CHROOT])
-    mounted.append(settings.CHROOT)
-    for dir in ['boot', 'home', 'usr', 'var', 'tmp']:
-        dev = '/dev/%s/%s' % (lv_name, dir)
+
+# LVs of the guest that are mounted below its root LV (if they exist)
+FILESYSTEMS = ['boot', 'home', 'usr', 'var', 'tmp']
+
+# mounted for steps that chroot into the guest
+PSEUDO_FILESYSTEMS = (
+    ('sysfs', 'sysfs', 'sys'),
+    ('devtmpfs', 'udev', 'dev'),
+    ('devpts', 'devpts', 'dev/pts'),
+    ('proc', 'proc', 'proc'),
+)
+
+POLICY_D = 'usr/sbin/policy-rc.d'
+
+_guest = None  # the guest mounted by mount(), only one guest can be mounted at a time
+
+
+class Guest(object):
+    """Filesystems of the mounted guest, mounted only once a step needs them."""
+
+    def __init__(self, lv_name, bootdisk, bootdisk_path):
+        self.lv_name = lv_name
+        self.bootdisk = bootdisk
+        self.bootdisk_path = bootdisk_path
+        self.mounted = []  # mount points, in the order they were mounted
+        self.tried = set()  # filesystems we already tried to mount
+        self.chroot = False  # if pseudo filesystems are mounted
+
+    def device(self, dir):
+        dev = '/dev/%s/%s' % (self.lv_name, dir)
         if os.path.exists(dev):
-            mytarget = os.path.join(settings.CHROOT, dir)
-            ex(['mount', dev, mytarget])
-            mounted.append(mytarget)
-
-    # mount boot if on separate partition / was not mounted before
-    if not 'boot' in mounted:
-        # just try the first partition
-        mappings, _ = ex(['kpartx', '-l', bootdisk])
+            return dev
+
+    def mount_boot_partition(self):
+        """Mount /boot if it is on a separate partition: just try the first partition."""
+        mappings, _ = ex(['kpartx', '-l', self.bootdisk])
         first_partition = str(mappings, 'utf-8').split(" ")[0]
         first_partition_path = "/dev/mapper/{}".format(first_partition)
-        mytarget = os.path.join(settings.CHROOT, 'boot')
-        try:
-            ex(['mount', first_partition_path, mytarget])
-            mounted.append(mytarget)
-        except Exception:
+        target = os.path.join(settings.CHROOT, 'boot')
+        ex(['mount', first_partition_path, target], ignore_errors=True)
+        if settings.DRY or os.path.ismount(target):
+            self.mounted.append(target)
+        else:
             log.warning("Could not mount boot")
 
-    # mount dev and proc
-    log.info('Mounting /dev, /dev/pts, /proc, /sys')
-    pseudo_filesystems = (
-        ('sysfs', 'sysfs', os.path.join(settings.CHROOT, 'sys')),
-        ('devtmpfs', 'udev', os.path.join(settings.CHROOT, 'dev')),
-        ('devpts', 'devpts', os.path.join(settings.CHROOT, 'dev', 'pts')),
-        ('proc', 'proc', os.path.join(settings.CHROOT, 'proc')),
-    )
-    for typ, dev, target in pseudo_filesystems:
-        ex(['mount', '-t', typ, dev, target])
-        mounted.append(target)
-
-    # create symlink for grub
-    ex(['ln', '-s', bootdisk, bootdisk_path])
-
-    policy_d = 'usr/sbin/policy-rc.d'
-    log.debug('- echo -e "#!/bin/sh\\nexit 101" > %s', policy_d)
-    if not settings.DRY:
-        os.chdir(settings.CHROOT)  # just while we're at it :-)
+    def ensure(self, paths=(), chroot=False):
+        """Mount everything needed to access ``paths`` (or to ``chroot`` into the guest)."""
+        dirs = set(FILESYSTEMS) if chroot else set(p.strip('/').split('/')[0] for p in paths)
+
+        entries = []
+        boot_partition = False
+        for dir in [d for d in FILESYSTEMS if d in dirs]:
+            target = os.path.join(settings.CHROOT, dir)
+            if target in self.mounted or dir in self.tried:
+                continue
+            self.tried.add(dir)
+            dev = self.device(dir)
+            if dev is not None:
+                entries.append((dev, target, 'auto'))
+            elif dir == 'boot':
+                boot_partition = True
+
+        if chroot and not self.chroot:
+            log.info('Mounting /dev, /dev/pts, /proc, /sys')
+            entries += [(dev, os.path.join(settings.CHROOT, target), typ)
+                        for typ, dev, target in PSEUDO_FILESYSTEMS]
+        self.mount(entries)
+        if boot_partition:
+            self.mount_boot_partition()
+
+        if chroot and not self.chroot:
+            # create symlink for grub
+            ex(['ln', '-s', self.bootdisk, self.bootdisk_path])
+
+            log.debug('- echo -e "#!/bin/sh\\nexit 101" > %s', POLICY_D)
+            if not settings.DRY:
+                with open(POLICY_D, 'w') as f:
+                    f.write("#!/bin/sh\nexit 101")
+            ex(['chmod', 'a+rx', POLICY_D])
+            self.chroot = True
+
+    def mount(self, entries):
+        """Mount ``(device, target, type)`` tuples with a single call to mount."""
+        if not entries:
+            return
+        with tempfile.NamedTemporaryFile('w', prefix='virsh-create-', suffix='.fstab') as fstab:
+            for dev, target, typ in entries:
+                fstab.write('%s %s %s defaults 0 0\n' % (dev, target, typ))
+            fstab.flush()
+            ex(['mount', '--all', '--fstab', fstab.name])
+        self.mounted += [target for dev, target, typ in entries]
+
+    def unmount(self):
+        if self.chroot:
+            ex(['rm', POLICY_D, self.bootdisk_path])
+        ex(['umount'] + list(reversed(self.mounted)))
+
+
+def needs(*paths, chroot=False):
+    """Decorator declaring the guest ``paths`` a step needs.
+
+    The filesystems containing these paths are mounted before the step runs. Pass ``chroot=True``
+    for steps that chroot into the guest, they get all filesystems and /dev, /proc and /sys.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _guest is not None:
+                _guest.ensure(paths, chroot=chroot)
+            return func(*args, **kwargs)
+        wrapper.paths = paths
+        wrapper.chroot = chroot
+        return wrapper
+    return decorator
 
-        with open(policy_d, 'w') as f:
-            f.write("#!/bin/sh\nexit 101")
-    ex(['chmod', 'a+rx', policy_d])
 
-    # execute code in context
-    try:
-        yield
-    finally:
+@contextmanager
+def mount(frm, lv_name, bootdisk, bootdisk_path, fmt=None):
+    """Mount the root filesystem of the guest, other filesystems are mounted by :py:func:`needs`.
 
-        # remove files
-        ex(['rm', policy_d, bootdisk_path])
+    :param fmt: The format of the boot disk if it is an image file (see
+        :py:meth:`~libvirtpy.domain.LibVirtBase.getBootDiskFormat`), it is attached as block device
+        first.
+    """
+    global _guest
 
-        # chdir back to /root
+    with trace.span('mount'):
         if not settings.DRY:
-            os.chdir('/root')
+            os.makedirs(settings.CHROOT)
 
-        # unmount filesystems
-        for mount in reversed(mounted):
-            ex(['umount', mount])
+        image_device = None
+        if fmt is not None:
+            image_device = bootdisk = image.attach(bootdisk, fmt)
 
-        # deactivate volume group
+        log.info('Detecting logical volumes')
         with setting(SLEEP=3):
-            ex(['vgchange', '-a', 'n', lv_name])
-            ex(['kpartx', '-s', '-d', bootdisk])
+            ex(['kpartx', '-s', '-a', bootdisk])  # Discover partitions on bootdisk
+            ex(['vgrename', 'vm_%s' % frm, lv_name])  # Rename volume group
+            ex(['vgchange', '-a', 'y', lv_name])  # Activate volume group
+
+        log.info('Mounting logical volumes...')
+        ex(['mount', os.path.join('/dev', lv_name, 'root'), settings.CHROOT])
+        _guest = Guest(lv_name, bootdisk, bootdisk_path)
+        _guest.mounted.append(settings.CHROOT)
 
         if not settings.DRY:
-            log.debug('- rmdir %s', settings.CHROOT)
-            os.removedirs(settings.CHROOT)
+            os.chdir(settings.CHROOT)  # just while we're at it :-)
 
+    # execute code in context
+    try:
+        yield _guest
+    finally:
+        with trace.span('unmount'):
+            # chdir back to /root
+            if not settings.DRY:
+                os.chdir('/root')
+
+            # remove files and unmount filesystems
+            _guest.unmount()
+            _guest = None
+
+            # deactivate volume group
+            with setting(SLEEP=3):
+                ex(['vgchange', '-a', 'n', lv_name])
+                ex(['kpartx', '-s', '-d', bootdisk])
+            if image_device is not None:
+                image.detach(image_device)
 
+            if not settings.DRY:
+                log.debug('- rmdir %s', settings.CHROOT)
+                os.removedirs(settings.CHROOT)
+
+
+@trace.traced
+@needs('etc')
 def update_macs(mac, mac_priv):
     log.info("Update MAC addresses")
     rules = 'etc/udev/rules.d/70-persistent-net.rules'
@@ -122,6 +222,8 @@ def update_macs(mac, mac_priv):
     ex(['sed', '-i', '/NAME="eth1"/s/ATTR{address}=="[^"]*"/ATTR{address}=="%s"/g' % mac_priv, rules])
 
 
+@trace.traced
+@needs('etc')
 def update_ips(*, src_public_ip4, public_ip4, src_priv_ip4, priv_ip4, src_public_ip6,
                public_ip6, src_priv_ip6, priv_ip6):
     log.info('Update IP addresses')
@@ -133,6 +235,8 @@ def update_ips(*, src_public_ip4, public_ip4, src_priv_ip4, priv_ip4, src_public
     ex(['sed', '-i', 's/%s/%s/g' % (src_priv_ip6, priv_ip6), eth1])
 
 
+@trace.traced
+@needs('etc')
 def prepare_sshd(src_priv_ip6, priv_ip6):
     log.info('Preparing SSH daemon')
     ex(['sed', '-i', 's/%s/%s/g' % (src_priv_ip6, priv_ip6), 'etc/ssh/sshd_config.d/local.conf'])
@@ -145,13 +249,24 @@ def prepare_sshd(src_priv_ip6, priv_ip6):
     ex(['ssh-keygen', '-t', 'rsa', '-b', '4096', '-f', 'etc/ssh/ssh_host_rsa_key', '-N', ''])
     log.info('rsa fingerprint: %s', ex(['ssh-keygen', '-lf', 'etc/ssh/ssh_host_rsa_key'])[0])
 
+    # return the public keys, so we can recognize the new host once it is started
+    keys = []
+    for path in glob.glob('etc/ssh/ssh_host_*_key.pub'):
+        with open(path) as stream:
+            keys.append(stream.read().split()[1])
+    return keys
 
+
+@trace.traced
+@needs('etc')
 def prepare_munin(src_priv_ip6, priv_ip6):
     log.info('Preparing munin-node')
     path = 'etc/munin/munin-node.conf'
     ex(['sed', '-i', 's/^host %s/host %s/g' % (src_priv_ip6, priv_ip6), path])
 
 
+@trace.traced
+@needs('etc')
 def prepare_munin_tls(key, pem):
     path = 'etc/munin/munin-node.conf'
     ex(['sed', '-i', 's/^#tls/tls/', path])
@@ -159,6 +274,8 @@ def prepare_munin_tls(key, pem):
     ex(['sed', '-i', 's~^tls_certificate.*~tls_certificate %s~' % pem, path])
 
 
+@trace.traced
+@needs('etc')
 def prepare_cga(frm, name):
     log.info('Prepare cgabackup...')
     cga_config = 'etc/cgabackup/client.conf'
@@ -171,6 +288,8 @@ def prepare_cga(frm, name):
     ex(['sed', '-i', 's/^0 5/%s %s/' % (minute, hour), 'etc/cron.d/cgabackup'])
 
 
+@trace.traced
+@needs('boot', chroot=True)
 def update_grub(sed_ex):
     log.info('Update GRUB')
     # update-grub is suspected to cause problems, so we just replace the hsotname manually
@@ -179,17 +298,33 @@ def update_grub(sed_ex):
     chroot(['update-initramfs', '-u', '-k', 'all'])
 
 
+def _record_download(stdout):
+    """Record the amount of data apt-get downloaded in the current span."""
+    match = APT_DOWNLOAD_RE.search(stdout.decode('utf-8', 'replace') if stdout else '')
+    if match is not None:
+        size = float(match.group(1).replace(',', ''))
+        trace.current().set(download_bytes=int(size * APT_UNITS[match.group(2)]))
+
+
+@trace.traced
+@needs(chroot=True)
 def update_system():
     log.info('Update system')
     chroot(['apt-get', 'update'])
-    chroot(['apt-get', '-y', 'dist-upgrade'])
+    stdout, stderr = chroot(['apt-get', '-y', 'dist-upgrade'])
+    _record_download(stdout)
 
 
+@trace.traced
+@needs(chroot=True)
 def install_extra(extra):
     log.info('Installing extra packages')
-    chroot(['apt-get', 'install', '-y', ] + extra)
+    stdout, stderr = chroot(['apt-get', 'install', '-y', ] + extra)
+    _record_download(stdout)
 
 
+@trace.traced
+@needs(chroot=True)
 def create_ssh_client_keys(name):
     log.info('Generate SSH client keys')
     rsa, ed25519 = '/root/.ssh/id_rsa', '/root/.ssh/id_ed25519'
@@ -207,66 +342,52 @@ def create_ssh_client_keys(name):
         chroot(['sed', '-i', 's/@[^@]*$/@%s/' % name, pub])  # fix hostname in public keys
 
 
-def cleanup_homes():
-    """Remove various sensitive files from users home directories."""
-
-    log.info('Cleaning up home directories')
-    homes = ['root']
-    if settings.DRY:
-        return
-    homes += [os.path.join('home', d) for d
-              in os.listdir(os.path.join(settings.CHROOT, 'home'))]
-    for homedir in homes:
-        path = os.path.join(settings.CHROOT, homedir)
-        if not os.path.isdir(path):
-            continue
-        log.info('checking %s...', path)
-        for filename in ['.bash_history', '.lesshst', '.viminfo', '.rnd', '.histfile', ]:
-            filepath = os.path.join(path, filename)
-            if os.path.exists(filepath):
-                log.info('Removing %s', filepath)
-                os.remove(filepath)
-
-
-def create_tls_cert(name, ca_host, ca_serial):
+@trace.traced
+def scrub(rules):
+    """Remove sensitive files of the template, see :py:mod:`util.scrub`."""
+    log.info('Scrubbing guest filesystems')
+    if _guest is not None:
+        prefixes = [scrubber.prefix(rule) for rule in rules if rule.action != 'exclude']
+        if '' in prefixes:  # a rule starting with a wildcard may match on any filesystem
+            prefixes = FILESYSTEMS
+        _guest.ensure(prefixes)
+    report = scrubber.scrub(settings.CHROOT, rules)
+    trace.current().set(files=len(report), bytes=sum(r.size for r in report))
+    log.info('Scrubbed %s files and directories (%s bytes)', len(report),
+             sum(r.size for r in report))
+    return report
+
+
+@trace.traced
+@needs(chroot=True)
+def create_tls_key(name):
+    """Generate the TLS key of the guest, return the key and certificate paths and the CSR."""
     log.info('Generate TLS certificate')
     key = '/etc/ssl/private/%s.local.key' % name
     pem = '/etc/ssl/public/%s.local.pem' % name
     csr = '/etc/ssl/%s.local.csr' % name
     ssl_cert_gid = get_chroot_gid('ssl-cert')
 
-    sign = 'fsinf-ca sign_cert --alt=%s.local --watch=<your email>' % name
-    if ca_serial:
-        sign += ' --ca=%s' % ca_serial
-
     with gid(ssl_cert_gid), umask(0o277):
         chroot(['openssl', 'genrsa', '-out', key, '4096'])
 
     chroot(['openssl', 'req', '-new', '-key', key, '-out', csr, '-utf8', '-batch', '-sha256', ])
-    log.critical('On %s, do:' % ca_host)
-    log.critical('\t%s' % sign)
     csr_path = os.path.join(settings.CHROOT, csr.lstrip('/'))
     if settings.DRY:
         log.info('... reading CSR content')
-    else:
-        with open(csr_path, 'r') as csr_file:
-            csr_content = csr_file.read()
-        log.critical('... and paste the CSR:\n%s' % csr_content)
-
-    # read certificate
-    cert_content = ''
-    line = ''
-    if settings.DRY:
-        log.info('... reading public certificate')
-    else:
-        while line != '-----END CERTIFICATE-----':
-            line = input().strip()
-            cert_content += '%s\n' % line
+        return key, pem, ''
 
-        with open(os.path.join(settings.CHROOT, pem.lstrip('/')), 'w') as cert_file:
-            cert_file.write(cert_content)
+    with open(csr_path, 'r') as csr_file:
+        csr_content = csr_file.read()
+    os.remove(csr_path)
+    return key, pem, csr_content
 
-        # remove CSR:
-        os.remove(csr_path)
 
-    return key, pem
+@trace.traced
+@needs('etc')
+def install_tls_cert(pem, content):
+    """Write the signed certificate to ``pem`` in the guest."""
+    log.info('Install TLS certificate')
+    if not settings.DRY:
+        with open(os.path.join(settings.CHROOT, pem.lstrip('/')), 'w') as cert_file:
+            cert_file.write(content)
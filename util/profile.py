@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Performance profiles that adapt the device settings of a clone to its size.
+
+A profile is a ``[profile:NAME]`` section in the config file, selected with the ``profile``
+option or ``--profile``::
+
+    [profile:large]
+    disk_cache = none
+    disk_io = native
+    disk_discard = unmap
+    iothreads = cpus/4
+    net_queues = cpus
+    hugepages_min_mem = 16
+    memballoon = virtio
+    memballoon_period = 10
+
+Counts (``iothreads``, ``net_queues``) are either a number, ``cpus`` (the number of vCPUs of the
+new VM) or ``cpus/N``. ``iothreads = 0`` removes the iothreads of the template, ``net_queues``
+must be at least 1. Options that are not set keep the value of the template.
+"""
+
+import logging
+
+from collections import namedtuple
+
+log = logging.getLogger(__name__)
+
+PREFIX = 'profile:'
+CHOICES = {
+    'disk_cache': ('default', 'none', 'writethrough', 'writeback', 'directsync', 'unsafe'),
+    'disk_io': ('native', 'threads', 'io_uring'),
+    'disk_discard': ('unmap', 'ignore'),
+    'memballoon': ('virtio', 'none'),
+}
+OPTIONS = ['disk_cache', 'disk_io', 'disk_discard', 'iothreads', 'net_queues',
+           'hugepages_min_mem', 'memballoon', 'memballoon_period']
+MAX_QUEUES = 256  # maximum number of virtio-net queue pairs in QEMU
+MINIMUM = {'iothreads': 0, 'net_queues': 1, 'hugepages_min_mem': 0, 'memballoon_period': 0}
+
+Profile = namedtuple('profile', ['name'] + OPTIONS)
+
+
+def count(value, cpus, minimum=0):
+    """Parse ``value`` of a count option, raises ``ValueError`` if it is invalid."""
+    if value == 'cpus':
+        result = cpus
+    elif value.startswith('cpus/'):
+        divisor = int(value[len('cpus/'):])
+        if divisor < 1:
+            raise ValueError('Invalid divisor: %s' % divisor)
+        result = max(1, cpus // divisor)
+    else:
+        result = int(value)
+    if result < minimum:
+        raise ValueError('%s is less than %s' % (result, minimum))
+    return result
+
+
+def load(config, section, cpus):
+    """Get the profile selected in ``section`` or ``None``, raises ``ValueError`` if invalid.
+
+    :param cpus: The number of vCPUs of the new VM.
+    """
+    name = config.get(section, 'profile')
+    if not name:
+        return None
+    if not config.has_section(PREFIX + name):
+        raise ValueError('Profile %s: No section [%s%s] in the config file.' % (
+            name, PREFIX, name))
+
+    values = {}
+    for option in OPTIONS:
+        value = config.get(PREFIX + name, option, fallback='').strip()
+        if not value:
+            values[option] = None
+        elif option in CHOICES and value not in CHOICES[option]:
+            raise ValueError('Profile %s: %s must be one of %s.' % (
+                name, option, ', '.join(CHOICES[option])))
+        elif option in ('iothreads', 'net_queues'):
+            try:
+                values[option] = count(value, cpus, MINIMUM[option])
+            except ValueError:
+                raise ValueError('Profile %s: Invalid %s: %s' % (name, option, value))
+        elif option in ('hugepages_min_mem', 'memballoon_period'):
+            try:
+                values[option] = float(value) if option == 'hugepages_min_mem' else int(value)
+                if values[option] < MINIMUM[option]:
+                    raise ValueError(value)
+            except ValueError:
+                raise ValueError('Profile %s: Invalid %s: %s' % (name, option, value))
+        else:
+            values[option] = value
+
+    if values['disk_io'] == 'native' and values['disk_cache'] not in ('none', 'directsync'):
+        raise ValueError('Profile %s: disk_io = native requires disk_cache = none or directsync.'
+                         % name)
+    if values['net_queues'] is not None:
+        values['net_queues'] = min(values['net_queues'], MAX_QUEUES)
+    return Profile(name=name, **values)
+
+
+def apply(domain, profile, mem):
+    """Apply ``profile`` to ``domain`` (a :py:class:`LibVirtDomainXML`) with ``mem`` GiB."""
+    log.info('Applying performance profile %s', profile.name)
+    if profile.disk_cache or profile.disk_io or profile.disk_discard:
+        domain.setDiskDriver(cache=profile.disk_cache, io=profile.disk_io,
+                             discard=profile.disk_discard)
+    if profile.iothreads is not None:
+        domain.setIOThreads(profile.iothreads)
+    if profile.net_queues is not None:
+        domain.setNetQueues(profile.net_queues)
+    if profile.hugepages_min_mem is not None:
+        domain.setHugepages(mem >= profile.hugepages_min_mem)
+    if profile.memballoon is not None:
+        domain.setMemballoon(profile.memballoon, period=profile.memballoon_period)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Wait until freshly started domains are usable.
+
+A :py:class:`Monitor` runs an asyncio event loop in a background thread. It receives libvirt
+lifecycle events on its own read-only connection and probes any number of domains at the same
+time: A domain is ready once the SSH port of one of its addresses accepts connections and presents
+one of the host keys generated by :py:func:`util.process.prepare_sshd`.
+"""
+
+import asyncio
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+INTERVAL = 1.0  # seconds between two probes of the same address
+CONNECT_TIMEOUT = 2.0
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+class NotReady(Exception):
+    pass
+
+
+class Probe(object):
+    """Readiness of one domain, all times are seconds since the probe was created."""
+
+    def __init__(self, name, addresses, keys, port=22, uri=None):
+        self.name = name
+        self.uri = uri
+        self.addresses = [a for a in addresses if a]
+        self.keys = set(keys)
+        self.port = port
+        self.created = time.perf_counter()
+        self.running = None  # libvirt reported the domain as started
+        self.reachable = None  # the port accepted a connection
+        self.ready = None  # the port presented the right host key
+        self.error = None
+        self.started = None  # asyncio.Event, set by the monitor
+
+    def elapsed(self):
+        return time.perf_counter() - self.created
+
+    def as_dict(self):
+        return {'running': self.running, 'reachable': self.reachable, 'ready': self.ready}
+
+
+async def host_keys(address, port):
+    """Get the public host keys presented at ``address`` (base64 blobs only)."""
+    proc = await asyncio.create_subprocess_exec(
+        'ssh-keyscan', '-T', '5', '-p', str(port), address,
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+    stdout, stderr = await proc.communicate()
+    keys = set()
+    for line in stdout.decode('utf-8').splitlines():
+        fields = line.split()
+        if len(fields) >= 3 and not line.startswith('#'):
+            keys.add(fields[2])
+    return keys
+
+
+async def probe_address(probe, address):
+    """Return once ``address`` presents the right host key."""
+    while True:
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(address, probe.port), CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError):
+            await asyncio.sleep(INTERVAL)
+            continue
+        writer.close()
+        if probe.reachable is None:
+            probe.reachable = probe.elapsed()
+            log.debug('%s: %s:%s reachable after %.1fs', probe.name, address, probe.port,
+                      probe.reachable)
+
+        if not probe.keys:  # nothing to compare with (e.g. keys were not regenerated)
+            return
+        keys = await host_keys(address, probe.port)
+        if keys & probe.keys:
+            return
+        elif keys:
+            raise NotReady('%s presents unexpected SSH host keys.' % address)
+        await asyncio.sleep(INTERVAL)
+
+
+class Monitor(object):
+    def __init__(self):
+        self.probes = {}  # (uri, name) -> probe
+        self.connections = {}  # uri -> read-only connection
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, daemon=True,
+                                        name='ready-monitor')
+        self._thread.start()
+        asyncio.run_coroutine_threadsafe(self._register(), self.loop).result()
+
+    async def _register(self):
+        import libvirtaio  # imported here, so the module can be imported without libvirt
+
+        # can only be done once per process, events are only delivered to connections opened
+        # after this
+        libvirtaio.virEventRegisterAsyncIOImpl(loop=self.loop)
+
+    def _connection(self, uri):
+        import libvirt
+
+        if uri not in self.connections:
+            conn = libvirt.openReadOnly(uri)
+            conn.domainEventRegisterAny(None, libvirt.VIR_DOMAIN_EVENT_ID_LIFECYCLE,
+                                        self._on_lifecycle, uri)
+            self.connections[uri] = conn
+        return self.connections[uri]
+
+    def _on_lifecycle(self, conn, domain, event, detail, uri):
+        import libvirt
+
+        probe = self.probes.get((uri, domain.name()))
+        if probe is None:
+            return
+        if event == libvirt.VIR_DOMAIN_EVENT_STARTED:
+            probe.running = probe.elapsed()
+            log.debug('%s: running after %.1fs', probe.name, probe.running)
+            probe.started.set()
+        elif event in (libvirt.VIR_DOMAIN_EVENT_STOPPED, libvirt.VIR_DOMAIN_EVENT_CRASHED):
+            probe.error = 'Domain stopped before it was ready.'
+            probe.started.set()
+
+    async def _watch(self, probe):
+        self._connection(probe.uri)
+        probe.started = asyncio.Event()
+        self.probes[(probe.uri, probe.name)] = probe
+
+    async def _wait(self, probe, timeout):
+        try:
+            await asyncio.wait_for(self._probe(probe), timeout)
+        except asyncio.TimeoutError:
+            probe.error = 'Not ready after %ss.' % timeout
+            if not probe.addresses:
+                probe.error += ' No addresses to probe.'
+        except NotReady as e:
+            probe.error = str(e)
+        finally:
+            self.probes.pop((probe.uri, probe.name), None)
+        return probe
+
+    async def _probe(self, probe):
+        # the domain might have been started before we were watching
+        if self._connection(probe.uri).lookupByName(probe.name).isActive():
+            probe.running = probe.running or probe.elapsed()
+            probe.started.set()
+        await probe.started.wait()
+        if probe.error:
+            raise NotReady(probe.error)
+
+        if not probe.addresses:  # asyncio.wait() raises ValueError for an empty set
+            log.warning('%s: No addresses to probe, waiting for the timeout.', probe.name)
+            await asyncio.Event().wait()
+
+        tasks = [asyncio.ensure_future(probe_address(probe, a)) for a in probe.addresses]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                task.result()  # raises NotReady for a host key mismatch
+        finally:
+            for task in tasks:
+                task.cancel()
+        probe.ready = probe.elapsed()
+        log.info('%s: ready after %.1fs', probe.name, probe.ready)
+
+    def watch(self, probe):
+        """Start receiving lifecycle events for ``probe``, call this before starting the domain."""
+        asyncio.run_coroutine_threadsafe(self._watch(probe), self.loop).result()
+
+    def wait(self, probes, timeout):
+        """Wait until all ``probes`` are ready (or failed) and return them."""
+        futures = [asyncio.run_coroutine_threadsafe(self._wait(probe, timeout), self.loop)
+                   for probe in probes]
+        return [f.result() for f in futures]
+
+
+def monitor():
+    """Get the shared :py:class:`Monitor`, so concurrent clones use one event loop."""
+    global _monitor
+    with _monitor_lock:
+        if _monitor is None:
+            _monitor = Monitor()
+        return _monitor
@@ -0,0 +1,221 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Remove secrets and host-specific state of the template from the filesystem of a clone.
+
+Rules are given in the ``scrub_rules`` config option, one per line as ``ACTION PATTERN``.
+Patterns are globs relative to the root of the guest, ``**`` matches any number of directories::
+
+    delete home/*/.bash_history
+    truncate var/log/**/*.log
+    regenerate etc/machine-id
+    exclude var/lib/docker
+
+Actions are ``delete`` (files and whole directories), ``truncate`` (regular files),
+``regenerate`` (replace the content with a new random ID, for files like ``/etc/machine-id``) and
+``exclude`` (never touch or descend into matching paths).
+
+The tree is walked in parallel with :py:func:`os.scandir`. Only directories where a rule can
+still match are scanned, and rules where the rest of the pattern has no wildcards are resolved
+with a single ``lstat()`` instead of listing the directory, so rules like
+``home/*/.bash_history`` stay cheap even on guests with millions of files. Symlinks are never
+followed, they point to the host while the guest is mounted.
+"""
+
+import fnmatch
+import logging
+import os
+import shutil
+import stat
+import uuid
+
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import wait
+
+from util import settings
+
+log = logging.getLogger(__name__)
+
+ACTIONS = ('delete', 'truncate', 'regenerate', 'exclude')
+MAX_WORKERS = 16
+
+Rule = namedtuple('rule', ['action', 'pattern', 'parts'])
+Removed = namedtuple('removed', ['action', 'path', 'size'])
+
+
+def parse(text):
+    """Parse the ``scrub_rules`` config option, raises ``ValueError`` for invalid rules."""
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        action, _, pattern = line.partition(' ')
+        pattern = pattern.strip().strip('/')
+        if action not in ACTIONS or not pattern:
+            raise ValueError('Invalid scrub rule: %s' % line)
+        rules.append(Rule(action, pattern, pattern.split('/')))
+    return rules
+
+
+def _is_literal(part):
+    return not any(c in part for c in '*?[')
+
+
+def prefix(rule):
+    """Get the path components of ``rule`` that contain no wildcards."""
+    parts = []
+    for part in rule.parts:
+        if not _is_literal(part):
+            break
+        parts.append(part)
+    return '/'.join(parts)
+
+
+def match(parts, path):
+    """If the pattern ``parts`` matches all of ``path`` (a list of path components)."""
+    if not parts:
+        return not path
+    if parts[0] == '**':
+        return any(match(parts[1:], path[i:]) for i in range(len(path) + 1))
+    return bool(path) and fnmatch.fnmatchcase(path[0], parts[0]) and match(parts[1:], path[1:])
+
+
+def below(parts, path):
+    """If the pattern ``parts`` may match something below the directory ``path``."""
+    if not path:
+        return bool(parts)
+    if not parts:
+        return False
+    if parts[0] == '**':
+        return True
+    return fnmatch.fnmatchcase(path[0], parts[0]) and below(parts[1:], path[1:])
+
+
+def _remaining(parts, path):
+    """Get the rest of a pattern below ``path`` if it has no wildcards, otherwise ``None``."""
+    if '**' in parts:  # path components don't line up with the pattern
+        return None
+    rest = parts[len(path):]
+    if any(not _is_literal(part) for part in rest):
+        return None
+    return rest
+
+
+class Scrubber(object):
+    def __init__(self, root, rules):
+        self.root = root
+        self.rules = [r for r in rules if r.action != 'exclude']
+        self.excludes = [r for r in rules if r.action == 'exclude']
+
+    def excluded(self, path):
+        return any(match(r.parts, path) for r in self.excludes)
+
+    def action(self, path):
+        """Get the action for the file at ``path`` (the first matching rule wins)."""
+        for rule in self.rules:
+            if match(rule.parts, path):
+                return rule.action
+
+    def entries(self, path, rules):
+        """Yield names and ``lstat()`` results of the children of ``path`` the rules may need."""
+        dirname = os.path.join(self.root, *path)
+        names = set()
+        for rule in rules:
+            rest = _remaining(rule.parts, path)
+            if rest is None:  # a wildcard follows, so we have to list the directory
+                try:
+                    with os.scandir(dirname) as it:
+                        for entry in it:
+                            yield entry.name, entry.stat(follow_symlinks=False)
+                except OSError as e:
+                    log.warning('Cannot scan %s: %s', dirname, e)
+                return
+            names.add(rest[0])
+
+        for name in sorted(names):
+            try:
+                yield name, os.lstat(os.path.join(dirname, name))
+            except FileNotFoundError:
+                continue
+
+    def scan(self, path):
+        """Scrub the directory ``path``, return what was removed and subdirectories to scan."""
+        rules = [r for r in self.rules if below(r.parts, path)]
+        removed = []
+        subdirs = []
+        for name, st in self.entries(path, rules):
+            child = path + [name]
+            if self.excluded(child):
+                continue
+            action = self.action(child)
+            if action is not None:
+                result = self.apply(action, child, st)
+                if result is not None:
+                    removed.append(result)
+                    continue
+            if stat.S_ISDIR(st.st_mode) and any(below(r.parts, child) for r in rules):
+                subdirs.append(child)
+        return removed, subdirs
+
+    def apply(self, action, path, st):
+        relpath = '/'.join(path)
+        fullpath = os.path.join(self.root, relpath)
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if action in ('truncate', 'regenerate') and not stat.S_ISREG(st.st_mode):
+            log.debug('Not a regular file, cannot %s /%s', action, relpath)
+            return None
+
+        if is_dir:
+            size = sum(os.lstat(os.path.join(d, f)).st_size
+                       for d, _, files in os.walk(fullpath) for f in files)
+        else:
+            size = st.st_size
+        log.info('%s /%s (%s bytes)', action.capitalize(), relpath, size)
+
+        if not settings.DRY:
+            if action == 'delete' and is_dir:
+                shutil.rmtree(fullpath)
+            elif action == 'delete':
+                os.remove(fullpath)
+            elif action == 'truncate':
+                with open(fullpath, 'r+b') as stream:
+                    stream.truncate(0)
+            elif action == 'regenerate':
+                with open(fullpath, 'w') as stream:
+                    stream.write('%s\n' % uuid.uuid4().hex)
+        return Removed(action, '/' + relpath, size)
+
+    def run(self, max_workers=MAX_WORKERS):
+        report = []
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            pending = {executor.submit(self.scan, [])}
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    removed, subdirs = future.result()
+                    report += removed
+                    pending |= {executor.submit(self.scan, d) for d in subdirs}
+        return sorted(report, key=lambda r: r.path)
+
+
+def scrub(root, rules):
+    """Apply ``rules`` to the tree at ``root`` and return a list of what was removed."""
+    if not os.path.isdir(root):
+        return []
+    return Scrubber(root, rules).run()
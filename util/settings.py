@@ -1,3 +1,15 @@
+import threading
+
 SLEEP = 0
 CHROOT = '/target'
 DRY = False
+CGROUP = None
+
+# Values set with util.context.setting() only apply to the thread that set them, so concurrent
+# jobs of the daemon don't sleep or run in the cgroup of each other.
+local = threading.local()
+
+
+def get(name):
+    """Get the setting ``name`` of the current thread."""
+    return getattr(local, name, globals()[name])
@@ -0,0 +1,243 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Throttle the I/O of a clone so running guests on the same storage are not starved.
+
+Disk copies and the apt phase run in a cgroup (v2) below ``io_cgroup`` with the ``io_weight``
+config option as ``io.weight``. While a disk is copied, an AIMD controller watches the average
+latency of the physical devices below the copy in ``/proc/diskstats``: If it is above
+``io_latency_target`` milliseconds, the ``io.max`` limit of the copy is halved, otherwise it is
+raised by :py:data:`INCREASE` per interval.
+"""
+
+import logging
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+from util import settings
+
+log = logging.getLogger(__name__)
+
+INTERVAL = 1.0  # seconds between two adjustments
+INCREASE = 16 * 1024 * 1024  # bytes per second added per interval
+DECREASE = 0.5  # factor applied to the limit if latency is too high
+MIN_RATE = 4 * 1024 * 1024  # never limit below this
+
+
+class Cgroup(object):
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, name, value):
+        with open(os.path.join(self.path, name), 'w') as stream:
+            stream.write(value)
+
+    def create(self, weight=None):
+        """Create the cgroup and enable the io controller for it."""
+        parent = os.path.dirname(self.path)
+        if not os.path.exists(parent):
+            Cgroup(parent).create()
+        Cgroup(parent).write('cgroup.subtree_control', '+io')
+        if not os.path.exists(self.path):
+            os.mkdir(self.path)
+        if weight:
+            self.write('io.weight', 'default %s' % weight)
+
+    def remove(self):
+        try:
+            os.rmdir(self.path)
+        except OSError as e:  # e.g. a process is still running
+            log.warning('Could not remove cgroup %s: %s', self.path, e)
+
+    def limit(self, devices, rate):
+        """Limit I/O to ``devices`` to ``rate`` bytes per second (``None`` means no limit)."""
+        value = 'max' if rate is None else str(int(rate))
+        for dev in devices:
+            self.write('io.max', '%s rbps=%s wbps=%s' % (dev, value, value))
+
+    def bytes(self):
+        """Bytes written by processes in this cgroup so far.
+
+        A copy reads every byte once too, so this is the amount of data copied.
+        """
+        total = 0
+        with open(os.path.join(self.path, 'io.stat')) as stream:
+            for line in stream:
+                for field in line.split()[1:]:
+                    key, value = field.split('=')
+                    if key == 'wbytes':
+                        total += int(value)
+        return total
+
+
+def devnum(path):
+    """Get the ``MAJOR:MINOR`` of the block device at ``path``."""
+    st = os.stat(path)
+    return '%s:%s' % (os.major(st.st_rdev), os.minor(st.st_rdev))
+
+
+def physical_devices(name):
+    """Get the names of the disks below the block device ``name`` (e.g. ``dm-3``)."""
+    sysfs = os.path.join('/sys/class/block', name)
+    slaves = os.path.join(sysfs, 'slaves')
+    if os.path.isdir(slaves) and os.listdir(slaves):
+        return sorted(set(d for s in os.listdir(slaves) for d in physical_devices(s)))
+    if os.path.exists(os.path.join(sysfs, 'partition')):  # use the whole disk of a partition
+        return [os.path.basename(os.path.dirname(os.path.realpath(sysfs)))]
+    return [name]
+
+
+def device_name(path):
+    return os.path.basename(os.path.realpath('/sys/dev/block/%s' % devnum(path)))
+
+
+def diskstats(devices):
+    """Get completed I/Os and milliseconds spent doing them, summed over ``devices``."""
+    ios = ticks = 0
+    with open('/proc/diskstats') as stream:
+        for line in stream:
+            fields = line.split()
+            if fields[2] in devices:
+                ios += int(fields[3]) + int(fields[7])
+                ticks += int(fields[6]) + int(fields[10])
+    return ios, ticks
+
+
+class Controller(object):
+    """AIMD controller for the ``io.max`` limit of a cgroup.
+
+    A controller without a cgroup does nothing, so callers don't have to care if throttling is
+    enabled.
+    """
+
+    def __init__(self, cgroup=None, devices=None, monitor=None, target=None, max_rate=None):
+        self.cgroup = cgroup
+        self.devices = devices or []
+        self.monitor = monitor or []
+        self.target = target
+        self.max_rate = max_rate
+        self.rate = max_rate
+        self.min_rate = None
+        self.events = 0
+        self.bytes = 0
+        self.seconds = 0
+        self._start = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self):
+        return self.cgroup.path if self.cgroup is not None else None
+
+    @property
+    def bandwidth(self):
+        return self.bytes / self.seconds if self.seconds else None
+
+    def update(self, latency, throughput):
+        """Adjust the limit after an interval with ``latency`` ms and ``throughput`` bytes/s."""
+        if latency > self.target:
+            self.rate = max(MIN_RATE, int((self.rate or throughput) * DECREASE))
+            self.events += 1
+            self.min_rate = min(self.rate, self.min_rate or self.rate)
+            log.debug('Latency %.1fms above %sms, limiting copy to %s MiB/s', latency,
+                      self.target, self.rate // 1024 // 1024)
+        elif self.rate is not None:
+            self.rate += INCREASE
+            if self.max_rate is None and self.rate > throughput * 2:
+                self.rate = None  # far above what we actually do, so lift the limit
+            elif self.max_rate is not None:
+                self.rate = min(self.rate, self.max_rate)
+        self.cgroup.limit(self.devices, self.rate)
+
+    def run(self):
+        ios, ticks = diskstats(self.monitor)
+        copied = self.cgroup.bytes()
+        last = time.perf_counter()
+        while not self._stop.wait(INTERVAL):
+            now = time.perf_counter()
+            new_ios, new_ticks = diskstats(self.monitor)
+            new_copied = self.cgroup.bytes()
+            if new_ios > ios:
+                self.update((new_ticks - ticks) / (new_ios - ios),
+                            (new_copied - copied) / (now - last))
+            ios, ticks, copied, last = new_ios, new_ticks, new_copied, now
+
+    def start(self):
+        if self.cgroup is None:
+            return
+        self.cgroup.limit(self.devices, self.rate)
+        self._start = time.perf_counter()
+        if self.target and self.monitor:
+            self._thread = threading.Thread(target=self.run, daemon=True, name='throttle')
+            self._thread.start()
+
+    def stop(self):
+        if self.cgroup is None:
+            return
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.bytes = self.cgroup.bytes()
+        self.seconds = time.perf_counter() - self._start
+
+
+def _cgroup(config, section, name):
+    path = config.get(section, 'io_cgroup')
+    if settings.DRY or not path:
+        return None
+    cgroup = Cgroup(os.path.join(path, name))
+    cgroup.create(weight=config.get(section, 'io_weight'))
+    return cgroup
+
+
+@contextmanager
+def cgroup(config, section, name):
+    """Yield the path of a cgroup with the configured ``io.weight`` (or ``None`` if disabled)."""
+    group = _cgroup(config, section, name)
+    try:
+        yield group.path if group is not None else None
+    finally:
+        if group is not None:
+            group.remove()
+
+
+@contextmanager
+def copy(config, section, name, source, target):
+    """Yield a started :py:class:`Controller` for copying ``source`` to ``target``."""
+    group = _cgroup(config, section, name)
+    if group is None:
+        controller = Controller()
+    else:
+        monitor = config.get(section, 'io_monitor').split()
+        if not monitor:
+            devices = [device_name(source), device_name(target)]
+            monitor = sorted(set(d for dev in devices for d in physical_devices(dev)))
+        max_rate = config.get(section, 'io_max_rate')
+        target_latency = config.get(section, 'io_latency_target')
+        controller = Controller(group, devices=sorted(set([devnum(source), devnum(target)])),
+                                monitor=monitor, max_rate=int(max_rate) if max_rate else None,
+                                target=float(target_latency) if target_latency else None)
+
+    controller.start()
+    try:
+        yield controller
+    finally:
+        controller.stop()
+        if group is not None:
+            group.remove()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# This file is part of virsh-create (https://github.com/fsinf/virsh-create).
+#
+# virsh-create is free software: you can redistribute it and/or modify it under the terms of the
+# GNU General Public License as published by the Free Software Foundation, either version 3 of the
+# License, or (at your option) any later version.
+#
+# virsh-create is distributed in the hope that it will be useful, but WITHOUT ANY WARRANTY; without
+# even the implied warranty of MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with virsh-create.  If
+# not, see <http://www.gnu.org/licenses/>.
+
+"""Record timed spans of a run and export them as a Chrome trace-event timeline.
+
+Spans are always recorded (it is just a list append), they are only written to disk if
+:py:func:`dump` is called. The resulting file can be loaded in ``chrome://tracing`` or Perfetto.
+"""
+
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_local = threading.local()
+_epoch = time.perf_counter()
+
+spans = []  # all finished spans, in the order they finished
+listeners = []  # called with ('start'|'end', span) for every phase
+
+
+class Span(object):
+    def __init__(self, name, cat, parent, attrs):
+        self.name = name
+        self.cat = cat
+        self.parent = parent
+        self.attrs = attrs
+        self.children = []
+        self.tid = threading.get_ident()
+        self.start = time.perf_counter()
+        self.end = None
+
+    @property
+    def duration(self):
+        end = self.end if self.end is not None else time.perf_counter()
+        return end - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def current():
+    """Get the innermost open span of the current thread (or ``None``)."""
+    stack = _stack()
+    return stack[-1] if stack else None
+
+
+@contextmanager
+def span(name, cat='phase', parent=None, **attrs):
+    """Record the enclosed block as a span.
+
+    :param parent: Explicit parent span, needed if the block runs in a different thread than the
+        span it belongs to.
+    """
+    stack = _stack()
+    if parent is None and stack:
+        parent = stack[-1]
+    sp = Span(name, cat, parent, attrs)
+    stack.append(sp)
+    if cat == 'phase':
+        for listener in listeners:
+            listener('start', sp)
+    try:
+        yield sp
+    except SystemExit as e:
+        sp.set(exit=e.code)
+        raise
+    except Exception as e:
+        sp.set(error=repr(e))
+        raise
+    finally:
+        sp.end = time.perf_counter()
+        stack.pop()
+        with _lock:
+            spans.append(sp)
+            if parent is not None:
+                parent.children.append(sp)
+        if cat == 'phase':
+            for listener in listeners:
+                listener('end', sp)
+
+
+def traced(func=None, cat='step'):
+    """Decorator recording every call of the decorated function as a span."""
+    if func is None:
+        return functools.partial(traced, cat=cat)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with span(func.__name__, cat=cat):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def root(sp):
+    """Get the top-level span ``sp`` belongs to."""
+    while sp.parent is not None:
+        sp = sp.parent
+    return sp
+
+
+def roots(spans=spans):
+    """Get all top-level spans, ordered by start time."""
+    return sorted([s for s in spans if s.parent is None], key=lambda s: s.start)
+
+
+def critical_path(root):
+    """Get the chain of spans that dominates ``root``, always following the longest child."""
+    path = [root]
+    while path[-1].children:
+        path.append(max(path[-1].children, key=lambda s: s.duration))
+    return path
+
+
+def chrome_trace():
+    """Get all recorded spans in Chrome trace-event format."""
+    pid = os.getpid()
+    tids = {}
+    events = []
+    for sp in sorted(spans, key=lambda s: s.start):
+        tid = tids.setdefault(sp.tid, len(tids) + 1)
+        events.append({
+            'name': sp.name,
+            'cat': sp.cat,
+            'ph': 'X',
+            'ts': round((sp.start - _epoch) * 1000000),
+            'dur': round(sp.duration * 1000000),
+            'pid': pid,
+            'tid': tid,
+            'args': sp.attrs,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def dump(path):
+    log.info('Writing trace to %s', path)
+    with open(path, 'w') as stream:
+        json.dump(chrome_trace(), stream, default=str)
+
+
+def summary(stream=sys.stderr, slowest=5):
+    """Print a short critical-path summary of the run."""
+    phases = roots()
+    if not phases:
+        return
+    total = phases[-1].end - phases[0].start
+
+    print('Total: %.2fs' % total, file=stream)
+    for phase in phases:
+        share = phase.duration / total * 100 if total else 0
+        print('  %-24s %8.2fs %5.1f%%' % (phase.name, phase.duration, share), file=stream)
+
+    longest = max(phases, key=lambda s: s.duration)
+    print('Critical path: %s' % ' > '.join(
+        '%s (%.2fs)' % (s.name, s.duration) for s in critical_path(longest)), file=stream)
+
+    commands = sorted([s for s in spans if s.cat in ('cmd', 'libvirt')],
+                      key=lambda s: s.duration, reverse=True)[:slowest]
+    if commands:
+        print('Slowest calls:', file=stream)
+        for sp in commands:
+            print('  %8.2fs %s' % (sp.duration, sp.attrs.get('command', sp.name)), file=stream)
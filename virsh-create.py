@@ -14,250 +14,232 @@
 # You should have received a copy of the GNU General Public License along with virsh-create. If not, see
 # <http://www.gnu.org/licenses/>.
 
-import configparser
 import argparse
+import configparser
 import logging
 import os
 import sys
+import time
 
-from libvirtpy.conn import conn
-from libvirtpy.constants import DOMAIN_STATUS_SHUTOFF
-
-from util import lvm
-from util import process
+from util import config as configuration
 from util import settings
-from util.cli import chroot
-from util.cli import ex
+from util import trace
 
 log = logging.getLogger(__name__)
 
-parser = argparse.ArgumentParser()
-parser.add_argument('-f', '--from', metavar='VM', dest='frm',
-                    help="Virtual machine to clone from (Default: %(default)s)")
-parser.add_argument('--desc', default='',
-                    help="Description for the new virtual machine")
-parser.add_argument('--kind', default='debian', choices=('debian', 'ubuntu', ),
-                    help="Set to 'ubuntu' if this is a Ubuntu and not a Debian template.")
-parser.add_argument('--mem', default=1.0, type=float,
-                    help="Amount of Memory in GigaByte (Default: %(default)s).")
-parser.add_argument('--cpus', default=1, type=int,
-                    help="Number of CPUs (Default: %(default)s)")
-parser.add_argument('-v', '--verbose', default=0, action="count",
-                    help="Verbose output. Can be given up to three times to increase verbosity.")
-parser.add_argument('-s', '--section', default='DEFAULT',
-                    help="Use different section in config file (Default: %(default)s).")
-parser.add_argument('--dry', action='store_true', help="Dry-run, don't really do anything")
-parser.add_argument('--no-cert', action='store_false', default=True, dest='update_cert',
-                    help='Do not update TLS certificate.')
-parser.add_argument('--extra', action='append', metavar='PKG',
-                    help='Install extra Debian packages, may be given multiple times.')
-parser.add_argument('name', help="Name of the new virtual machine")
-parser.add_argument(
-    'id', type=int, help="Id of the virtual machine. Used for VNC-port, MAC-address and IP")
-args = parser.parse_args()
-
-# parse local machine dependent configuration
-config = configparser.ConfigParser(defaults={
-    'src_guest': 'stretch',
-    'transfer-from': '',
-    'transfer-to': '',
-    'transfer-source': '',
-    'public_bridge': 'br0',
-    'priv_bridge': 'br1',
-    'vnc_port': '59%(guest_id)s',
-    'ca_host': '',
-    'ca_serial': '',
-})
-config.read('virsh-create.conf')
-config[args.section]['guest_id'] = str(args.id)
-if args.frm:
-    config[args.section]['src_guest'] = args.frm
-
-host_id = config.get(args.section, 'host_id')
-transfer_from = config.get(args.section, 'transfer-from')
-
-# configure logging
-logging.basicConfig(
-    format='[%(asctime)s] %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S',
-    level=logging.ERROR - (args.verbose * 10 if args.verbose <= 3 else 30)
-)
-
-# common configuration:
-settings.DRY = args.dry
-
-#######################
-# Variable definition #
-#######################
-# define some variables
-lv_name = 'vm_%s' % args.name
-src_guest = config.get(args.section, 'src_guest')
-public_bridge = config.get(args.section, 'public_bridge')
-public_mac = config.get(args.section, 'public_mac')
-public_ip4 = config.get(args.section, 'public_ip4')
-public_ip6 = config.get(args.section, 'public_ip6')
-priv_bridge = config.get(args.section, 'priv_bridge')
-priv_mac = config.get(args.section, 'priv_mac')
-priv_ip4 = config.get(args.section, 'priv_ip4')
-priv_ip6 = config.get(args.section, 'priv_ip6')
-vnc_port = config.get(args.section, 'vnc_port')
-ca_host = config.get(args.section, 'ca_host')
-ca_serial = config.get(args.section, 'ca_serial')
-
-######################
-# BASIC SANITY TESTS #
-######################
-if os.getuid() != 0:  # check if we are root
-    log.error('Error: You need to be root to create a virtual machine.')
-    sys.exit(1)
-if os.path.exists(settings.CHROOT):
-    log.error('Error: %s: chroot target exists.', settings.CHROOT)
-    sys.exit(1)
-
-log.debug('Creating VM %s...', args.name)
-
-#########################
-# LIBVIRT SANITY CHECKS #
-#########################
-# get template domain:
-template = conn.getDomain(name=src_guest)
-if template.status != DOMAIN_STATUS_SHUTOFF and not transfer_from:
-    log.error('Error: VM "%s" is not shut off', src_guest)
-    sys.exit(1)
-template_id = template.domain_id  # i.e. 89.
-
-# check if domain is already defined
-if args.name in [d.name for d in conn.getAllDomains()]:
-    log.error("Error: Domain already defined.")
-    sys.exit(1)
-# path to bootdisk, including chroot prefix, e.g. /target/dev/vda
-bootdisk_path = os.path.join('/dev', template.getBootTarget())
-
-if os.path.lexists(bootdisk_path):
-    log.error("Error: %s already exists", bootdisk_path)
-    sys.exit(1)
-
-# get some variables depending on the run-time template id
-config[args.section]['template_id'] = str(template_id)
-src_public_mac = config.get(args.section, 'src_public_mac')
-src_public_ip4 = config.get(args.section, 'src_public_ip4')
-src_public_ip6 = config.get(args.section, 'src_public_ip6')
-src_priv_mac = config.get(args.section, 'src_priv_mac')
-src_priv_ip4 = config.get(args.section, 'src_priv_ip4')
-src_priv_ip6 = config.get(args.section, 'src_priv_ip6')
-
-######################
-# LVM SANITIY CHECKS #
-######################
-# get a list of logical volumes (so we can verify it doesn't exist yet)
-lvs = {(lv.vg, lv.name): lv for lv in lvm.lvs()}  # list of all logical volumes
-
-# Create mappings from template LVMs to target LVMs, check if they exist
-lv_mapping = {}
-for path in template.getDiskPaths():
-    lv = lvm.lvdisplay(path)
-
-    new_lv_name = lv.name.replace(template.name, args.name)
-    if (lv.vg, new_lv_name) in lvs:
-        log.error("Error: LV %s in VG %s is already defined.", new_lv_name, lv.vg)
-        sys.exit(1)
-    lv_mapping[(lv.vg, lv.name)] = (lv.vg, new_lv_name)
-
-#################
-# COPY TEMPLATE #
-#################
-# finally get the full xml of the template
-log.info("Copying libvirt XML configuration...")
-domain = template.copy()
-domain.name = args.name
-domain.uuid = ''
-domain.description = args.desc
-domain.vcpu = args.cpus
-domain.memory = int(args.mem * 1024 * 1024)
-domain.currentMemory = int(args.mem * 1024 * 1024)
-domain.vncport = int(vnc_port)
-domain.update_interface(public_bridge, public_mac, public_ip4, public_ip6)
-domain.update_interface(priv_bridge, priv_mac, priv_ip4, priv_ip6)
-
-##############
-# Copy disks #
-##############
-for path in template.getDiskPaths():
-    # create logical volume
-    lv = lvm.lvdisplay(path)
-    new_vg, new_lv = lv_mapping[(lv.vg, lv.name)]
-    new_path = path.replace(lv.name, new_lv)
-    lvm.lvcreate(new_vg, new_lv, lv.size)
-
-    # replace disk in template
-    domain.replaceDisk(path, new_path)
-
-    if transfer_from:
-        transfer_to = config.get(args.section, 'transfer-to')
-        transfer_source = config.get(args.section, 'transfer-source')
-        log.warn('Copy disk by executing on %s', transfer_from)
-        log.warn("  dd if=%s bs=4096 | pv | gzip | ssh %s 'gzip -d | dd of=%s bs=4096'",
-                 transfer_source or path, transfer_to, new_path)
-        log.warn("Press enter when done.")
-        if not settings.DRY:
-            input()
-    else:
-        # copy data from local volume
-        log.info("Copying LV %s to %s", path, new_path)
-        ex(['dd', 'if=%s' % path, 'of=%s' % new_path, 'bs=4M'])
-
-############################
-# Define domain in libvirt #
-############################
-log.info('Load new libvirt XML configuration')
-if not settings.DRY:
-    conn.loadXML(domain.xml)
-
-
-#####################
-# MODIFY FILESYSTEM #
-#####################
-sed_ex = 's/%s/%s/g' % (src_guest, args.name)
-
-bootdisk = domain.getBootDisk()
-with process.mount(src_guest, lv_name, bootdisk, bootdisk_path):
-    # copy /etc/resolv.conf, so that e.g. apt-get update works
-    ex(['cp', '-S', '.backup', '-ba', '/etc/resolv.conf', 'etc/resolv.conf'])
-
-    # update hostname
-    log.info('Update hostname')
-    ex(['sed', '-i', sed_ex, 'etc/hostname'])
-    ex(['sed', '-i', sed_ex, 'etc/hosts'])
-    ex(['sed', '-i', sed_ex, 'etc/fstab'])
-    ex(['sed', '-i', sed_ex, 'etc/mailname'])
-    ex(['sed', '-i', sed_ex, 'etc/postfix/main.cf'])
-
-    process.prepare_cga(src_guest, args.name)
-    process.update_ips(
-        src_public_ip4=src_public_ip4,
-        public_ip4=public_ip4,
-        src_priv_ip4=src_priv_ip4,
-        priv_ip4=priv_ip4,
-        src_public_ip6=src_public_ip6,
-        public_ip6=public_ip6,
-        src_priv_ip6=src_priv_ip6,
-        priv_ip6=priv_ip6,
-    )
-    process.update_macs(public_mac, priv_mac)
-    process.cleanup_homes()
-    process.prepare_sshd(src_priv_ip6, priv_ip6)
-    process.update_grub(sed_ex)
-    process.update_system()
-    if args.extra:
-        process.install_extra(args.extra)
+COMMANDS = ('create', 'stats', 'daemon', 'validate')
 
-    process.create_ssh_client_keys(args.name)
 
-    if args.update_cert:
-        key, pem = process.create_tls_cert(args.name, ca_host, ca_serial)
-        process.prepare_munin_tls(key, pem)
+def configure_logging(verbose, format='[%(asctime)s] %(message)s'):
+    logging.basicConfig(
+        format=format,
+        datefmt='%Y-%m-%d %H:%M:%S',
+        level=logging.ERROR - (verbose * 10 if verbose <= 3 else 30)
+    )
 
-    process.prepare_munin(src_priv_ip6, priv_ip6)
 
-    log.info('Done, cleaning up.')
-    chroot(['mv', '/etc/resolv.conf.backup', '/etc/resolv.conf'])
+def connect(config, section):
+    from libvirtpy.conn import LibVirtConnection  # imports libvirt and lxml
+    return LibVirtConnection(config.get(section, 'libvirt_uri') or None)
+
+
+def create(args, config):
+    from util import daemon
+    from util import estimate
+    from util import metrics
+    from util import placement
+    from util.clone import clone
+
+    configuration.for_guest(config, args.section, args.id, args.frm, args.profile)
+    src_guest = config.get(args.section, 'src_guest')
+    configure_logging(args.verbose)
+
+    # common configuration:
+    settings.DRY = args.dry
+
+    # Pick the best hypervisor if requested, continue on the other host if it's not this one.
+    conn = None
+    if args.place:
+        from libvirtpy.conn import LibVirtConnectionPool
+
+        hosts = config.get(args.section, 'hosts').split()
+        if not hosts:
+            log.error('Error: --place requires "hosts" in the config file.')
+            sys.exit(1)
+        pool = LibVirtConnectionPool(hosts)
+        ranking = placement.rank(pool, src_guest,
+                                 memory=int(args.mem * 1024 ** 3), cpus=args.cpus,
+                                 storage_pool=config.get(args.section, 'storage_pool'),
+                                 transfer=bool(config.get(args.section, 'transfer-from')))
+        best = ranking[0]
+        if best.reason is not None:
+            log.error('Error: No host can take the clone: %s', best.reason)
+            sys.exit(1)
+        if not placement.is_local(best.uri, config.get(args.section, 'libvirt_uri')):
+            placement.run_remote(config.get(args.section, 'remote_command'), best.uri,
+                                 [a for a in args.argv if a != '--place'])
+        log.info('Cloning on this host (%s).', best.uri)
+        conn = pool.get(best.uri)
+
+    # Submit the job to the daemon if it is running and can handle it (it clones on libvirt_uri).
+    daemon_socket = config.get(args.section, 'daemon_socket')
+    other_uri = conn is not None and conn.uri != (config.get(args.section, 'libvirt_uri') or None)
+    if not args.local and os.path.exists(daemon_socket) and not (
+            args.dry or args.trace or other_uri or config.get(args.section, 'transfer-from') or (
+                args.update_cert and config.get(args.section, 'ca_backend') == 'interactive')):
+        log.info('Submitting job to daemon at %s', daemon_socket)
+        job = {key: getattr(args, key) for key in ['name', 'id', 'frm', 'section', 'desc', 'cpus',
+                                                   'mem', 'extra', 'update_cert', 'start',
+                                                   'wait_ready', 'numa', 'profile']}
+        result = daemon.submit(daemon_socket, job)
+        if result is not None:
+            sys.exit(0 if result else 1)
+        log.info('Cloning locally.')
+
+    status = 'failed'
+    try:
+        clone(conn or connect(config, args.section), args, config)
+        status = 'ok'
+    finally:
+        if args.trace:
+            trace.dump(args.trace)
+            trace.summary()
+
+        if not args.dry:
+            metrics_db = config.get(args.section, 'metrics_db')
+            metrics_textfile = config.get(args.section, 'metrics_textfile')
+            try:
+                metrics.record(metrics_db, src_guest, args.name, status)
+                if metrics_textfile:
+                    metrics.write_textfile(metrics_db, metrics_textfile)
+            except Exception as e:
+                log.warn('Could not record metrics: %s', e)
+
+    if args.dry:
+        estimate.report(config.get(args.section, 'metrics_db'), src_guest)
+
+
+def validate(args, config):
+    """Check the configuration of a clone without connecting to libvirt or scanning LVM."""
+    from util.preflight import configure
+
+    start = time.perf_counter()
+    configure_logging(args.verbose)
+    if args.section != configparser.DEFAULTSECT and not config.has_section(args.section):
+        log.error('Error: No section [%s] in the config file.', args.section)
+        sys.exit(1)
+    configuration.for_guest(config, args.section, args.id, args.frm, args.profile)
+    plan = configure(args, config)
+    for problem in plan.problems:
+        log.error('Error: %s', problem)
+    log.info('Validated in %.1fms.', (time.perf_counter() - start) * 1000)
+    sys.exit(1 if plan.problems else 0)
+
+
+def stats(args, config):
+    from util import metrics
+    metrics.stats(config.get(args.section, 'metrics_db'), template=args.template)
+
+
+def run_daemon(args, config):
+    from util import daemon
+
+    configure_logging(args.verbose, format='[%(asctime)s] %(threadName)s: %(message)s')
+    daemon.Daemon(connect(config, args.section), config,
+                  config.get(args.section, 'daemon_socket'),
+                  max_jobs=config.getint(args.section, 'daemon_max_jobs')).serve()
+
+
+def add_common_arguments(parser):
+    parser.add_argument('-s', '--section', default='DEFAULT',
+                        help="Use different section in config file (Default: %(default)s).")
+    parser.add_argument('-v', '--verbose', default=0, action="count",
+                        help="Verbose output. Can be given up to three times to increase "
+                        "verbosity.")
+
+
+def add_clone_arguments(parser):
+    """Arguments describing the new virtual machine, used by create and validate."""
+    parser.add_argument('-f', '--from', metavar='VM', dest='frm',
+                        help="Virtual machine to clone from (Default: %(default)s)")
+    parser.add_argument('--desc', default='',
+                        help="Description for the new virtual machine")
+    parser.add_argument('--kind', default='debian', choices=('debian', 'ubuntu', ),
+                        help="Set to 'ubuntu' if this is a Ubuntu and not a Debian template.")
+    parser.add_argument('--mem', default=1.0, type=float,
+                        help="Amount of Memory in GigaByte (Default: %(default)s).")
+    parser.add_argument('--cpus', default=1, type=int,
+                        help="Number of CPUs (Default: %(default)s)")
+    parser.add_argument('--no-cert', action='store_false', default=True, dest='update_cert',
+                        help='Do not update TLS certificate.')
+    parser.add_argument('--numa', action='store_true',
+                        help="Pin the virtual machine to the CPUs and memory of the least loaded "
+                        "NUMA node.")
+    parser.add_argument('--profile', metavar='NAME',
+                        help="Apply the performance profile in the [profile:NAME] section of the "
+                        "config file (Default: the profile option of the section).")
+    parser.add_argument('name', help="Name of the new virtual machine")
+    parser.add_argument(
+        'id', type=int, help="Id of the virtual machine. Used for VNC-port, MAC-address and IP")
+
+
+parser = argparse.ArgumentParser(
+    description="Clone virtual machines. Without a command, the arguments are those of create.")
+commands = parser.add_subparsers(dest='command', metavar='COMMAND')
+
+create_parser = commands.add_parser('create', help="Clone a new virtual machine (the default).")
+create_parser.set_defaults(func=create)
+add_common_arguments(create_parser)
+add_clone_arguments(create_parser)
+create_parser.add_argument('--dry', action='store_true',
+                           help="Dry-run, don't really do anything but print an execution plan "
+                           "with an estimate of how long the clone will take.")
+create_parser.add_argument('--extra', action='append', metavar='PKG',
+                           help='Install extra Debian packages, may be given multiple times.')
+create_parser.add_argument('--place', action='store_true',
+                           help="Pick the best of the hosts in the config file and clone there.")
+create_parser.add_argument('--local', action='store_true',
+                           help="Do not submit the job to a running daemon but clone locally.")
+create_parser.add_argument('--start', action='store_true',
+                           help="Start the new virtual machine when done.")
+create_parser.add_argument('--wait-ready', action='store_true',
+                           help="Start the new virtual machine and wait until it answers on SSH "
+                           "with its new host key.")
+create_parser.add_argument('--trace', metavar='FILE',
+                           help='Write a Chrome trace-event timeline of all steps to FILE and '
+                           'print a summary of where the time went.')
+
+validate_parser = commands.add_parser(
+    'validate', help="Only check the configuration of a clone, without connecting to libvirt.")
+validate_parser.set_defaults(func=validate)
+add_common_arguments(validate_parser)
+add_clone_arguments(validate_parser)
+
+stats_parser = commands.add_parser('stats', help="Show statistics of previous runs.")
+stats_parser.set_defaults(func=stats)
+add_common_arguments(stats_parser)
+stats_parser.add_argument('--template', metavar='VM',
+                          help="Only show statistics for clones of this template.")
+
+daemon_parser = commands.add_parser(
+    'daemon', help="Run a provisioning daemon that accepts clone jobs on a Unix socket.")
+daemon_parser.set_defaults(func=run_daemon)
+add_common_arguments(daemon_parser)
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    if not argv or (argv[0] not in COMMANDS and argv[0] not in ('-h', '--help')):
+        argv = ['create'] + argv  # "virsh-create.py NAME ID" still creates a clone
+
+    args = parser.parse_args(argv)
+    args.argv = argv[1:]  # without the command, for running the same create on another host
+
+    # parse local machine dependent configuration
+    config = configuration.load()
+    args.func(args, config)
+
+
+if __name__ == '__main__':
+    main()